@@ -8,7 +8,9 @@ HOME = os.environ['HOME']
 DEBUG = True
 TEMPLATE_DEBUG = DEBUG
 
-DATABASES = {'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': HOME + '/kegbot-data/kegbot.sqlite'}}
+# The test database is a file, rather than in memory, so that tests can
+# record drinks concurrently from several connections.
+DATABASES = {'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': HOME + '/kegbot-data/kegbot.sqlite', 'TEST_NAME': HOME + '/kegbot-data/kegbot-test.sqlite'}}
 
 KEGBOT_ROOT = HOME + '/kegbot-data'
 
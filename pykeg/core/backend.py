@@ -20,13 +20,16 @@
 
 from __future__ import absolute_import
 
-import datetime
+import copy
 import logging
 
 from django.conf import settings
+from django.db import transaction
 from django.utils import timezone
 from . import kb_common
 from . import models
+from . import registry
+from . import sessions
 from . import time_series
 
 if settings.HAVE_CELERY:
@@ -97,95 +100,283 @@ class KegbotBackend:
   def RecordDrink(self, tap_name, ticks, volume_ml=None, username=None,
       pour_time=None, duration=0, shout='', tick_time_series='',
       do_postprocess=True):
+    """Records a new drink.
+
+    If settings.KEGBOT_ASYNC_POSTPROCESS is set, the drink is queued to be
+    post processed by the kb_postprocess worker; otherwise it is post
+    processed before returning, unless `do_postprocess` is False.
+    """
+    d = self._NewDrink(tap_name, ticks, volume_ml=volume_ml,
+        username=username, pour_time=pour_time, duration=duration,
+        shout=shout, tick_time_series=tick_time_series)
 
-    tap = self._GetTapFromName(tap_name)
+    queue = do_postprocess and settings.KEGBOT_ASYNC_POSTPROCESS
+    with transaction.commit_on_success():
+      models.DatabaseLock.Acquire(models.DrinkingSession.ASSIGNMENT_LOCK)
+      models.DrinkingSession._AssignSessionForDrink(d,
+          registry.Get().session_delta)
+      if queue:
+        models.PostProcessTask.Enqueue(d)
+
+    if queue:
+      if settings.HAVE_CELERY:
+        tasks.process_pending_drinks.delay()
+    elif do_postprocess:
+      d.PostProcess()
+      self._HandleNewEvents([d])
+
+    return d
+
+  def RecordDrinks(self, pours):
+    """Records several drinks at once, eg pours queued by a client while it
+    was offline.
+
+    `pours` is a list of dicts of RecordDrink arguments, each with an optional
+    `client_id`.  A pour whose `client_id` was already recorded is skipped.
+    The new drinks are assigned sessions in time order and post processed
+    together, in a single transaction, or queued as by RecordDrink.
+
+    Returns the drinks, in the order of `pours`; for skipped pours, the drink
+    recorded earlier.
+    """
+    drinks = [self._NewDrink(**pour) for pour in pours]
+    new_drinks = []
+    with transaction.commit_on_success():
+      models.DatabaseLock.Acquire(models.DrinkingSession.ASSIGNMENT_LOCK)
+
+      client_ids = [d.client_id for d in drinks if d.client_id]
+      recorded = dict((d.client_id, d) for d in
+          models.Drink.objects.filter(client_id__in=client_ids))
+      for i, d in enumerate(drinks):
+        if d.client_id:
+          if d.client_id in recorded:
+            drinks[i] = recorded[d.client_id]
+            continue
+          recorded[d.client_id] = d
+        new_drinks.append(d)
+
+      new_drinks.sort(key=lambda d: d.time)
+      session_delta = registry.Get().session_delta
+      if settings.KEGBOT_ASYNC_POSTPROCESS:
+        for d in new_drinks:
+          models.DrinkingSession._AssignSessionForDrink(d, session_delta)
+          models.PostProcessTask.Enqueue(d)
+      else:
+        for i, d in enumerate(new_drinks):
+          models.DrinkingSession._AssignSessionForDrink(d, session_delta,
+              pending_drinks=new_drinks[:i])
+        models.Drink._PostProcessDrinks(new_drinks)
+
+    if settings.KEGBOT_ASYNC_POSTPROCESS:
+      if new_drinks and settings.HAVE_CELERY:
+        tasks.process_pending_drinks.delay()
+    else:
+      self._HandleNewEvents(new_drinks)
+
+    return drinks
+
+  def ProcessPendingDrinks(self, batch_size=100):
+    """Post processes up to `batch_size` queued drinks, in the order they were
+    queued.  Returns the number processed.
+
+    The session assignment lock is held only to claim the drinks, so drinks
+    can be recorded while the claimed drinks are post processed.
+    """
+    if not self._ClaimPendingDrinks(batch_size):
+      return 0
+    return self._ProcessClaimedDrinks()
+
+  def _ClaimPendingDrinks(self, batch_size):
+    """Claims up to `batch_size` queued drinks; returns the number claimed."""
+    with transaction.commit_on_success():
+      models.DatabaseLock.Acquire(models.DrinkingSession.ASSIGNMENT_LOCK)
+      unclaimed = models.PostProcessTask.objects.filter(claimed=False)
+      task_ids = list(unclaimed.order_by('id').values_list('id',
+          flat=True)[:batch_size])
+      models.PostProcessTask.objects.filter(id__in=task_ids).update(
+          claimed=True)
+    return len(task_ids)
+
+  def _ProcessClaimedDrinks(self):
+    """Post processes all claimed drinks, in the order they were queued, in a
+    single transaction.  Returns the number processed.
+
+    Drinks claimed by other workers are processed too, so that a worker
+    which claimed later cannot process its drinks first.
+    """
+    with transaction.commit_on_success():
+      models.DatabaseLock.Acquire(models.PostProcessTask.PROCESSING_LOCK)
+      queued = models.PostProcessTask.objects.filter(claimed=True)
+      queued = list(queued.select_related('drink').order_by('id'))
+      drinks = [task.GetDrink() for task in queued]
+      models.Drink._PostProcessDrinks(drinks)
+      models.PostProcessTask.objects.filter(
+          id__in=[task.id for task in queued]).delete()
+    self._HandleNewEvents(drinks)
+    return len(drinks)
+
+  def _HandleNewEvents(self, drinks):
+    if drinks and settings.HAVE_CELERY:
+      event_list = list(models.SystemEvent.objects.filter(
+          drink__in=drinks).order_by('id'))
+      if event_list:
+        tasks.handle_new_events.delay(event_list)
+
+  def _NewDrink(self, tap_name, ticks, volume_ml=None, username=None,
+      pour_time=None, duration=0, shout='', tick_time_series='',
+      client_id=None):
+    """Returns a new, unsaved drink.  Taps, kegs and users are looked up in
+    the tap registry rather than queried."""
+    tap_registry = registry.Get()
+    tap = tap_registry.GetTap(tap_name)
     if not tap:
       raise BackendError("Tap unknown")
 
     if volume_ml is None:
       volume_ml = float(ticks) * tap.ml_per_tick
 
-    user = None
     if username:
-      user = self._GetUserObjFromUsername(username)
+      user_id = tap_registry.GetUserId(username)
     else:
-      user = models.SiteSettings.get().default_user
+      user_id = tap_registry.default_user_id
 
     if not pour_time:
       pour_time = timezone.now()
 
-    keg = None
-    if tap.current_keg and tap.current_keg.status == 'online':
-      keg = tap.current_keg
-
     if tick_time_series:
       try:
-        # Validate the time series by parsing it; canonicalize it by generating
-        # it again.  If malformed, just junk it; it's non-essential information.
-        tick_time_series = time_series.to_string(time_series.from_string(tick_time_series))
+        # Validate the time series by parsing it; the parsed series is encoded
+        # directly when saved.  If malformed, just junk it; it's non-essential
+        # information.
+        tick_time_series = time_series.from_string(tick_time_series)
       except ValueError, e:
         self._logger.warning('Time series invalid, ignoring. Error was: %s' % e)
         tick_time_series = ''
 
-    d = models.Drink(ticks=ticks, keg=keg, user=user,
+    return models.Drink(ticks=ticks, keg_id=tap.keg_id, user_id=user_id,
         volume_ml=volume_ml, time=pour_time, duration=duration,
-        shout=shout, tick_time_series=tick_time_series)
-    models.DrinkingSession.AssignSessionForDrink(d)
-    d.save()
+        shout=shout, tick_time_series=tick_time_series,
+        client_id=client_id or None)
 
-    if do_postprocess:
-      d.PostProcess()
-      event_list = [e for e in models.SystemEvent.objects.filter(drink=d).order_by('id')]
-      if settings.HAVE_CELERY:
-        tasks.handle_new_events.delay(event_list)
+  def CancelDrink(self, drink_id, spilled=False):
+    """Cancels a drink, removing it from its session and stats.  A drink
+    which is already cancelled is returned unchanged."""
+    with transaction.commit_on_success():
+      # Serializes with session assignment and the post processing worker,
+      # and with other cancellations of the drink.
+      models.DatabaseLock.Acquire(models.DrinkingSession.ASSIGNMENT_LOCK)
+      models.DatabaseLock.Acquire(models.PostProcessTask.PROCESSING_LOCK)
+      try:
+        d = models.Drink.objects.get(id=drink_id)
+      except models.Drink.DoesNotExist:
+        return
+      if d.status != 'valid':
+        return d
+
+      session = d.session
+
+      # Transfer volume to spillage if requested.
+      if spilled and d.volume_ml and d.keg:
+        d.keg.spilled_ml += d.volume_ml
+        d.keg.save()
+
+      d.status = 'deleted'
+      d.save()
+
+      queued = models.PostProcessTask.objects.filter(drink=d)
+      if queued.exists():
+        # Not yet in any stats, and without events.
+        queued.delete()
+      else:
+        # Remove the drink from all statistics.
+        self._RemoveDrinkFromStats(d)
+
+        # Delete any SystemEvents for this drink.
+        models.SystemEvent.objects.filter(drink=d).delete()
+
+      if session:
+        # The session may now be empty, start later, or split in two.
+        sessions.ReassignSessions([session])
 
     return d
 
-  def CancelDrink(self, drink_id, spilled=False):
+  def AdjustDrinkVolume(self, drink_id, volume_ml):
+    """Corrects the volume of a recorded drink."""
     try:
       d = models.Drink.objects.get(id=drink_id)
     except models.Drink.DoesNotExist:
       return
 
-    keg = d.keg
-    user = d.user
-    session = d.session
-
-    # Transfer volume to spillage if requested.
-    if spilled and d.volume_ml and d.keg:
-      d.keg.spilled_ml += d.volume_ml
-      d.keg.save()
-
-    d.status = 'deleted'
-    d.save()
-
-    # Invalidate all statistics.
-    models.SystemStats.objects.all().delete()
-    models.KegStats.objects.filter(keg=d.keg).delete()
-    models.UserStats.objects.filter(user=d.user).delete()
-    models.SessionStats.objects.filter(session=d.session).delete()
-
-    # Delete any SystemEvents for this drink.
-    models.SystemEvent.objects.filter(drink=d).delete()
-
-    # Regenerate new statistics, based on the most recent drink
-    # post-cancellation.
-    last_qs = models.Drink.objects.valid().order_by('-id')
-    if last_qs:
-      last_drink = last_qs[0]
-      last_drink._UpdateSystemStats()
-
-    if keg:
-      keg.RecomputeStats()
-    if user and user.get_profile():
-      user.get_profile().RecomputeStats()
-    if session:
-      session.Rebuild()
-      session.RecomputeStats()
-
-    # TODO(mikey): recompute session.
+    original = copy.copy(d)
+    d.volume_ml = volume_ml
+    with transaction.commit_on_success():
+      models.DatabaseLock.Acquire(models.DrinkingSession.ASSIGNMENT_LOCK)
+      models.DatabaseLock.Acquire(models.PostProcessTask.PROCESSING_LOCK)
+      d.save()
+      self._ReplaceDrinkInStats(original, d)
+      # Flow rates were computed from the old volume.
+      models.DrinkFlow.objects.filter(drink=d).delete()
     return d
 
+  def ReassignDrink(self, drink_id, username):
+    """Assigns a recorded drink to another user, or to a guest if no username
+    is given."""
+    try:
+      d = models.Drink.objects.get(id=drink_id)
+    except models.Drink.DoesNotExist:
+      return
+
+    user = None
+    if username:
+      user = self._GetUserObjFromUsername(username)
+      if not user:
+        raise BackendError("User unknown")
+
+    original = copy.copy(d)
+    d.user = user
+    with transaction.commit_on_success():
+      models.DatabaseLock.Acquire(models.DrinkingSession.ASSIGNMENT_LOCK)
+      models.DatabaseLock.Acquire(models.PostProcessTask.PROCESSING_LOCK)
+      d.save()
+      self._ReplaceDrinkInStats(original, d)
+    return d
+
+  def _RemoveDrinkFromStats(self, drink):
+    """Removes `drink` from the stats of every scope it belongs to, without
+    rebuilding them."""
+    records = list(models.SystemStats.objects.all())
+    if drink.keg:
+      records += list(models.KegStats.objects.filter(keg=drink.keg))
+    if drink.user:
+      records += list(models.UserStats.objects.filter(user=drink.user))
+    if drink.session:
+      records += list(models.SessionStats.objects.filter(session=drink.session))
+    for record in records:
+      record.RemoveDrink(drink)
+    models.LeaderboardEntry.RemoveDrink(drink)
+
+  def _ReplaceDrinkInStats(self, original, drink):
+    """Updates stats and session chunks after `original` was changed to
+    `drink`.  The caller must hold the session assignment lock and the post
+    processing lock."""
+    if original.user_id != drink.user_id:
+      # Which queued drinks open a user's part of the session is looked up
+      # when they are processed.
+      models.PostProcessTask.objects.filter(
+          drink__session=drink.session).update(created_user_chunk=None)
+    queued = models.PostProcessTask.objects.filter(drink=drink)
+    if not queued.exists():
+      # Queued drinks are not yet in any stats; they are added as changed
+      # when processed.
+      self._RemoveDrinkFromStats(original)
+      drink._UpdateSystemStats()
+      drink._UpdateUserStats()
+      drink._UpdateKegStats()
+      drink._UpdateSessionStats()
+      models.LeaderboardEntry.AddDrink(drink)
+    if drink.session:
+      drink.session.Rebuild()
+
   def LogSensorReading(self, sensor_name, temperature, when=None):
     now = timezone.now()
     if not when:
@@ -203,20 +394,12 @@ class KegbotBackend:
       raise ValueError('Temperature out of bounds')
 
     sensor = self._GetSensorFromName(sensor_name)
-    defaults = {
-        'temp': temperature,
-    }
-    record, created = models.Thermolog.objects.get_or_create(sensor=sensor,
-      time=when, defaults=defaults)
-    record.temp = temperature
-    record.save()
-
-    # Delete old entries.
-    keep_time = now - datetime.timedelta(hours=24)
-    old_entries = models.Thermolog.objects.filter(time__lt=keep_time)
-    old_entries.delete()
-
-    return record
+
+    # The reading is also kept in its ThermoDay, which holds the long-term
+    # history.  Old entries are deleted by the kb_compress_temps job.  Both
+    # are normally a single statement (see Thermolog.Record, ThermoDay.Record).
+    models.ThermoDay.Record(sensor, when, temperature)
+    return models.Thermolog.Record(sensor, when, temperature)
 
   def GetAuthToken(self, auth_device, token_value):
     if token_value and auth_device in kb_common.AUTH_MODULE_NAMES_HEX_VALUES:
@@ -0,0 +1,79 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+"""Model field storing a byte string in a binary column.
+
+Django 1.5 has no binary field, so the column type is chosen per database.
+Values are serialized as base64 text.
+"""
+
+import base64
+
+from django.db import models
+
+DB_TYPES = {
+  'mysql': 'longblob',
+  'postgresql': 'bytea',
+}
+
+def to_bytes(value):
+  """Returns a value read from a binary column as a byte string."""
+  # Drivers may return binary columns as buffers.
+  if isinstance(value, buffer):
+    return str(value)
+  return value
+
+def to_binary(value, connection):
+  """Returns a byte string as a parameter for a binary column."""
+  # MySQLdb escapes byte strings as binary; sqlite3 and psycopg2 need buffers.
+  if connection.vendor == 'mysql':
+    return value
+  return buffer(value)
+
+
+class BlobField(models.Field):
+  """Stores a byte string."""
+
+  def db_type(self, connection):
+    return DB_TYPES.get(connection.vendor, 'blob')
+
+  def to_python(self, value):
+    # Serialized values are base64 text.
+    if isinstance(value, unicode):
+      return base64.b64decode(value)
+    return to_bytes(value)
+
+  def get_db_prep_value(self, value, connection, prepared=False):
+    value = to_bytes(value)
+    if value is None:
+      return None
+    return to_binary(value, connection)
+
+  def value_to_string(self, obj):
+    value = self._get_val_from_obj(obj)
+    if value is None:
+      return None
+    return base64.b64encode(to_bytes(value))
+
+try:
+  from south.modelsinspector import add_introspection_rules
+except ImportError:
+  pass
+else:
+  add_introspection_rules([
+    ([BlobField], [], {}),
+    ], ["^pykeg\.core\.blobfield\.BlobField"])
@@ -0,0 +1,103 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Process-local caches of rarely changing rows.
+
+Each cache is tagged with a version which every process can read.
+Invalidating it stores a new version, so every process reloads on its next
+use.  The version is stored in the Django cache when that cache is shared
+between processes.  A process-local cache backend, such as the default
+LocMemCache, cannot carry invalidations to other processes, so the version
+is then the generation of a DatabaseLock row, bumped in the invalidating
+transaction, and each use of a cache reads it with one query.
+"""
+
+import threading
+import uuid
+
+from django.core.cache import cache
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+
+# Caches invalidated inside a transaction which is still open.
+_pending = set()
+_pending_lock = threading.Lock()
+
+def _NewVersion():
+  return uuid.uuid4().hex
+
+def IsProcessLocal():
+  """Returns True if the Django cache is not shared between processes."""
+  return isinstance(cache, (LocMemCache, DummyCache))
+
+class VersionedCache:
+  """A value computed by `load_fn`, cached until invalidated."""
+
+  def __init__(self, name, load_fn):
+    self.name = name
+    self._key = 'pykeg:cache-version:%s' % name
+    self._lock_name = 'cache:%s' % name
+    self._load_fn = load_fn
+    self._entry = None  # (version, value)
+
+  def _Version(self):
+    if IsProcessLocal():
+      from pykeg.core import models
+      rows = models.DatabaseLock.objects.filter(name=self._lock_name)
+      rows = list(rows.values_list('generation', flat=True))
+      # The lock is created at generation 1 by the first invalidation.
+      return rows[0] if rows else 0
+    version = cache.get(self._key)
+    if version is None:
+      cache.add(self._key, _NewVersion())
+      version = cache.get(self._key)
+    return version
+
+  def Get(self):
+    version = self._Version()
+    entry = self._entry
+    if entry is None or entry[0] != version:
+      entry = (version, self._load_fn())
+      self._entry = entry
+    return entry[1]
+
+  def Invalidate(self):
+    self._entry = None
+    if IsProcessLocal():
+      # Seen by other processes once the current transaction commits.
+      from pykeg.core import models
+      models.DatabaseLock.Acquire(self._lock_name)
+      return
+    cache.set(self._key, _NewVersion())
+    if transaction.is_managed():
+      # Another process may reload the old rows before this transaction
+      # commits; see FlushPendingInvalidations.
+      with _pending_lock:
+        _pending.add(self)
+
+
+def FlushPendingInvalidations():
+  """Invalidates again the caches invalidated in transactions which have
+  since committed or rolled back."""
+  with _pending_lock:
+    caches = list(_pending)
+    _pending.clear()
+  for c in caches:
+    c._entry = None
+    cache.set(c._key, _NewVersion())
@@ -0,0 +1,170 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Flow meter calibration from hand-corrected drinks.
+
+A drink's volume is recorded as its ticks times the tap's ml_per_tick, so the
+uncorrected drinks of a keg all share the ratio in effect when they were
+poured.  Drinks whose volume was later corrected by hand carry the measured
+volume instead; ml_per_tick is fitted to those by least squares through the
+origin, repeatedly rejecting outliers by median absolute deviation.
+
+All kegs are fitted at once, with array operations grouped by keg.  Requires
+NumPy (settings.HAVE_NUMPY).
+"""
+
+from django.conf import settings
+
+from pykeg.core import models
+
+if settings.HAVE_NUMPY:
+  import numpy as np
+
+# Drinks with fewer ticks than this are too coarse to calibrate with.
+MIN_TICKS = 100
+
+# A keg needs at least this many corrected drinks to be calibrated.
+MIN_SAMPLES = 5
+
+# Drinks whose relative error is more than this many (robust) standard
+# deviations, or more than MIN_TOLERANCE, are rejected.
+REJECT_SIGMAS = 3.0
+MIN_TOLERANCE = 0.01
+
+MAX_ITERATIONS = 10
+
+# Relative difference from the recorded ratio below which a drink is
+# considered uncorrected.
+RATIO_TOLERANCE = 1e-6
+
+class Calibration:
+  """A fitted ml_per_tick, and the corrected drinks it was fitted to."""
+  def __init__(self, keg_id, ml_per_tick, samples, rejected):
+    self.keg_id = keg_id
+    self.ml_per_tick = ml_per_tick
+    self.samples = samples  # Corrected drinks used in the fit.
+    self.rejected = rejected  # Corrected drinks rejected as outliers.
+
+  def __str__(self):
+    return 'Calibration for keg %s: %s ml/tick' % (self.keg_id,
+        self.ml_per_tick)
+
+
+def _RunStarts(*arrays):
+  """Returns the index of the first element of each run of equal elements in
+  the (sorted) `arrays`."""
+  if not len(arrays[0]):
+    return np.zeros(0, dtype=np.int64)
+  changed = np.zeros(len(arrays[0]) - 1, dtype=bool)
+  for array in arrays:
+    changed |= array[1:] != array[:-1]
+  return np.flatnonzero(np.concatenate(([True], changed)))
+
+def _RecordedRatios(groups, ratios, num_groups):
+  """Returns the most common ml/tick ratio of each group."""
+  keys = np.round(ratios, 9)
+  order = np.lexsort((keys, groups))
+  sorted_groups = groups[order]
+  sorted_keys = keys[order]
+  starts = _RunStarts(sorted_groups, sorted_keys)
+  counts = np.diff(np.append(starts, len(order)))
+  run_groups = sorted_groups[starts]
+  run_keys = sorted_keys[starts]
+  # Orders the runs of each group longest first.
+  best = np.lexsort((-counts, run_groups))
+  first = best[_RunStarts(run_groups[best])]
+  recorded = np.zeros(num_groups)
+  recorded[run_groups[first]] = run_keys[first]
+  return recorded
+
+def _GroupMedians(groups, values, num_groups):
+  """Returns the (lower) median of `values` within each group."""
+  order = np.lexsort((values, groups))
+  starts = _RunStarts(groups[order])
+  counts = np.diff(np.append(starts, len(order)))
+  medians = np.zeros(num_groups)
+  medians[groups[order][starts]] = values[order][starts + (counts - 1) // 2]
+  return medians
+
+def FitGroups(groups, ticks, volumes, num_groups):
+  """Fits ml_per_tick for each group of drinks.
+
+  `groups` gives the group index, from 0 to num_groups - 1, of each drink.
+  Returns arrays of the fitted ml_per_tick (NaN where there were fewer than
+  MIN_SAMPLES corrected drinks), the number of drinks used, and the number
+  rejected, for each group.
+  """
+  groups = np.asarray(groups, dtype=np.int64)
+  ticks = np.asarray(ticks, dtype=np.float64)
+  volumes = np.asarray(volumes, dtype=np.float64)
+
+  usable = (ticks >= MIN_TICKS) & (volumes > 0)
+  groups, ticks, volumes = groups[usable], ticks[usable], volumes[usable]
+  ratios = volumes / ticks
+  recorded = _RecordedRatios(groups, ratios, num_groups)[groups]
+  corrected = np.abs(ratios - recorded) > recorded * RATIO_TOLERANCE
+  groups, ticks, volumes = groups[corrected], ticks[corrected], volumes[corrected]
+
+  used = np.ones(len(groups), dtype=bool)
+  for i in xrange(MAX_ITERATIONS):
+    with np.errstate(invalid='ignore', divide='ignore'):
+      fit = (np.bincount(groups, weights=ticks * volumes * used,
+          minlength=num_groups) /
+          np.bincount(groups, weights=ticks * ticks * used,
+          minlength=num_groups).astype(np.float64))
+      errors = np.abs(volumes / (fit[groups] * ticks) - 1)
+    deviation = 1.4826 * _GroupMedians(groups[used], errors[used], num_groups)
+    tolerance = np.maximum(REJECT_SIGMAS * deviation, MIN_TOLERANCE)
+    keep = errors <= tolerance[groups]
+    if np.array_equal(keep, used):
+      break
+    used = keep
+
+  samples = np.bincount(groups[used], minlength=num_groups)
+  rejected = np.bincount(groups, minlength=num_groups) - samples
+  fit[samples < MIN_SAMPLES] = np.nan
+  return fit, samples, rejected
+
+def CalibrateKegs(keg_ids=None):
+  """Fits ml_per_tick to the corrected drinks of each keg, or of each keg in
+  `keg_ids`.  Returns a dict of Calibrations keyed by keg id, for kegs which
+  have enough corrected drinks."""
+  drinks = models.Drink.objects.valid().exclude(keg=None)
+  if keg_ids is not None:
+    drinks = drinks.filter(keg__in=keg_ids)
+  rows = np.array(list(drinks.values_list('keg_id', 'ticks', 'volume_ml')),
+      dtype=np.float64).reshape(-1, 3)
+  kegs, groups = np.unique(rows[:, 0].astype(np.int64), return_inverse=True)
+  fit, samples, rejected = FitGroups(groups, rows[:, 1], rows[:, 2], len(kegs))
+  ret = {}
+  for i in np.flatnonzero(~np.isnan(fit)):
+    keg_id = int(kegs[i])
+    ret[keg_id] = Calibration(keg_id, float(fit[i]), int(samples[i]),
+        int(rejected[i]))
+  return ret
+
+def CalibrateTaps(taps):
+  """Returns a dict of Calibrations keyed by tap id, fitted to the drinks of
+  each tap's current keg."""
+  taps = [t for t in taps if t.current_keg_id]
+  calibrations = CalibrateKegs([t.current_keg_id for t in taps])
+  ret = {}
+  for tap in taps:
+    if tap.current_keg_id in calibrations:
+      ret[tap.id] = calibrations[tap.current_keg_id]
+  return ret
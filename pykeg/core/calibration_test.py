@@ -0,0 +1,84 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unittests for flow meter calibration."""
+
+import unittest
+
+from django.conf import settings
+from django.test import TestCase
+
+from . import backend
+from . import calibration
+from . import models
+
+@unittest.skipUnless(settings.HAVE_NUMPY, 'requires NumPy')
+class FitGroupsTestCase(unittest.TestCase):
+  def testFit(self):
+    groups, ticks, volumes = [], [], []
+    def add(group, t, v):
+      groups.append(group)
+      ticks.append(t)
+      volumes.append(v)
+
+    for t in xrange(200, 2200, 100):
+      add(0, t, t * 0.5)  # recorded at 0.5 ml/tick
+      add(1, t, t * 0.25)
+    for t, error in zip((300, 500, 800, 1200, 1600, 2000), (1, -2, 3, -1, 2, 0)):
+      add(0, t, t * 0.45 + error)  # corrected
+    add(0, 1000, 900)  # a bad correction
+    add(0, 50, 40)  # too small
+
+    fit, samples, rejected = calibration.FitGroups(groups, ticks, volumes, 3)
+    self.assertAlmostEqual(0.45, fit[0], places=2)
+    self.assertEqual([6, 0, 0], samples.tolist())
+    self.assertEqual([1, 0, 0], rejected.tolist())
+    self.assertTrue(all(map(lambda f: f != f, fit[1:])))  # NaN
+
+
+@unittest.skipUnless(settings.HAVE_NUMPY, 'requires NumPy')
+class CalibrateTapsTestCase(TestCase):
+  def setUp(self):
+    models.KegbotSite.get()  # create the site
+    self.backend = backend.KegbotBackend()
+    self.tap = self.backend.CreateTap('tap1', 'kegboard.flow0',
+        ml_per_tick=0.5)
+    brewer = models.Brewer.objects.create(name='Brewer')
+    style = models.BeerStyle.objects.create(name='Porter')
+    beer_type = models.BeerType.objects.create(name='Beer', brewer=brewer,
+        style=style)
+    size = models.KegSize.objects.create(name='Keg', volume_ml=100000)
+    self.keg = models.Keg.objects.create(type=beer_type, size=size,
+        status='online')
+    self.tap.current_keg = self.keg
+    self.tap.save()
+
+  def testCalibrateTaps(self):
+    # Corrected to measured volumes, which are never exactly proportional.
+    corrections = {1000: 401, 1100: 439, 1200: 481, 1300: 519, 1400: 561,
+        1500: 600}
+    for ticks in xrange(1000, 2000, 100):
+      d = self.backend.RecordDrink('kegboard.flow0', ticks=ticks)
+      if ticks in corrections:
+        self.backend.AdjustDrinkVolume(d.id, corrections[ticks])
+    self.assertEqual({}, calibration.CalibrateTaps([]))
+
+    result = calibration.CalibrateTaps([self.tap])[self.tap.id]
+    self.assertEqual(self.keg.id, result.keg_id)
+    self.assertAlmostEqual(0.4, result.ml_per_tick, places=2)
+    self.assertEqual(6, result.samples)
@@ -0,0 +1,92 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+"""Methods for manipulating a day of temperature readings.
+
+A day (ThermoDay.temps) holds one reading per minute, packed as SLOTS signed
+16-bit little-endian integers of hundredths of a degree Celsius.  Minutes
+without a reading hold MISSING.  Slots are counted from midnight UTC.
+
+A packed day unpacks into an array.array of the slot values.
+"""
+
+import array
+import struct
+import sys
+
+SLOTS = 24 * 60
+MISSING = -32768
+SCALE = 100.0
+
+_PACKED = struct.Struct('<h')
+SLOT_SIZE = _PACKED.size
+
+# Temperatures are kept within the range of a slot, less the sentinel.
+_MIN_VALUE = MISSING + 1
+_MAX_VALUE = 32767
+
+def empty():
+  """Returns a packed day with no readings."""
+  return _PACKED.pack(MISSING) * SLOTS
+
+def slot(when):
+  """Returns the slot of the datetime `when`, which should be in UTC."""
+  return when.hour * 60 + when.minute
+
+def pack_temp(temp):
+  """Converts a temperature in degrees Celsius to a slot value."""
+  return max(_MIN_VALUE, min(_MAX_VALUE, int(round(temp * SCALE))))
+
+def unpack_temp(value):
+  """Converts a slot value to degrees Celsius, or None if missing."""
+  if value == MISSING:
+    return None
+  return value / SCALE
+
+def offset(index):
+  """Returns the offset in bytes of the slot at `index`."""
+  if not 0 <= index < SLOTS:
+    raise ValueError('Slot out of range: %s' % index)
+  return index * SLOT_SIZE
+
+def pack_slot(temp):
+  """Returns the packed slot holding `temp`."""
+  return _PACKED.pack(pack_temp(temp))
+
+def set_slot(packed, index, temp):
+  """Returns `packed` with the slot at `index` set to `temp`.
+
+  A `packed` of None or '' is treated as an empty day.
+  """
+  start = offset(index)
+  if not packed:
+    packed = empty()
+  return packed[:start] + pack_slot(temp) + packed[start + SLOT_SIZE:]
+
+def to_array(packed):
+  """Unpacks a day into an array.array('h') of slot values."""
+  values = array.array('h')
+  values.fromstring(packed or empty())
+  if sys.byteorder != 'little':
+    values.byteswap()
+  return values
+
+def iter_temps(packed):
+  """Yields the (slot, temperature) pairs of the readings of a day."""
+  for index, value in enumerate(to_array(packed)):
+    if value != MISSING:
+      yield index, value / SCALE
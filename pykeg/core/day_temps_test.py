@@ -0,0 +1,44 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+"""Unittests for packed days of temperature readings."""
+
+import datetime
+import unittest
+
+from . import day_temps
+
+class DayTempsTestCase(unittest.TestCase):
+  def testPacking(self):
+    packed = day_temps.set_slot(None, 0, 4.5)
+    packed = day_temps.set_slot(packed, day_temps.SLOTS - 1, -2.344)
+    packed = day_temps.set_slot(packed, 61, 4000.0)
+    self.assertEqual(day_temps.SLOTS * 2, len(packed))
+    self.assertEqual('\xc2\x01', packed[:2])
+
+    values = day_temps.to_array(packed)
+    self.assertEqual(day_temps.SLOTS, len(values))
+    self.assertEqual([450, day_temps.MISSING], list(values[:2]))
+    self.assertEqual(-234, values[-1])
+    self.assertEqual(32767, values[61])
+
+    self.assertEqual([(0, 4.5), (61, 327.67), (day_temps.SLOTS - 1, -2.34)],
+        list(day_temps.iter_temps(packed)))
+    self.assertEqual([], list(day_temps.iter_temps(day_temps.empty())))
+    self.assertEqual(61, day_temps.slot(datetime.datetime(2013, 1, 1, 1, 1)))
+    self.assertRaises(ValueError, day_temps.set_slot, packed,
+        day_temps.SLOTS, 1.0)
@@ -0,0 +1,258 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Flow rate analysis of drink time series.
+
+Many series are decoded at once into contiguous arrays, and every metric is
+computed over all of them with array operations, rather than looping over
+drinks.  The amount of each sample is the number of ticks since the previous
+sample; ticks are converted to volume with each drink's own volume per tick.
+
+Per-drink results are cached in DrinkFlow records.  Computing new results
+requires NumPy (settings.HAVE_NUMPY); cached results are always available.
+"""
+
+from django.conf import settings
+from django.db import transaction
+from django.db.utils import IntegrityError
+
+from pykeg.core import models
+from pykeg.core import time_series
+
+if settings.HAVE_NUMPY:
+  import numpy as np
+
+# A meter is considered stuck when a pour goes this long between samples.
+STUCK_GAP_MS = 3000
+
+# A meter is considered bursty when the peak rate of a pour is this many times
+# its average rate.
+BURST_RATIO = 4.0
+
+# Pours with fewer samples than this are never considered bursty.
+MIN_BURST_SAMPLES = 4
+
+# Width and number of the time bins of a flow profile.
+PROFILE_BIN_MS = 500
+PROFILE_BINS = 30
+
+FLOW_FIELDS = ('samples', 'duration_ms', 'average_rate', 'peak_rate',
+    'max_gap_ms', 'anomaly')
+
+def _encoded_body(value):
+  """Returns the varints of a stored series, or '' if it is empty or
+  malformed."""
+  if isinstance(value, buffer):
+    value = str(value)
+  if not value:
+    return ''
+  if not time_series.is_encoded(value):
+    try:
+      value = time_series.encode(time_series.iter_string(value))
+    except ValueError:
+      return ''
+  if ord(value[-1]) & 0x80:
+    # Truncated.
+    return ''
+  return value[1:]
+
+
+class SeriesBatch:
+  """Many time series decoded into contiguous arrays.
+
+  The samples of series `i` are times[offsets[i]:offsets[i+1]] and
+  amounts[offsets[i]:offsets[i+1]]; series[j] is the series of sample `j`.
+  """
+
+  def __init__(self, values):
+    """Decodes `values`, a sequence of stored series in either form."""
+    bodies = [_encoded_body(v) for v in values]
+    counts = self._VarintCounts(bodies)
+    odd = np.flatnonzero(counts % 2)
+    if len(odd):
+      # Malformed; a pair is missing its amount.
+      for i in odd:
+        bodies[i] = ''
+      counts[odd] = 0
+    varints = self._DecodeVarints(''.join(bodies))
+
+    self.num_series = len(bodies)
+    self.counts = counts // 2
+    self.offsets = np.zeros(self.num_series + 1, dtype=np.int64)
+    np.cumsum(self.counts, out=self.offsets[1:])
+    self.series = np.repeat(np.arange(self.num_series), self.counts)
+
+    # Times are deltas from the previous time of the same series.
+    deltas = varints[0::2]
+    self.amounts = varints[1::2]
+    totals = np.cumsum(deltas)
+    starts = np.zeros(self.num_series, dtype=np.int64)
+    nonempty = self.counts > 0
+    first = self.offsets[:-1][nonempty]
+    starts[nonempty] = totals[first] - deltas[first]
+    self.times = totals - starts[self.series]
+
+  def _VarintCounts(self, bodies):
+    lengths = np.array([len(b) for b in bodies], dtype=np.int64)
+    data = np.frombuffer(''.join(bodies), dtype=np.uint8)
+    byte_series = np.repeat(np.arange(len(bodies)), lengths)
+    return np.bincount(byte_series[data < 0x80], minlength=len(bodies))
+
+  def _DecodeVarints(self, data):
+    """Returns the zigzag varints of `data` as an array of int64."""
+    data = np.frombuffer(data, dtype=np.uint8)
+    if not len(data):
+      return np.zeros(0, dtype=np.int64)
+    ends = data < 0x80
+    starts = np.flatnonzero(np.concatenate(([True], ends[:-1])))
+    varint = np.cumsum(ends) - ends
+    shift = (np.arange(len(data)) - starts[varint]) * 7
+    parts = (data & 0x7f).astype(np.uint64) << shift.astype(np.uint64)
+    values = np.add.reduceat(parts, starts)
+    return (values >> np.uint64(1)).astype(np.int64) ^ \
+        -(values & np.uint64(1)).astype(np.int64)
+
+  def Volumes(self, ml_per_tick):
+    """Returns the volume of each sample, given the ml per tick of each
+    series."""
+    return self.amounts * np.asarray(ml_per_tick, dtype=np.float64)[self.series]
+
+  def Analyze(self, ml_per_tick):
+    """Returns a dict of per-series arrays, keyed by FLOW_FIELDS."""
+    n = self.num_series
+    volumes = self.Volumes(ml_per_tick)
+    nonempty = self.counts > 0
+
+    duration = np.zeros(n, dtype=np.int64)
+    duration[nonempty] = (self.times[self.offsets[1:][nonempty] - 1] -
+        self.times[self.offsets[:-1][nonempty]])
+    # Times out of order are not counted against the pour.
+    np.maximum(duration, 0, out=duration)
+
+    # Intervals between consecutive samples of the same series.
+    same = self.series[1:] == self.series[:-1]
+    interval_series = self.series[1:][same]
+    interval_ms = np.diff(self.times)[same]
+    interval_ml = volumes[1:][same]
+
+    max_gap = np.zeros(n, dtype=np.int64)
+    np.maximum.at(max_gap, interval_series, interval_ms)
+
+    timed = interval_ms > 0
+    peak = np.zeros(n)
+    np.maximum.at(peak, interval_series[timed],
+        interval_ml[timed] * 1000.0 / interval_ms[timed])
+
+    average = np.zeros(n)
+    flowing = duration > 0
+    average[flowing] = (np.bincount(interval_series, weights=interval_ml,
+        minlength=n)[flowing] * 1000.0 / duration[flowing])
+
+    anomaly = np.array([''] * n, dtype=object)
+    bursty = ((self.counts >= MIN_BURST_SAMPLES) & (average > 0) &
+        (peak > average * BURST_RATIO))
+    anomaly[bursty] = 'bursty'
+    anomaly[max_gap >= STUCK_GAP_MS] = 'stuck'
+
+    return {
+      'samples': self.counts,
+      'duration_ms': duration,
+      'average_rate': average,
+      'peak_rate': peak,
+      'max_gap_ms': max_gap,
+      'anomaly': anomaly,
+    }
+
+  def Profile(self, ml_per_tick, bin_ms=PROFILE_BIN_MS, bins=PROFILE_BINS):
+    """Returns the average flow rate, in ml/sec, of the series over time since
+    their first sample, in `bins` bins of `bin_ms` each."""
+    volumes = self.Volumes(ml_per_tick)
+    nonempty = self.counts > 0
+    pours = np.count_nonzero(nonempty)
+    if not pours:
+      return [0.0] * bins
+    starts = np.zeros(self.num_series, dtype=np.int64)
+    starts[nonempty] = self.times[self.offsets[:-1][nonempty]]
+    elapsed = self.times - starts[self.series]
+    index = elapsed // bin_ms
+    keep = (index >= 0) & (index < bins)
+    totals = np.bincount(index[keep], weights=volumes[keep], minlength=bins)
+    return list(totals * 1000.0 / bin_ms / pours)
+
+
+def _MlPerTick(ticks, volume_ml):
+  if not ticks:
+    return 0.0
+  return float(volume_ml) / ticks
+
+def UpdateDrinkFlows(drink_ids):
+  """Computes and saves the DrinkFlow of each drink in `drink_ids`, replacing
+  any cached ones.  Returns a dict of DrinkFlows keyed by drink id."""
+  rows = list(models.Drink.objects.filter(id__in=drink_ids).values_list(
+      'id', 'ticks', 'volume_ml', 'tick_time_series'))
+  if not rows:
+    return {}
+  batch = SeriesBatch([row[3] for row in rows])
+  results = batch.Analyze([_MlPerTick(row[1], row[2]) for row in rows])
+
+  flows = {}
+  for i, row in enumerate(rows):
+    flow = models.DrinkFlow(drink_id=row[0])
+    for field in FLOW_FIELDS:
+      value = results[field][i]
+      setattr(flow, field, value.item() if hasattr(value, 'item') else value)
+    flows[row[0]] = flow
+
+  try:
+    with transaction.commit_on_success():
+      models.DrinkFlow.objects.filter(drink__in=flows.keys()).delete()
+      models.DrinkFlow.objects.bulk_create(flows.values())
+  except IntegrityError:
+    # Computed concurrently; the other results are equivalent.
+    pass
+  return flows
+
+def GetDrinkFlows(drink_ids):
+  """Returns a dict of DrinkFlows keyed by drink id.
+
+  Cached results are used where present.  The rest are computed in one batch
+  if NumPy is available, and are otherwise missing from the result.
+  """
+  drink_ids = list(drink_ids)
+  flows = models.DrinkFlow.objects.in_bulk(drink_ids)
+  missing = [i for i in drink_ids if i not in flows]
+  if missing and settings.HAVE_NUMPY:
+    flows.update(UpdateDrinkFlows(missing))
+  return flows
+
+def GetKegProfile(keg, bin_ms=PROFILE_BIN_MS, bins=PROFILE_BINS):
+  """Returns the flow profile of the valid drinks from `keg`, and a count of
+  each kind of anomaly among them, as a dict.  Requires NumPy."""
+  rows = list(keg.drinks.valid().values_list('ticks', 'volume_ml',
+      'tick_time_series'))
+  batch = SeriesBatch([row[2] for row in rows])
+  ml_per_tick = [_MlPerTick(row[0], row[1]) for row in rows]
+  anomaly = batch.Analyze(ml_per_tick)['anomaly']
+  return {
+    'keg_id': keg.id,
+    'pours': len(rows),
+    'bin_ms': bin_ms,
+    'rates': batch.Profile(ml_per_tick, bin_ms, bins),
+    'stuck': int(np.count_nonzero(anomaly == 'stuck')),
+    'bursty': int(np.count_nonzero(anomaly == 'bursty')),
+  }
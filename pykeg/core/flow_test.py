@@ -0,0 +1,114 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unittests for flow rate analysis."""
+
+import unittest
+
+from django.conf import settings
+from django.test import TestCase
+
+from . import backend
+from . import flow
+from . import models
+from . import time_series
+
+@unittest.skipUnless(settings.HAVE_NUMPY, 'requires NumPy')
+class SeriesBatchTestCase(unittest.TestCase):
+  def testDecode(self):
+    series = [
+      [(0, 10), (100, 20), (250, 30)],
+      [],
+      [(5, -1), (2**40, 2)],
+    ]
+    values = [time_series.encode(s) for s in series]
+    values += ['0:4 50:6', None, 'junk', values[0][:-1]]
+    batch = flow.SeriesBatch(values)
+
+    expected = series + [[(0, 4), (50, 6)], [], [], []]
+    self.assertEqual(len(expected), batch.num_series)
+    for i, pairs in enumerate(expected):
+      start, end = batch.offsets[i], batch.offsets[i + 1]
+      self.assertEqual(pairs, zip(batch.times[start:end].tolist(),
+          batch.amounts[start:end].tolist()))
+
+  def testAnalyze(self):
+    values = [
+      # Steady: 10 ml every 100 ms.
+      time_series.encode((t, 10) for t in xrange(0, 1000, 100)),
+      # A 5 second gap.
+      time_series.encode([(0, 10), (100, 10), (5100, 10)]),
+      # A burst of 100 ml in 50 ms.
+      time_series.encode([(0, 10), (1000, 10), (2000, 10), (2050, 100),
+          (3000, 10)]),
+      '',
+    ]
+    results = flow.SeriesBatch(values).Analyze([1.0, 1.0, 1.0, 1.0])
+
+    self.assertEqual([10, 3, 5, 0], results['samples'].tolist())
+    self.assertEqual([900, 5100, 3000, 0], results['duration_ms'].tolist())
+    self.assertEqual([100, 5000, 1000, 0], results['max_gap_ms'].tolist())
+    self.assertAlmostEqual(100.0, results['average_rate'][0])
+    self.assertAlmostEqual(100.0, results['peak_rate'][0])
+    self.assertAlmostEqual(2000.0, results['peak_rate'][2])
+    self.assertEqual(['', 'stuck', 'bursty', ''], list(results['anomaly']))
+
+  def testProfile(self):
+    values = [
+      time_series.encode([(1000, 10), (1500, 10), (2000, 10)]),
+      time_series.encode([(0, 20)]),
+    ]
+    rates = flow.SeriesBatch(values).Profile([1.0, 0.5], bin_ms=500, bins=4)
+    self.assertEqual([20.0, 10.0, 10.0, 0.0], rates)
+
+
+@unittest.skipUnless(settings.HAVE_NUMPY, 'requires NumPy')
+class DrinkFlowTestCase(TestCase):
+  def setUp(self):
+    models.KegbotSite.get()  # create the site
+    self.backend = backend.KegbotBackend()
+    self.tap = self.backend.CreateTap('tap1', 'kegboard.flow0',
+        ml_per_tick=0.5)
+    brewer = models.Brewer.objects.create(name='Brewer')
+    style = models.BeerStyle.objects.create(name='Porter')
+    beer_type = models.BeerType.objects.create(name='Beer', brewer=brewer,
+        style=style)
+    size = models.KegSize.objects.create(name='Keg', volume_ml=10000)
+    self.keg = models.Keg.objects.create(type=beer_type, size=size,
+        status='online')
+    self.tap.current_keg = self.keg
+    self.tap.save()
+
+  def testCache(self):
+    d = self.backend.RecordDrink('kegboard.flow0', ticks=400,
+        tick_time_series='0:100 1000:100 2000:200')
+    flows = flow.GetDrinkFlows([d.id])
+    self.assertEqual(3, flows[d.id].samples)
+    self.assertAlmostEqual(75.0, flows[d.id].average_rate)
+    self.assertAlmostEqual(100.0, flows[d.id].peak_rate)
+
+    with self.assertNumQueries(1):
+      flow.GetDrinkFlows([d.id])
+
+    # Rates follow the corrected volume.
+    self.backend.AdjustDrinkVolume(d.id, 400)
+    self.assertAlmostEqual(150.0, flow.GetDrinkFlows([d.id])[d.id].average_rate)
+
+    profile = flow.GetKegProfile(self.keg, bin_ms=1000, bins=3)
+    self.assertEqual(1, profile['pours'])
+    self.assertEqual([100.0, 100.0, 200.0], profile['rates'])
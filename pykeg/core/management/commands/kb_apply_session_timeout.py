@@ -0,0 +1,38 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.core.management.base import NoArgsCommand
+
+from pykeg.core import models
+from pykeg.core import sessions
+from pykeg.core.management.commands.common import progbar
+
+class Command(NoArgsCommand):
+  help = u'Recompute sessions after changes to the session timeout.'
+  args = '<none>'
+
+  def handle(self, **options):
+    changes = models.SessionTimeoutChange.objects.filter(finished_time=None)
+    for change in changes.order_by('id'):
+      title = 'timeout %s -> %s min' % (change.old_timeout_minutes,
+          change.new_timeout_minutes)
+      progbar(title, 0, 0)
+      sessions.ApplyTimeoutChange(change,
+          progress=lambda pos, total: progbar(title, pos, total))
+      print ''
+    print 'done!'
@@ -0,0 +1,59 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.conf import settings
+from django.core.management.base import CommandError
+from django.core.management.base import NoArgsCommand
+
+from pykeg.core import calibration
+from pykeg.core import models
+
+from optparse import make_option
+
+class Command(NoArgsCommand):
+  option_list = NoArgsCommand.option_list + (
+      make_option('--apply',
+        action='store_true',
+        dest='apply',
+        default=False,
+        help='Save the suggested ml_per_tick of each tap.'),
+      )
+
+  help = u'Suggest tap calibrations from drinks with corrected volumes.'
+  args = '<none>'
+
+  def handle(self, **options):
+    if not settings.HAVE_NUMPY:
+      raise CommandError('Calibration requires NumPy.')
+
+    taps = list(models.KegTap.objects.order_by('id'))
+    calibrations = calibration.CalibrateTaps(taps)
+    for tap in taps:
+      result = calibrations.get(tap.id)
+      if not result:
+        print '%s: not enough corrected drinks' % tap.meter_name
+        continue
+      print '%s: %.6f -> %.6f ml/tick (%i drinks, %i rejected)' % (
+          tap.meter_name, tap.ml_per_tick, result.ml_per_tick, result.samples,
+          result.rejected)
+      if options['apply']:
+        tap.ml_per_tick = result.ml_per_tick
+        tap.save()
+
+    if options['apply']:
+      print 'done!'
@@ -19,34 +19,16 @@
 from django.core.management.base import BaseCommand
 from django.core.management.base import CommandError
 
-import datetime
-
-from django.utils import timezone
 from pykeg.core import models
 
 
 class Command(BaseCommand):
-  help = u'Deletes any old temperature sensor records'
+  help = (u'Deletes temperature sensor records older than '
+      'KEGBOT_THERMOLOG_KEEP_HOURS')
   args = '<none>'
 
   def handle(self, *args, **options):
     if len(args) != 0:
       raise CommandError('No arguments required')
 
-    now = timezone.now()
-
-    # keep at least the most recent 24 hours
-    keep_time = now - datetime.timedelta(hours=24)
-
-    # round down to the start of the day
-    keep_date = datetime.datetime(year=keep_time.year, month=keep_time.month,
-        day=keep_time.day)
-
-    print "Deleting entries older than %s" % keep_date
-
-    for sensor in models.ThermoSensor.objects.all():
-      old_entries = sensor.thermolog_set.filter(time__lt=keep_date).order_by('time')
-      print "Sensor: %s" % sensor
-      print "Deleting %s entries ..." % (old_entries.count())
-      old_entries.delete()
-      print ""
+    print "Deleted %s entries" % models.Thermolog.PruneExpired()
@@ -0,0 +1,64 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+
+from django.core.management.base import NoArgsCommand
+from django.db import connection
+
+from pykeg.core import backend
+
+from optparse import make_option
+
+class Command(NoArgsCommand):
+  option_list = NoArgsCommand.option_list + (
+      make_option('-b', '--batch-size',
+        type='int',
+        action='store',
+        dest='batch_size',
+        default=100,
+        help='Maximum number of drinks to post process per transaction.'),
+      make_option('-i', '--interval',
+        type='float',
+        action='store',
+        dest='interval',
+        default=1.0,
+        help='Seconds to wait before checking an empty queue again.'),
+      make_option('--once',
+        action='store_true',
+        dest='once',
+        default=False,
+        help='Exit once the queue is empty.'),
+      )
+
+  help = u'Post process drinks queued by KEGBOT_ASYNC_POSTPROCESS.'
+  args = '<none>'
+
+  def handle(self, **options):
+    b = backend.KegbotBackend()
+    batch_size = options['batch_size']
+    while True:
+      count = b.ProcessPendingDrinks(batch_size=batch_size)
+      if count:
+        print 'Processed %i drink(s).' % count
+      if count < batch_size:
+        if options['once']:
+          break
+        # Don't hold a connection open while idle.
+        connection.close()
+        time.sleep(options['interval'])
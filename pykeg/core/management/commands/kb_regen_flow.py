@@ -0,0 +1,59 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.conf import settings
+from django.core.management.base import CommandError
+from django.core.management.base import NoArgsCommand
+
+from pykeg.core import flow
+from pykeg.core import models
+from pykeg.core.management.commands.common import progbar
+
+from optparse import make_option
+
+class Command(NoArgsCommand):
+  option_list = NoArgsCommand.option_list + (
+      make_option('-b', '--batch-size',
+        type='int',
+        action='store',
+        dest='batch_size',
+        default=5000,
+        help='Number of drinks to analyze at once.'),
+      )
+
+  help = u'Regenerate the flow rate analysis of all drinks.'
+  args = '<none>'
+
+  def handle(self, **options):
+    if not settings.HAVE_NUMPY:
+      raise CommandError('Flow analysis requires NumPy.')
+    batch_size = options['batch_size']
+    if batch_size < 1:
+      raise CommandError('--batch-size must be at least 1')
+
+    drink_ids = list(models.Drink.objects.order_by('id').values_list('id',
+        flat=True))
+    count = len(drink_ids)
+    progbar('analyze drinks', 0, count)
+    for pos in xrange(0, count, batch_size):
+      batch = drink_ids[pos:pos + batch_size]
+      flow.UpdateDrinkFlows(batch)
+      progbar('analyze drinks', pos + len(batch), count)
+    print ''
+
+    print 'done!'
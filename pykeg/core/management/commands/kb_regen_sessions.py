@@ -16,68 +16,54 @@
 # You should have received a copy of the GNU General Public License
 # along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
 
-from django.db import connection
-from django.core.management.base import CommandError
 from django.core.management.base import NoArgsCommand
 
+from pykeg.core import backend
 from pykeg.core import models
+from pykeg.core import sessions
 from pykeg.core.management.commands.common import progbar
 
 class Command(NoArgsCommand):
-  help = u'Regenerate all cached stats.'
+  help = u'Regenerate all drinking sessions.'
   args = '<none>'
 
   def handle(self, **options):
-    drinks = models.Drink.objects.valid()
+    # Queued drinks keep flags from their current session assignment.
+    b = backend.KegbotBackend()
+    while b.ProcessPendingDrinks():
+      pass
 
-    pos = 0
-    count = drinks.count()
-    for d in drinks:
-      pos += 1
-      progbar('clear drink sessions', pos, count)
-      d.session = None
-      d.save()
-    print ''
+    print 'deleting old sessions..',
+    sessions.DeleteAllSessions()
+    print 'done'
 
-    pics = models.PourPicture.objects.all()
-    count = pics.count()
+    drinks = models.Drink.objects.valid().order_by('time', 'id')
+    count = drinks.count()
+    session_delta = models.SiteSettings.get().GetSessionTimeoutDelta()
+    regen = sessions.SessionRegenerator(session_delta)
     pos = 0
-    for p in pics:
+    progbar('calc new sessions', pos, count)
+    for row in drinks.values_list(*sessions.SessionRegenerator.FIELDS).iterator():
       pos += 1
-      progbar('clear image sessions', pos, count)
-      p.session = None
-      p.save()
+      progbar('calc new sessions', pos, count)
+      regen.AddDrink(*row)
     print ''
 
-    print 'deleting old sessions..',
-    try:
-      with connection.constraint_checks_disabled():
-        cursor = connection.cursor()
-        for table in ('core_drinkingsession', 'core_kegsessionchunk',
-          'core_usersessionchunk', 'core_sessionchunk'):
-          cursor.execute('TRUNCATE TABLE `%s`' % table)
-        print 'truncate successful'
-    except Exception, e:
-      models.DrinkingSession.objects.all().delete()
-      print 'orm delete successful'
+    total = len(regen.sessions)
+    progbar('write new sessions', 0, total)
+    regen.Write(progress=lambda pos: progbar('write new sessions', pos, total))
+    print ''
 
-    pos = 0
-    count = drinks.count()
-    for d in drinks.order_by('time'):
-      pos += 1
-      progbar('calc new sessions', pos, count)
-      sess = models.DrinkingSession.AssignSessionForDrink(d)
+    total = len(regen.sessions)
+    progbar('write session stats', 0, total)
+    sessions.RebuildSessionStats(
+        progress=lambda pos: progbar('write session stats', pos, total))
     print ''
 
-    pics = models.PourPicture.objects.all()
-    count = pics.count()
-    pos = 0
-    for p in pics:
-      pos += 1
-      progbar('set image sessions', pos, count)
-      if p.drink:
-        p.session = p.drink.session
-        p.save()
+    # Session leaderboards are keyed by session id.
+    progbar('rebuild leaderboards', 0, 1)
+    models.LeaderboardEntry.Rebuild()
+    progbar('rebuild leaderboards', 1, 1)
     print ''
 
     print 'done!'
@@ -16,65 +16,171 @@
 # You should have received a copy of the GNU General Public License
 # along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
 
+import multiprocessing
+
 from django.core.management.base import CommandError
 from django.core.management.base import NoArgsCommand
+from django.db import connection
+from django.db import transaction
 
+from pykeg.core import backend
 from pykeg.core import models
+from pykeg.core import stats
 from pykeg.core.management.commands.common import progbar
 
+from optparse import make_option
+
+# Maximum number of stats rows to insert per query.
+BATCH_SIZE = 100
+
+# Number of keg, user or session scopes handled by one worker task.
+SCOPES_PER_TASK = 200
+
+# Stats model and key field for each StatsRegenerator scope.
+SCOPE_MODELS = {
+  'system': (models.SystemStats, None),
+  'kegs': (models.KegStats, 'keg_id'),
+  'users': (models.UserStats, 'user_id'),
+  'sessions': (models.SessionStats, 'session_id'),
+}
 
 class Command(NoArgsCommand):
+  option_list = NoArgsCommand.option_list + (
+      make_option('-w', '--workers',
+        type='int',
+        action='store',
+        dest='workers',
+        default=1,
+        help='Number of worker processes to build stats with.'),
+      )
+
   help = u'Regenerate all cached stats.'
   args = '<none>'
 
   def handle(self, **options):
-    models.SystemStats.objects.all().delete()
-    models.KegStats.objects.all().delete()
-    models.UserStats.objects.all().delete()
-    models.SessionStats.objects.all().delete()
+    workers = options['workers']
+    if workers < 1:
+      raise CommandError('--workers must be at least 1')
 
-    drinks = models.Drink.objects.valid()
+    # Queued drinks would otherwise be counted again when processed.
+    b = backend.KegbotBackend()
+    while b.ProcessPendingDrinks():
+      pass
 
-    last_drinks = drinks.order_by('-time')
-    if last_drinks:
-      progbar('recalc system stats', 0, 1)
-      last_drinks[0]._UpdateSystemStats()
-    progbar('recalc system stats', 1, 1)
-    print ''
+    with transaction.commit_on_success():
+      models.SystemStats.objects.all().delete()
+      models.KegStats.objects.all().delete()
+      models.UserStats.objects.all().delete()
+      models.SessionStats.objects.all().delete()
 
-    kegs = models.Keg.objects.all()
-    count = kegs.count()
-    pos = 0
-    for k in kegs:
-      pos += 1
-      progbar('recalc keg stats', pos, count)
-      last_drinks = k.drinks.valid().order_by('-time')
-      if last_drinks:
-        last_drinks[0]._UpdateKegStats()
-    print ''
+      progbar('rebuild leaderboards', 0, 1)
+      models.LeaderboardEntry.Rebuild()
+      progbar('rebuild leaderboards', 1, 1)
+      print ''
+
+      if workers == 1:
+        self._regen_all()
+
+    if workers > 1:
+      self._regen_parallel(workers)
+
+    print 'done!'
+
+  def _regen_all(self):
+    drinks = models.Drink.objects.valid().order_by('id')
+    count = drinks.count()
 
-    users = models.User.objects.all()
-    count = users.count()
+    # Stream every valid drink once, feeding all scopes at the same time.
+    regen = stats.StatsRegenerator()
     pos = 0
-    for user in users:
+    progbar('scan drinks', pos, count)
+    for row in drinks.values_list(*stats.StatsRegenerator.FIELDS).iterator():
       pos += 1
-      progbar('recalc user stats', pos, count)
-      user_drinks = user.drinks.valid().order_by('-time')
-      if user_drinks:
-        last = user_drinks[0]
-        last._UpdateUserStats()
+      progbar('scan drinks', pos, count)
+      regen.AddDrink(*row)
     print ''
 
-    sessions = models.DrinkingSession.objects.all()
-    count = sessions.count()
-    pos = 0
-    for session in sessions:
-      pos += 1
-      progbar('recalc session stats', pos, count)
-      session_drinks = session.drinks.valid().order_by('-time')
-      if session_drinks:
-        last = session_drinks[0]
-        last._UpdateSessionStats()
+    if count:
+      progbar('write system stats', 0, 1)
+      _write_scope(regen, 'system')
+      progbar('write system stats', 1, 1)
+      print ''
+
+    for scope in ('kegs', 'users', 'sessions'):
+      title = 'write %s stats' % scope[:-1]
+      total = len(getattr(regen, scope))
+      progbar(title, 0, total)
+      _write_scope(regen, scope,
+          progress=lambda pos: progbar(title, pos, total))
+      print ''
+
+  def _regen_parallel(self, workers):
+    """Partitions scopes into tasks, and builds and writes each task's stats
+    in a pool of worker processes."""
+    drinks = models.Drink.objects.valid()
+    tasks = []
+    if drinks.exists():
+      tasks.append(('system', None))
+    for scope, field in (('kegs', 'keg'), ('users', 'user'),
+        ('sessions', 'session')):
+      ids = drinks.exclude(**{field: None}).order_by(field).values_list(
+          field, flat=True).distinct()
+      ids = list(ids)
+      for i in xrange(0, len(ids), SCOPES_PER_TASK):
+        tasks.append((scope, ids[i:i+SCOPES_PER_TASK]))
+
+    # Each worker must open its own database connection.
+    connection.close()
+    pool = multiprocessing.Pool(workers)
+    try:
+      # Progress counts stats records written, across all workers.
+      total = sum(len(ids or (None,)) for scope, ids in tasks)
+      pos = 0
+      progbar('build stats', pos, total)
+      for written in pool.imap_unordered(_regen_task, tasks):
+        pos += written
+        progbar('build stats', pos, total)
+    finally:
+      pool.terminate()
     print ''
 
-    print 'done!'
+
+def _regen_task(task):
+  """Builds and writes the stats of one task's scopes.  Runs in a worker."""
+  scope, ids = task
+  drinks = models.Drink.objects.valid().order_by('id')
+  if ids is not None:
+    model, key_field = SCOPE_MODELS[scope]
+    drinks = drinks.filter(**{'%s__in' % key_field: ids})
+
+  regen = stats.StatsRegenerator(scopes=(scope,))
+  for row in drinks.values_list(*stats.StatsRegenerator.FIELDS).iterator():
+    regen.AddDrink(*row)
+  with transaction.commit_on_success():
+    written = _write_scope(regen, scope)
+  connection.close()
+  return written
+
+def _write_scope(regen, scope, progress=None):
+  """Writes the stats accumulated by `regen` for `scope`, returning the
+  number of records written."""
+  model, key_field = SCOPE_MODELS[scope]
+  if scope == 'system':
+    model.objects.create(stats_proto=regen.system.Build())
+    return 1
+
+  accumulators = getattr(regen, scope)
+  count = len(accumulators)
+  pos = 0
+  batch = []
+  for key, acc in accumulators.iteritems():
+    record = model(stats_proto=acc.Build())
+    setattr(record, key_field, key)
+    batch.append(record)
+    pos += 1
+    if len(batch) >= BATCH_SIZE or pos == count:
+      model.objects.bulk_create(batch)
+      batch = []
+      if progress:
+        progress(pos)
+  return count
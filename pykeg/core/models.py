@@ -17,27 +17,39 @@
 # You should have received a copy of the GNU General Public License
 # along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
 
+import copy
 import datetime
 import os
 import random
 
 from django.conf import settings
 from django.core.urlresolvers import reverse
+from django.db import connection
 from django.db import models
+from django.db import transaction
+from django.db.models import F
+from django.db.models import Max
+from django.db.models.signals import post_delete
 from django.db.models.signals import post_save
 from django.db.models.signals import pre_save
+from django.db.utils import IntegrityError
 from django.contrib.sites.models import Site
 from django.contrib.auth.models import User
 from django.utils import timezone
 
 from pykeg import EPOCH
 
+from pykeg.core import blobfield
+from pykeg.core import cache
+from pykeg.core import day_temps
 from pykeg.core import kb_common
 from pykeg.core import fields
 from pykeg.core import imagespecs
-from pykeg.core import jsonfield
 from pykeg.core import managers
+from pykeg.core import protofield
+from pykeg.core import registry
 from pykeg.core import stats
+from pykeg.core import timeseriesfield
 from pykeg.core.util import make_serial
 
 from kegbot.util import units
@@ -67,10 +79,26 @@ class KegbotSite(models.Model):
     return self.name
 
   @classmethod
-  def get(cls):
-    """Gets the default site settings."""
-    return KegbotSite.objects.get_or_create(name='default',
-        defaults={'is_setup': False})[0]
+  def get(cls, create=True):
+    """Gets the default site, with its settings, from the site cache.
+
+    The site is created if it does not exist, unless `create` is False, in
+    which case None is returned.  Each call returns new copies of the cached
+    rows, which callers may change.  Changes saved by any process are seen on
+    the next call; see pykeg.core.cache.
+    """
+    cached = _SITE_CACHE.Get()
+    if cached is None or cached[1] is None:
+      if not create:
+        return None
+      site = KegbotSite.objects.get_or_create(name='default',
+          defaults={'is_setup': False})[0]
+      return site
+    site = copy.copy(cached[0])
+    site_settings = copy.copy(cached[1])
+    site._settings_cache = site_settings
+    site_settings._site_cache = site
+    return site
 
   def full_url(self):
     return 'http://%s' % Site.objects.get_current().domain
@@ -97,6 +125,21 @@ def _kegbotsite_post_save(sender, instance, **kwargs):
   settings, _ = SiteSettings.objects.get_or_create(site=instance)
 post_save.connect(_kegbotsite_post_save, sender=KegbotSite)
 
+def _load_site():
+  """Returns the default (site, settings), or None if there is no site."""
+  sites = list(KegbotSite.objects.filter(name='default'))
+  if not sites:
+    return None
+  site_settings = SiteSettings.objects.filter(site=sites[0]).select_related(
+      'guest_image', 'background_image')
+  site_settings = list(site_settings)
+  return sites[0], (site_settings[0] if site_settings else None)
+
+_SITE_CACHE = cache.VersionedCache('site', _load_site)
+
+def _invalidate_site_cache(sender, instance, **kwargs):
+  _SITE_CACHE.Invalidate()
+
 class SiteSettings(models.Model):
   VOLUME_DISPLAY_UNITS_CHOICES = (
     ('metric', 'Metric (mL, L)'),
@@ -175,6 +218,31 @@ class SiteSettings(models.Model):
     """Gets the default site settings."""
     return KegbotSite.get().settings
 
+def _site_settings_pre_save(sender, instance, **kwargs):
+  instance._old_session_timeout_minutes = None
+  if instance.pk:
+    old = SiteSettings.objects.filter(pk=instance.pk).values_list(
+        'session_timeout_minutes', flat=True)
+    if old and old[0] != instance.session_timeout_minutes:
+      instance._old_session_timeout_minutes = old[0]
+pre_save.connect(_site_settings_pre_save, sender=SiteSettings)
+
+def _site_settings_post_save(sender, instance, **kwargs):
+  """Schedules recomputing sessions when the session timeout changed."""
+  old_timeout = getattr(instance, '_old_session_timeout_minutes', None)
+  if old_timeout is None:
+    return
+  SessionTimeoutChange.objects.create(old_timeout_minutes=old_timeout,
+      new_timeout_minutes=instance.session_timeout_minutes)
+  if settings.HAVE_CELERY:
+    from pykeg.web import tasks
+    tasks.apply_session_timeout_changes.delay()
+post_save.connect(_site_settings_post_save, sender=SiteSettings)
+
+for _model in (KegbotSite, SiteSettings):
+  post_save.connect(_invalidate_site_cache, sender=_model)
+  post_delete.connect(_invalidate_site_cache, sender=_model)
+
 
 class UserProfile(models.Model):
   """Extra per-User information."""
@@ -472,22 +540,8 @@ class Keg(models.Model):
       sessions.append(sess)
     return sessions
 
-  def TopDrinkers(self):
-    stats = self.GetStats()
-    if not stats:
-      return []
-    ret = []
-    entries = stats.get('volume_by_drinker', [])
-    for entry in entries:
-      username = str(entry.username)
-      vol = entry.volume_ml
-      try:
-        user = User.objects.get(username=username)
-      except User.DoesNotExist:
-        continue  # should not happen
-      ret.append((vol, user))
-    ret.sort(reverse=True)
-    return ret
+  def TopDrinkers(self, limit=10):
+    return LeaderboardEntry.Top(LeaderboardEntry.KegScope(self), limit)
 
   def __str__(self):
     return "Keg #%s - %s" % (self.id, self.type)
@@ -534,6 +588,29 @@ def _keg_post_save(sender, instance, **kwargs):
 
 post_save.connect(_keg_post_save, sender=Keg)
 
+# Rows cached by the tap registry.
+for _model in (KegTap, Keg, SiteSettings):
+  post_save.connect(registry.Invalidate, sender=_model)
+for _model in (KegTap, Keg, SiteSettings, User):
+  post_delete.connect(registry.Invalidate, sender=_model)
+
+def _user_pre_save(sender, instance, update_fields=None, **kwargs):
+  # The registry only caches user ids by username, which most saves, such as
+  # the last_login update of every login, leave alone.
+  instance._username_changed = True
+  if update_fields is not None and 'username' not in update_fields:
+    instance._username_changed = False
+  elif instance.pk:
+    old = User.objects.filter(pk=instance.pk).values_list('username',
+        flat=True)
+    instance._username_changed = not old or old[0] != instance.username
+pre_save.connect(_user_pre_save, sender=User)
+
+def _user_registry_post_save(sender, instance, **kwargs):
+  if getattr(instance, '_username_changed', True):
+    registry.Invalidate()
+post_save.connect(_user_registry_post_save, sender=User)
+
 
 class Drink(models.Model):
   """ Table of drinks records """
@@ -582,12 +659,58 @@ class Drink(models.Model):
       stats, created = SessionStats.objects.get_or_create(session=self.session)
       stats.Update(self)
 
+  def _StatsRecords(self, cache=None):
+    """Returns the stats records of every scope this drink belongs to,
+    creating (unsaved) records for scopes which have none.
+
+    If given, `cache` maps scopes to records already loaded.
+    """
+    scopes = [(SystemStats, {})]
+    if self.user:
+      scopes.append((UserStats, {'user': self.user}))
+    if self.keg:
+      scopes.append((KegStats, {'keg': self.keg}))
+    if self.session:
+      scopes.append((SessionStats, {'session': self.session}))
+
+    if cache is None:
+      cache = {}
+    records = []
+    for model, scope in scopes:
+      key = (model, tuple(scope.items()))
+      if key not in cache:
+        existing = list(model.objects.filter(**scope)[:1])
+        if existing:
+          cache[key] = existing[0]
+        else:
+          cache[key] = model(**scope)
+      records.append(cache[key])
+    return records
+
   def PostProcess(self):
-    self._UpdateSystemStats()
-    self._UpdateUserStats()
-    self._UpdateKegStats()
-    self._UpdateSessionStats()
-    SystemEvent.ProcessDrink(self)
+    """Updates all stats and generates events for this drink.
+
+    All writes happen in a single transaction, so a failure leaves no scope
+    partially updated.
+    """
+    with transaction.commit_on_success():
+      Drink._PostProcessDrinks([self])
+
+  @classmethod
+  def _PostProcessDrinks(cls, drinks):
+    """Post processes `drinks`, in order, within the caller's transaction.
+
+    Each stats record is loaded and saved once, however many of the drinks
+    it covers.
+    """
+    cache = {}
+    for drink in drinks:
+      for record in drink._StatsRecords(cache):
+        record.Update(drink, save=False)
+      LeaderboardEntry.AddDrink(drink)
+      SystemEvent.ProcessDrink(drink)
+    for record in cache.itervalues():
+      record.save()
 
   objects = managers.DrinkManager()
 
@@ -614,8 +737,13 @@ class Drink(models.Model):
       on_delete=models.PROTECT)
   shout = models.TextField(blank=True, null=True,
       help_text='Comment from the drinker at the time of the pour.')
-  tick_time_series = models.TextField(blank=True, null=True, editable=False,
+  tick_time_series = timeseriesfield.TimeSeriesField(blank=True, null=True,
+      editable=False,
       help_text='Tick update sequence that generated this drink')
+  client_id = models.CharField(max_length=64, unique=True, blank=True,
+      null=True, editable=False,
+      help_text='Identifier assigned by the posting client, used to discard '
+      'duplicate posts.')
 
 
 class AuthenticationToken(models.Model):
@@ -670,6 +798,39 @@ def _auth_token_pre_save(sender, instance, **kwargs):
 
 pre_save.connect(_auth_token_pre_save, sender=AuthenticationToken)
 
+class DatabaseLock(models.Model):
+  """A named lock, held until the end of the transaction which acquired it.
+
+  Acquiring the lock writes its row.  This takes a row lock on MySQL and
+  PostgreSQL, and the database write lock on SQLite, so holders of the same
+  lock are serialized on every backend, even across processes.
+  """
+  name = models.CharField(max_length=64, unique=True)
+  generation = models.PositiveIntegerField(default=0, editable=False)
+
+  def __str__(self):
+    return 'DatabaseLock %s' % self.name
+
+  @classmethod
+  def Acquire(cls, name):
+    """Acquires the lock `name`, waiting for any other holder.
+
+    Must be called in a transaction, before any other query of the
+    transaction that the lock should protect.
+    """
+    if cls.objects.filter(name=name).update(generation=F('generation') + 1):
+      return
+    sid = transaction.savepoint()
+    try:
+      # The first acquisition is generation 1, so that it differs from a
+      # lock which was never acquired.
+      cls.objects.create(name=name, generation=1)
+      transaction.savepoint_commit(sid)
+    except IntegrityError:
+      # Created by a concurrent holder; wait for it.
+      transaction.savepoint_rollback(sid)
+      cls.Acquire(name)
+
 class _AbstractChunk(models.Model):
   class Meta:
     abstract = True
@@ -683,8 +844,9 @@ class _AbstractChunk(models.Model):
   def Duration(self):
     return self.end_time - self.start_time
 
-  def _AddDrinkNoSave(self, drink):
-    session_delta = SiteSettings.get().GetSessionTimeoutDelta()
+  def _AddDrinkNoSave(self, drink, session_delta=None):
+    if session_delta is None:
+      session_delta = SiteSettings.get().GetSessionTimeoutDelta()
     session_end = drink.time + session_delta
 
     if self.start_time > drink.time:
@@ -693,9 +855,44 @@ class _AbstractChunk(models.Model):
       self.end_time = session_end
     self.volume_ml += drink.volume_ml
 
-  def AddDrink(self, drink):
-    self._AddDrinkNoSave(drink)
-    self.save()
+  def AddDrink(self, drink, session_delta=None):
+    if session_delta is None:
+      session_delta = SiteSettings.get().GetSessionTimeoutDelta()
+    self._AddDrinkNoSave(drink, session_delta)
+    self.__class__._AddDrinkToRow(drink, session_delta, pk=self.pk)
+
+  @classmethod
+  def _AddDrinkToRow(cls, drink, session_delta, **keys):
+    """Atomically adds `drink` to the chunk matching `keys`, creating it if
+    there is none.  Returns True if the chunk was created.
+
+    Volumes are incremented in the database, so concurrent pours into the
+    same chunk are not lost.
+    """
+    session_end = drink.time + session_delta
+    rows = cls.objects.filter(**keys)
+    volume_ml = F('volume_ml') + drink.volume_ml
+
+    # Usually the drink is the chunk's latest, which extends its end time and
+    # cannot move its start time.
+    if rows.filter(end_time__lt=session_end).update(volume_ml=volume_ml,
+        end_time=session_end):
+      return False
+    if rows.update(volume_ml=volume_ml):
+      rows.filter(start_time__gt=drink.time).update(start_time=drink.time)
+      return False
+
+    sid = transaction.savepoint()
+    try:
+      cls.objects.create(start_time=drink.time, end_time=session_end,
+          volume_ml=drink.volume_ml, **keys)
+      transaction.savepoint_commit(sid)
+      return True
+    except IntegrityError:
+      # Created by a concurrent pour.
+      transaction.savepoint_rollback(sid)
+      cls._AddDrinkToRow(drink, session_delta, **keys)
+      return False
 
 
 class DrinkingSession(_AbstractChunk):
@@ -704,6 +901,9 @@ class DrinkingSession(_AbstractChunk):
     get_latest_by = 'start_time'
     ordering = ('-start_time',)
 
+  # DatabaseLock held while assigning a drink to a session.
+  ASSIGNMENT_LOCK = 'session_assignment'
+
   objects = managers.SessionManager()
   name = models.CharField(max_length=256, blank=True, null=True)
 
@@ -796,29 +996,22 @@ class DrinkingSession(_AbstractChunk):
         # Not yet saved.
         return 'New Session'
 
-  def AddDrink(self, drink):
-    super(DrinkingSession, self).AddDrink(drink)
-    session_delta = SiteSettings.get().GetSessionTimeoutDelta()
-
-    defaults = {
-      'start_time': drink.time,
-      'end_time': drink.time + session_delta,
-    }
+  def AddDrink(self, drink, session_delta=None):
+    """Adds the drink to this session and its chunks.
 
-    # Update or create a SessionChunk.
-    chunk, created = SessionChunk.objects.get_or_create(session=self,
-        user=drink.user, keg=drink.keg, defaults=defaults)
-    chunk.AddDrink(drink)
+    Sets `created_user_chunk` and `created_keg_chunk` on the drink, telling
+    whether it is the first drink of its user and keg in this session.
+    """
+    if session_delta is None:
+      session_delta = SiteSettings.get().GetSessionTimeoutDelta()
+    super(DrinkingSession, self).AddDrink(drink, session_delta)
 
-    # Update or create a UserSessionChunk.
-    chunk, created = UserSessionChunk.objects.get_or_create(session=self,
-        user=drink.user, defaults=defaults)
-    chunk.AddDrink(drink)
-
-    # Update or create a KegSessionChunk.
-    chunk, created = KegSessionChunk.objects.get_or_create(session=self,
-        keg=drink.keg, defaults=defaults)
-    chunk.AddDrink(drink)
+    SessionChunk._AddDrinkToRow(drink, session_delta, session=self,
+        user=drink.user, keg=drink.keg)
+    drink.created_user_chunk = UserSessionChunk._AddDrinkToRow(drink,
+        session_delta, session=self, user=drink.user)
+    drink.created_keg_chunk = KegSessionChunk._AddDrinkToRow(drink,
+        session_delta, session=self, keg=drink.keg)
 
   def UserChunksByVolume(self):
     chunks = self.user_chunks.all().order_by('-volume_ml')
@@ -846,7 +1039,7 @@ class DrinkingSession(_AbstractChunk):
     min_time = None
     max_time = None
     for d in drinks:
-      self.AddDrink(d)
+      self.AddDrink(d, session_delta)
       if min_time is None or d.time < min_time:
         min_time = d.time
       if max_time is None or d.time > max_time:
@@ -861,20 +1054,53 @@ class DrinkingSession(_AbstractChunk):
     if drink.session:
       return drink.session
 
-    # Return last session if one already exists
-    q = DrinkingSession.objects.all().order_by('-end_time')[:1]
-    if q and q[0].IsActive(drink.time):
+    session_delta = SiteSettings.get().GetSessionTimeoutDelta()
+
+    with transaction.commit_on_success():
+      # Concurrent pours must not both start a new session, or both miss the
+      # session started by the other.
+      DatabaseLock.Acquire(cls.ASSIGNMENT_LOCK)
+      return cls._AssignSessionForDrink(drink, session_delta)
+
+  @classmethod
+  def _AssignSessionForDrink(cls, drink, session_delta, pending_drinks=()):
+    """Assigns and saves `drink`; the caller must hold the assignment lock.
+
+    `pending_drinks` are drinks already assigned a session but not yet post
+    processed, in the order they will be.
+    """
+    # Sessions active at the time of the drink, or starting within the
+    # timeout after it.  This is a locking read so that, on MySQL, it sees
+    # sessions committed while waiting for the lock rather than the snapshot
+    # of an earlier read in the transaction, such as that of a web request.
+    q = DrinkingSession.objects.select_for_update().filter(
+        end_time__gt=drink.time,
+        start_time__lt=drink.time + session_delta).order_by('start_time')
+    q = list(q)
+    if len(q) == 1 and q[0].start_time <= drink.time:
       session = q[0]
-      session.AddDrink(drink)
+      session.AddDrink(drink, session_delta)
       drink.session = session
+      drink.created_session = False
       drink.save()
       return session
 
+    if q:
+      # A backdated drink, which moves the start of a session or bridges
+      # several of them.
+      from pykeg.core import sessions
+      if not drink.id:
+        drink.save()
+      sessions.ReassignSessions(q, new_drinks=list(pending_drinks) + [drink])
+      drink.save()
+      return drink.session
+
     # Create a new session
     session = cls(start_time=drink.time, end_time=drink.time)
     session.save()
-    session.AddDrink(drink)
+    session.AddDrink(drink, session_delta)
     drink.session = session
+    drink.created_session = True
     drink.save()
     return session
 
@@ -927,6 +1153,108 @@ class KegSessionChunk(_AbstractChunk):
     return self.session.GetTitle()
 
 
+class SessionTimeoutChange(models.Model):
+  """A change of the session timeout, and the progress of recomputing
+  existing sessions under it.
+
+  Changes are applied by sessions.ApplyTimeoutChanges, which saves its
+  position as it goes so that it can be resumed.
+  """
+  class Meta:
+    ordering = ('id',)
+
+  created_time = models.DateTimeField(default=timezone.now)
+  old_timeout_minutes = models.PositiveIntegerField()
+  new_timeout_minutes = models.PositiveIntegerField()
+  shifted = models.BooleanField(default=False,
+      help_text='Whether session end times were reset for the change.')
+  position = models.DateTimeField(blank=True, null=True,
+      help_text='Sessions starting before this time have been recomputed.')
+  finished_time = models.DateTimeField(blank=True, null=True)
+
+  def __str__(self):
+    return 'SessionTimeoutChange %s: %s -> %s minutes' % (self.id,
+        self.old_timeout_minutes, self.new_timeout_minutes)
+
+
+class PostProcessTask(models.Model):
+  """A recorded drink waiting to be post processed by the kb_postprocess
+  worker.
+
+  Tasks are processed in id order, which is the order their drinks were
+  assigned sessions in.  The session assignment flags of the drink (see
+  DrinkingSession.AssignSessionForDrink) are saved with the task.
+
+  Workers claim tasks while holding the session assignment lock, then post
+  process claimed tasks while holding PROCESSING_LOCK only, so that drinks
+  can be recorded meanwhile.  Drink edits and session reassignment, which
+  change claimed tasks and the stats of processed drinks, hold
+  PROCESSING_LOCK too.
+  """
+  class Meta:
+    ordering = ('id',)
+
+  # DatabaseLock held while post processing claimed drinks.
+  PROCESSING_LOCK = 'drink_postprocess'
+
+  drink = models.OneToOneField(Drink, related_name='postprocess_task')
+  created_time = models.DateTimeField(default=timezone.now)
+  claimed = models.BooleanField(default=False)
+  created_session = models.NullBooleanField()
+  created_user_chunk = models.NullBooleanField()
+  created_keg_chunk = models.NullBooleanField()
+
+  FLAGS = ('created_session', 'created_user_chunk', 'created_keg_chunk')
+
+  def __str__(self):
+    return 'PostProcessTask for drink %s' % self.drink_id
+
+  @classmethod
+  def Enqueue(cls, drink):
+    """Queues a drink which has been assigned a session.
+
+    Must be called while holding the session assignment lock.
+    """
+    task = cls(drink=drink)
+    task.SetFlags(drink)
+    task.save()
+    return task
+
+  def SetFlags(self, drink):
+    for flag in self.FLAGS:
+      setattr(self, flag, getattr(drink, flag, None))
+
+  def GetDrink(self):
+    """Returns the drink, with its session assignment flags."""
+    drink = self.drink
+    for flag in self.FLAGS:
+      setattr(drink, flag, getattr(self, flag))
+    return drink
+
+
+class DrinkFlow(models.Model):
+  """Cached flow rate analysis of a drink's time series.
+
+  Computed by pykeg.core.flow, and discarded when the drink's volume changes.
+  Rates are in ml/sec.
+  """
+  drink = models.OneToOneField(Drink, primary_key=True, related_name='flow')
+  samples = models.PositiveIntegerField(default=0)
+  duration_ms = models.PositiveIntegerField(default=0)
+  average_rate = models.FloatField(default=0)
+  peak_rate = models.FloatField(default=0)
+  max_gap_ms = models.PositiveIntegerField(default=0)
+  anomaly = models.CharField(max_length=16, blank=True, default='',
+      choices=(
+        ('', 'none'),
+        ('stuck', 'stuck meter'),
+        ('bursty', 'bursty meter'),
+      ))
+
+  def __str__(self):
+    return 'DrinkFlow for drink %s' % self.drink_id
+
+
 class ThermoSensor(models.Model):
   raw_name = models.CharField(max_length=256)
   nice_name = models.CharField(max_length=128)
@@ -942,27 +1270,355 @@ class ThermoSensor(models.Model):
     except Thermolog.DoesNotExist:
       return None
 
+  def GetLogs(self, start):
+    """Returns the logs of this sensor since `start`, in time order, from the
+    finest tier still holding them: Thermologs for recent windows, or
+    ThermoRollups of the finest resolution kept long enough.  Returns the
+    resolution, in seconds, and the logs."""
+    now = timezone.now()
+    keep_hours = settings.KEGBOT_THERMOLOG_KEEP_HOURS
+    if start >= now - datetime.timedelta(hours=keep_hours):
+      return Thermolog.RESOLUTION, self.thermolog_set.filter(
+          time__gte=start).order_by('time')
+    for resolution, keep_hours in settings.KEGBOT_THERMOLOG_ROLLUPS:
+      if keep_hours is None or \
+          start >= now - datetime.timedelta(hours=keep_hours):
+        return resolution, self.rollups.filter(resolution=resolution,
+            time__gte=start).order_by('time')
+    # Nothing is kept that long; return what remains.
+    return Thermolog.RESOLUTION, self.thermolog_set.filter(
+        time__gte=start).order_by('time')
+
+  def GetDays(self, start, end=None):
+    """Returns the ThermoDays of this sensor from the date `start` through
+    `end`, if given, in date order."""
+    days = self.days.filter(date__gte=start)
+    if end:
+      days = days.filter(date__lte=end)
+    return days.order_by('date')
+
+  def GetTemps(self, start, end):
+    """Returns the temperature of this sensor for each minute from `start`
+    through `end`, read from its ThermoDays, with None for minutes without a
+    reading."""
+    start = start.astimezone(timezone.utc)
+    end = end.astimezone(timezone.utc)
+    days = dict((day.date, day.Values())
+        for day in self.GetDays(start.date(), end.date()))
+    temps = []
+    date = start.date()
+    first = day_temps.slot(start)
+    while date <= end.date():
+      if date == end.date():
+        last = day_temps.slot(end) + 1
+      else:
+        last = day_temps.SLOTS
+      values = days.get(date)
+      if values is None:
+        temps.extend([None] * (last - first))
+      else:
+        temps.extend(day_temps.unpack_temp(v) for v in values[first:last])
+      date += datetime.timedelta(days=1)
+      first = 0
+    return temps
+
 
 class Thermolog(models.Model):
   """ A log from an ITemperatureSensor device of periodic measurements. """
   class Meta:
     get_latest_by = 'time'
     ordering = ('-time',)
+    unique_together = ('sensor', 'time')
 
   sensor = models.ForeignKey(ThermoSensor)
   temp = models.FloatField()
-  time = models.DateTimeField()
+  time = models.DateTimeField(db_index=True)
+
+  # Readings are rounded down to the minute.
+  RESOLUTION = 60
+
+  # Single statement upserts of a reading, by database vendor.  Parameters are
+  # (sensor_id, time, temp); each returns the id of the row.
+  UPSERT_SQL = {
+    'mysql': ('INSERT INTO %(table)s (sensor_id, time, temp) '
+        'VALUES (%%s, %%s, %%s) '
+        'ON DUPLICATE KEY UPDATE temp = VALUES(temp), id = LAST_INSERT_ID(id)'),
+    'sqlite': ('INSERT OR REPLACE INTO %(table)s (sensor_id, time, temp) '
+        'VALUES (%%s, %%s, %%s)'),
+    'postgresql': ('WITH new (sensor_id, time, temp) AS ('
+        'VALUES (%%s, CAST(%%s AS timestamp with time zone), %%s)), '
+        'updated AS (UPDATE %(table)s t SET temp = new.temp FROM new '
+        'WHERE t.sensor_id = new.sensor_id AND t.time = new.time '
+        'RETURNING t.id), '
+        'inserted AS (INSERT INTO %(table)s (sensor_id, time, temp) '
+        'SELECT * FROM new WHERE NOT EXISTS (SELECT 1 FROM updated) '
+        'RETURNING id) '
+        'SELECT id FROM updated UNION ALL SELECT id FROM inserted'),
+  }
 
   def __str__(self):
     return '%s %.2f C / %.2f F [%s]' % (self.sensor, self.TempC(),
         self.TempF(), self.time)
 
+  @classmethod
+  def Record(cls, sensor, when, temp):
+    """Saves the reading of `sensor` at `when`, replacing any reading already
+    saved for that time, and returns it."""
+    sql = cls.UPSERT_SQL.get(connection.vendor)
+    if not sql:
+      return cls._Record(sensor, when, temp)
+    sql = sql % {'table': connection.ops.quote_name(cls._meta.db_table)}
+    params = (sensor.id,
+        cls._meta.get_field('time').get_db_prep_value(when, connection), temp)
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    if connection.vendor == 'postgresql':
+      record_id = cursor.fetchone()[0]
+    else:
+      record_id = cursor.lastrowid
+    transaction.commit_unless_managed()
+    return cls(id=record_id, sensor=sensor, time=when, temp=temp)
+
+  @classmethod
+  def _Record(cls, sensor, when, temp):
+    rows = cls.objects.filter(sensor=sensor, time=when)
+    if rows.update(temp=temp):
+      return rows.get()
+    sid = transaction.savepoint()
+    try:
+      record = cls.objects.create(sensor=sensor, time=when, temp=temp)
+      transaction.savepoint_commit(sid)
+      return record
+    except IntegrityError:
+      # Recorded concurrently.
+      transaction.savepoint_rollback(sid)
+      return cls._Record(sensor, when, temp)
+
+  @classmethod
+  def PruneExpired(cls):
+    """Rolls up readings, then deletes readings and rollups older than they
+    are kept for (settings.KEGBOT_THERMOLOG_KEEP_HOURS and
+    KEGBOT_THERMOLOG_ROLLUPS).  Returns the number of readings deleted."""
+    ThermoRollup.Update()
+    now = timezone.now()
+    batch_size = settings.KEGBOT_THERMOLOG_PRUNE_BATCH_SIZE
+    for resolution, keep_hours in settings.KEGBOT_THERMOLOG_ROLLUPS:
+      if keep_hours is not None:
+        before = now - datetime.timedelta(hours=keep_hours)
+        _DeleteInBatches(ThermoRollup.objects.filter(resolution=resolution,
+            time__lt=before), batch_size)
+    before = now - datetime.timedelta(hours=settings.KEGBOT_THERMOLOG_KEEP_HOURS)
+    return cls.Prune(before, batch_size)
+
+  @classmethod
+  def Prune(cls, before, batch_size=1000):
+    """Deletes readings older than `before`, `batch_size` rows per transaction,
+    and returns the number deleted."""
+    return _DeleteInBatches(cls.objects.filter(time__lt=before), batch_size)
+
+  def TempC(self):
+    return self.temp
+
+  def TempF(self):
+    return util.CtoF(self.temp)
+
+
+def _DeleteInBatches(queryset, batch_size):
+  """Deletes the rows of `queryset` in time order, `batch_size` rows per
+  transaction, and returns the number deleted."""
+  deleted = 0
+  while True:
+    ids = list(queryset.order_by('time').values_list('id',
+        flat=True)[:batch_size])
+    if not ids:
+      return deleted
+    with transaction.commit_on_success():
+      queryset.model.objects.filter(id__in=ids).delete()
+    deleted += len(ids)
+
+
+class ThermoRollup(models.Model):
+  """The minimum, mean and maximum readings of a sensor over an interval of
+  `resolution` seconds, starting at `time`.
+
+  Each resolution in settings.KEGBOT_THERMOLOG_ROLLUPS is built from the next
+  finer one, the first from Thermologs, by Update.
+  """
+  class Meta:
+    get_latest_by = 'time'
+    ordering = ('-time',)
+    unique_together = ('sensor', 'resolution', 'time')
+
+  # DatabaseLock held while updating rollups.
+  UPDATE_LOCK = 'thermolog_rollup'
+
+  sensor = models.ForeignKey(ThermoSensor, related_name='rollups')
+  resolution = models.PositiveIntegerField()
+  time = models.DateTimeField()
+  count = models.PositiveIntegerField()
+  total = models.FloatField()
+  min_temp = models.FloatField()
+  max_temp = models.FloatField()
+
+  def __str__(self):
+    return '%s %.2f C [%s, %ss]' % (self.sensor, self.temp, self.time,
+        self.resolution)
+
+  @property
+  def temp(self):
+    return self.total / self.count
+
   def TempC(self):
     return self.temp
 
   def TempF(self):
     return util.CtoF(self.temp)
 
+  @classmethod
+  def Update(cls):
+    """Rolls up the readings since the last rollup of each resolution.
+
+    The latest interval of each resolution may have been incomplete, so it is
+    rebuilt along with the new ones.
+    """
+    with transaction.commit_on_success():
+      DatabaseLock.Acquire(cls.UPDATE_LOCK)
+      cls._Update()
+
+  @classmethod
+  def _Update(cls):
+    source = Thermolog.objects.all()
+    fields = ('sensor_id', 'time', 'temp')
+    for resolution, keep_hours in settings.KEGBOT_THERMOLOG_ROLLUPS:
+      rollups = cls.objects.filter(resolution=resolution)
+      start = rollups.aggregate(Max('time'))['time__max']
+      rows = source
+      if start:
+        rows = rows.filter(time__gte=start)
+
+      buckets = {}
+      for row in rows.order_by().values_list(*fields).iterator():
+        sensor_id, when = row[:2]
+        if len(row) == 3:
+          count, total, low, high = 1, row[2], row[2], row[2]
+        else:
+          count, total, low, high = row[2:]
+        seconds = when.hour * 3600 + when.minute * 60 + when.second
+        when = when.replace(microsecond=0) - datetime.timedelta(
+            seconds=seconds % resolution)
+        bucket = buckets.get((sensor_id, when))
+        if not bucket:
+          buckets[(sensor_id, when)] = cls(sensor_id=sensor_id,
+              resolution=resolution, time=when, count=count, total=total,
+              min_temp=low, max_temp=high)
+        else:
+          bucket.count += count
+          bucket.total += total
+          bucket.min_temp = min(bucket.min_temp, low)
+          bucket.max_temp = max(bucket.max_temp, high)
+
+      if start:
+        rollups.filter(time__gte=start).delete()
+      cls.objects.bulk_create(buckets.values())
+
+      source = rollups
+      fields = ('sensor_id', 'time', 'count', 'total', 'min_temp', 'max_temp')
+
+
+class ThermoDay(models.Model):
+  """A day of a sensor's readings, one per minute, packed as in
+  pykeg.core.day_temps.
+
+  A year of readings is 365 rows per sensor, so days are kept indefinitely.
+  """
+  class Meta:
+    get_latest_by = 'date'
+    ordering = ('-date',)
+    unique_together = ('sensor', 'date')
+
+  sensor = models.ForeignKey(ThermoSensor, related_name='days')
+  date = models.DateField(help_text='The day of the readings, in UTC.')
+  temps = blobfield.BlobField()
+
+  def __str__(self):
+    return '%s %s' % (self.sensor, self.date)
+
+  # Single statement updates of one slot of an existing day, by database
+  # vendor.  Parameters are (position, packed slot, position, sensor_id,
+  # date), with the position of the slot counted from 1.
+  SET_SLOT_SQL = {
+    'mysql': ('UPDATE %(table)s SET temps = '
+        'CONCAT(SUBSTRING(temps, 1, %%s - 1), %%s, '
+        'SUBSTRING(temps, %%s + %(size)d)) '
+        'WHERE sensor_id = %%s AND date = %%s'),
+    'sqlite': ('UPDATE %(table)s SET temps = CAST(substr(temps, 1, %%s - 1) '
+        '|| %%s || substr(temps, %%s + %(size)d) AS BLOB) '
+        'WHERE sensor_id = %%s AND date = %%s'),
+    'postgresql': ('UPDATE %(table)s SET temps = '
+        'substring(temps from 1 for %%s - 1) || %%s || '
+        'substring(temps from %%s + %(size)d) '
+        'WHERE sensor_id = %%s AND date = %%s'),
+  }
+
+  @classmethod
+  def Record(cls, sensor, when, temp):
+    """Saves the reading of `sensor` at `when` in its day, replacing any
+    reading saved for that minute.
+
+    The slot of an existing day is replaced in a single statement where the
+    database allows; otherwise the day is read, changed and saved.
+    """
+    when = when.astimezone(timezone.utc)
+    index = day_temps.slot(when)
+    sql = cls.SET_SLOT_SQL.get(connection.vendor)
+    if sql and cls._SetSlot(sql, sensor, when.date(), index, temp):
+      return
+    with transaction.commit_on_success():
+      rows = cls.objects.select_for_update().filter(sensor=sensor,
+          date=when.date())
+      try:
+        day = rows.get()
+      except cls.DoesNotExist:
+        day = cls(sensor=sensor, date=when.date())
+        day.temps = day_temps.set_slot(None, index, temp)
+        sid = transaction.savepoint()
+        try:
+          day.save(force_insert=True)
+          transaction.savepoint_commit(sid)
+          return
+        except IntegrityError:
+          # Created concurrently.
+          transaction.savepoint_rollback(sid)
+          day = rows.get()
+      day.temps = day_temps.set_slot(day.temps, index, temp)
+      rows.update(temps=day.temps)
+
+  @classmethod
+  def _SetSlot(cls, sql, sensor, date, index, temp):
+    """Replaces a slot of an existing day with `sql` (see SET_SLOT_SQL).
+    Returns False if the day does not exist yet."""
+    sql = sql % {'table': connection.ops.quote_name(cls._meta.db_table),
+        'size': day_temps.SLOT_SIZE}
+    position = day_temps.offset(index) + 1
+    packed = blobfield.to_binary(day_temps.pack_slot(temp), connection)
+    params = (position, packed, position, sensor.id,
+        cls._meta.get_field('date').get_db_prep_value(date, connection))
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    transaction.commit_unless_managed()
+    return cursor.rowcount > 0
+
+  def Values(self):
+    """Returns an array.array of the slot values of this day."""
+    return day_temps.to_array(self.temps)
+
+  def Readings(self):
+    """Yields the (time, temperature) pairs of the readings of this day."""
+    midnight = datetime.datetime.combine(self.date, datetime.time())
+    midnight = timezone.make_aware(midnight, timezone.utc)
+    for index, temp in day_temps.iter_temps(self.temps):
+      yield midnight + datetime.timedelta(minutes=index), temp
+
 
 class _StatsModel(models.Model):
   STATS_BUILDER = None
@@ -970,20 +1626,55 @@ class _StatsModel(models.Model):
   class Meta:
     abstract = True
 
-  def Update(self, drink, force=False):
+  def _Previous(self):
+    if self.stats_proto.ListFields():
+      return self.stats_proto
+    return None
+
+  @property
+  def stats(self):
+    """The stats as a dictionary, for templates and views."""
+    return protoutil.ProtoMessageToDict(self.stats_proto)
+
+  def _Indexes(self, previous):
+    """Returns the indexes kept by builders over the repeated fields of
+    `previous`, which they update in place; see StatsBuilder."""
+    if previous is None:
+      return None
+    if getattr(self, '_indexed_stats', None) is not previous:
+      self._indexed_stats = previous
+      self._stats_indexes = {}
+    return self._stats_indexes
+
+  def Update(self, drink, force=False, save=True):
     previous = None
-    try:
-      if not force and self.stats:
-        previous = protoutil.DictToProtoMessage(self.stats, models_pb2.Stats())
-    except TypeError, e:
-      pass
+    if not force:
+      previous = self._Previous()
+    builder = self.STATS_BUILDER(drink=drink, previous=previous,
+        drink_qs=Drink.objects.valid(), indexes=self._Indexes(previous))
+    self.stats_proto = builder.Build()
+    if save:
+      self.save()
+
+  def RemoveDrink(self, drink):
+    """Removes a drink's contribution from these stats.
+
+    `drink` must have the values it had when it was added; the stored drink
+    may already be deleted or changed.  The record is deleted if no drinks
+    remain.
+    """
+    previous = self._Previous()
     builder = self.STATS_BUILDER(drink=drink, previous=previous,
-        drink_qs=Drink.objects.valid())
-    self.stats = protoutil.ProtoMessageToDict(builder.Build())
+        drink_qs=Drink.objects.valid(), indexes=self._Indexes(previous))
+    stats = builder.Remove()
+    if not stats.total_pours:
+      self.delete()
+      return
+    self.stats_proto = stats
     self.save()
 
   time = models.DateTimeField(default=timezone.now)
-  stats = jsonfield.JSONField()
+  stats_proto = protofield.ProtoField('kegbot.api.models_pb2.Stats')
 
 
 class SystemStats(_StatsModel):
@@ -1017,6 +1708,120 @@ class SessionStats(_StatsModel):
     return 'SessionStats for %s' % self.session
 
 
+class LeaderboardEntry(models.Model):
+  """Volume poured by a registered user within a scope.
+
+  Scopes are systemwide ('system'), a keg ('keg:<id>'), a session
+  ('session:<id>'), a year ('year:<yyyy>') or a month ('month:<yyyy-mm>').
+  Entries are updated on every pour, so the top drinkers of a scope can be
+  read with a single query.
+  """
+  class Meta:
+    unique_together = ('scope', 'user')
+    index_together = (('scope', 'volume_ml'),)
+
+  scope = models.CharField(max_length=64)
+  user = models.ForeignKey(User, related_name='leaderboard_entries')
+  volume_ml = models.FloatField(default=0)
+
+  def __str__(self):
+    return 'LeaderboardEntry %s for %s' % (self.scope, self.user)
+
+  @classmethod
+  def KegScope(cls, keg):
+    return 'keg:%s' % keg.id
+
+  @classmethod
+  def SessionScope(cls, session):
+    return 'session:%s' % session.id
+
+  @classmethod
+  def YearScope(cls, when):
+    return 'year:%04d' % when.year
+
+  @classmethod
+  def MonthScope(cls, when):
+    return 'month:%04d-%02d' % (when.year, when.month)
+
+  @classmethod
+  def _Scopes(cls, keg_id, session_id, when):
+    scopes = ['system', cls.YearScope(when), cls.MonthScope(when)]
+    if keg_id:
+      scopes.append('keg:%s' % keg_id)
+    if session_id:
+      scopes.append('session:%s' % session_id)
+    return scopes
+
+  @classmethod
+  def ScopesForDrink(cls, drink):
+    return cls._Scopes(drink.keg_id, drink.session_id, drink.time)
+
+  @classmethod
+  def Top(cls, scope, limit=10):
+    """Returns up to `limit` (volume_ml, user) tuples, largest first."""
+    entries = cls.objects.filter(scope=scope).select_related('user')
+    entries = entries.order_by('-volume_ml')[:limit]
+    return [(e.volume_ml, e.user) for e in entries]
+
+  @classmethod
+  def AddDrink(cls, drink):
+    """Adds the drink's volume to the entries of each of its scopes."""
+    if not drink.user_id:
+      return
+    cls._AddVolume(drink.user_id, cls.ScopesForDrink(drink), drink.volume_ml)
+
+  @classmethod
+  def _AddVolume(cls, user_id, scopes, volume_ml):
+    entries = cls.objects.filter(user=user_id)
+    existing = set(entries.filter(scope__in=scopes).values_list('scope', flat=True))
+    if existing:
+      entries.filter(scope__in=existing).update(
+          volume_ml=F('volume_ml') + volume_ml)
+    missing = [scope for scope in scopes if scope not in existing]
+    if not missing:
+      return
+
+    sid = transaction.savepoint()
+    try:
+      cls.objects.bulk_create([cls(scope=scope, user_id=user_id,
+          volume_ml=volume_ml) for scope in missing])
+      transaction.savepoint_commit(sid)
+    except IntegrityError:
+      # Created by a concurrent pour.
+      transaction.savepoint_rollback(sid)
+      cls._AddVolume(user_id, missing, volume_ml)
+
+  @classmethod
+  def RemoveDrink(cls, drink):
+    """Subtracts the drink's volume from the entries of each of its scopes.
+
+    `drink` must have the values it had when it was added.
+    """
+    if not drink.user_id:
+      return
+    entries = cls.objects.filter(user=drink.user_id,
+        scope__in=cls.ScopesForDrink(drink))
+    entries.update(volume_ml=F('volume_ml') - drink.volume_ml)
+    entries.filter(volume_ml__lt=stats.MIN_VOLUME_ML).delete()
+
+  @classmethod
+  def Rebuild(cls, batch_size=100):
+    """Recomputes all entries from valid drinks."""
+    volumes = {}
+    drinks = Drink.objects.valid().exclude(user=None)
+    rows = drinks.values_list('user', 'keg', 'session', 'time', 'volume_ml')
+    for user_id, keg_id, session_id, when, volume_ml in rows.iterator():
+      for scope in cls._Scopes(keg_id, session_id, when):
+        key = (scope, user_id)
+        volumes[key] = volumes.get(key, 0) + volume_ml
+
+    cls.objects.all().delete()
+    entries = [cls(scope=scope, user_id=user_id, volume_ml=volume_ml)
+        for (scope, user_id), volume_ml in volumes.iteritems()
+        if volume_ml >= stats.MIN_VOLUME_ML]
+    cls.objects.bulk_create(entries, batch_size=batch_size)
+
+
 class SystemEvent(models.Model):
   class Meta:
     ordering = ('-id',)
@@ -1082,34 +1887,40 @@ class SystemEvent(models.Model):
     keg = drink.keg
     session = drink.session
     user = drink.user
+    events = []
 
     if keg:
       q = keg.events.filter(kind='keg_tapped')
-      if q.count() == 0:
-        e = keg.events.create(kind='keg_tapped', time=drink.time,
-            keg=keg, user=user, drink=drink, session=session)
-        e.save()
+      if not q.exists():
+        events.append(cls(kind='keg_tapped', time=drink.time,
+            keg=keg, user=user, drink=drink, session=session))
 
+    # Session assignment records whether the drink started the session or
+    # the user's part of it; only drinks assigned elsewhere need a query.
     if session:
-      q = session.events.filter(kind='session_started')
-      if q.count() == 0:
-        e = session.events.create(kind='session_started',
-            time=session.start_time, drink=drink, user=user)
-        e.save()
+      started = getattr(drink, 'created_session', None)
+      if started is None:
+        started = not session.events.filter(kind='session_started').exists()
+      if started:
+        events.append(cls(kind='session_started',
+            time=session.start_time, drink=drink, user=user, session=session))
 
     if user:
-      q = user.events.filter(kind='session_joined', session=session)
-      if q.count() == 0:
-        e = user.events.create(kind='session_joined',
-            time=drink.time, session=session, drink=drink, user=user)
-        e.save()
+      joined = getattr(drink, 'created_user_chunk', None)
+      if joined is None:
+        q = user.events.filter(kind='session_joined', session=session)
+        joined = not q.exists()
+      if joined:
+        events.append(cls(kind='session_joined',
+            time=drink.time, session=session, drink=drink, user=user))
 
     q = drink.events.filter(kind='drink_poured')
-    if q.count() == 0:
-      e = drink.events.create(kind='drink_poured',
+    if not q.exists():
+      events.append(cls(kind='drink_poured',
           time=drink.time, drink=drink, user=user, keg=keg,
-          session=session)
-      e.save()
+          session=session))
+
+    cls.objects.bulk_create(events)
 
 
 def _pics_file_name(instance, filename):
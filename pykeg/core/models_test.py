@@ -21,10 +21,12 @@
 import datetime
 
 from django.conf import settings
+from django.core.cache import cache as django_cache
 from django.utils import timezone
 from django.test import TestCase
 
 from . import backend
+from . import cache
 from . import kb_common
 from . import models
 from .testutils import make_datetime
@@ -120,6 +122,16 @@ class CoreModelsTestCase(TestCase):
 
     self.assertEqual(self.keg.served_volume(), d.volume_ml)
 
+  def testDrinkTimeSeries(self):
+    d = self.backend.RecordDrink(tap_name=self.tap.meter_name, ticks=1200,
+        username=self.user.username, tick_time_series='0:100  250:1100')
+    d = models.Drink.objects.get(id=d.id)
+    self.assertEqual([(0, 100), (250, 1100)], d.tick_time_series)
+
+    d = self.backend.RecordDrink(tap_name=self.tap.meter_name, ticks=1200,
+        username=self.user.username, tick_time_series='0:100 junk')
+    self.assertEqual([], models.Drink.objects.get(id=d.id).tick_time_series)
+
   def testDrinkSessions(self):
     """ Checks for the DrinkingSession records. """
     u1 = self.user
@@ -210,6 +222,12 @@ class CoreModelsTestCase(TestCase):
     self.assertEqual(u2_c2.start_time, base_time + td_390m)
     self.assertEqual(u2_c2.end_time, base_time + td_400m + SESSION_DELTA)
 
+    # Chunk and session volumes are incremented in the database.
+    self.assertEqual(u1_chunks[0].volume_ml,
+        sum(d.volume_ml for d in drinks_u1[:2]))
+    self.assertEqual(u2_c2.volume_ml, sum(d.volume_ml for d in drinks_u2[1:]))
+    self.assertEqual(s2.volume_ml, sum(d.volume_ml for d in s2.drinks.valid()))
+
     # Now check DrinkingSessions were created correctly; there should be
     # two groups capturing all 4 sessions.
     all_groups = models.DrinkingSession.objects.all().order_by('start_time')
@@ -222,3 +240,91 @@ class CoreModelsTestCase(TestCase):
     self.assertEqual(all_groups[1].start_time, base_time + td_390m)
     self.assertEqual(all_groups[1].end_time, base_time + td_400m + SESSION_DELTA)
     self.assertEqual(all_groups[1].user_chunks.all().count(), 2)
+
+  def testSiteCache(self):
+    site = models.KegbotSite.get()
+    # With a process-local cache backend, the cache version is read from the
+    # database.
+    with self.assertNumQueries(1 if cache.IsProcessLocal() else 0):
+      site = models.KegbotSite.get()
+      self.assertEquals(site, site.settings.site)
+
+    # Callers get their own copies.
+    site.settings.guest_name = 'changed'
+    self.assertEquals('guest', models.SiteSettings.get().guest_name)
+
+    site.settings.save()
+    self.assertEquals('changed', models.SiteSettings.get().guest_name)
+
+  def testSiteCacheAcrossProcesses(self):
+    # Before the site was ever invalidated.
+    models.DatabaseLock.objects.filter(name='cache:site').delete()
+    django_cache.clear()
+
+    # The site cache of another process.
+    other = cache.VersionedCache('site', models._load_site)
+    self.assertEquals('public', other.Get()[1].privacy)
+
+    site_settings = models.SiteSettings.get()
+    site_settings.privacy = 'members'
+    site_settings.save()
+    self.assertEquals('members', other.Get()[1].privacy)
+
+  def testSensorReadings(self):
+    when = make_datetime(2013, 1, 1, 12, 0, 0)
+    self.backend.LogSensorReading('sensor1', 4.0, when)
+    with self.assertNumQueries(3):
+      record = self.backend.LogSensorReading('sensor1', 5.0, when)
+    record = models.Thermolog.objects.get(id=record.id)
+    self.assertEqual(5.0, record.temp)
+    self.assertEqual((5.0, 41.0), (record.TempC(), record.TempF()))
+    self.assertIn('5.00 C / 41.00 F', str(record))
+    later = when + datetime.timedelta(minutes=1)
+    self.backend.LogSensorReading('sensor1', 6.0, later)
+    self.assertEqual(2, models.Thermolog.objects.count())
+
+    # Readings are also packed into their day.
+    day = models.ThermoDay.objects.get()
+    self.assertEqual(when.date(), day.date)
+    self.assertEqual([(when, 5.0), (later, 6.0)], list(day.Readings()))
+    self.assertEqual([500, 600], list(day.Values()[12*60:12*60 + 2]))
+    sensor = models.ThermoSensor.objects.get(raw_name='sensor1')
+    self.assertEqual([day], list(sensor.GetDays(when.date())))
+    minute = datetime.timedelta(minutes=1)
+    self.assertEqual([None, 5.0, 6.0, None],
+        sensor.GetTemps(when - minute, later + minute))
+    self.assertEqual([None] * 2, sensor.GetTemps(when - 721 * minute,
+        when - 720 * minute))
+
+    self.assertEqual(1, models.Thermolog.Prune(later, batch_size=1))
+    self.assertEqual([6.0], [r.temp for r in models.Thermolog.objects.all()])
+
+  def testThermoRollups(self):
+    start = make_datetime(2013, 1, 1, 12, 0, 0)
+    for minute, temp in enumerate((4.0, 6.0, 2.0, 8.0, 5.0, 9.0)):
+      when = start + datetime.timedelta(minutes=minute)
+      self.backend.LogSensorReading('sensor1', temp, when)
+    models.ThermoRollup.Update()
+
+    five = models.ThermoRollup.objects.filter(resolution=5*60).order_by('time')
+    self.assertEqual([(start, 5, 2.0, 8.0),
+        (start + datetime.timedelta(minutes=5), 1, 9.0, 9.0)],
+        [(r.time, r.count, r.min_temp, r.max_temp) for r in five])
+    self.assertEqual(5.0, five[0].temp)
+    hourly = models.ThermoRollup.objects.get(resolution=60*60)
+    self.assertEqual((start, 6, 2.0, 9.0),
+        (hourly.time, hourly.count, hourly.min_temp, hourly.max_temp))
+
+    # The open interval is rebuilt, not counted twice.
+    self.backend.LogSensorReading('sensor1', 1.0,
+        start + datetime.timedelta(minutes=6))
+    models.ThermoRollup.Update()
+    hourly = models.ThermoRollup.objects.get(resolution=60*60)
+    self.assertEqual((7, 1.0, 35.0), (hourly.count, hourly.min_temp, hourly.total))
+
+    sensor = models.ThermoSensor.objects.get(raw_name='sensor1')
+    now = timezone.now()
+    self.assertEqual(models.Thermolog.RESOLUTION,
+        sensor.GetLogs(now - datetime.timedelta(hours=1))[0])
+    self.assertEqual(5*60, sensor.GetLogs(now - datetime.timedelta(days=2))[0])
+    self.assertEqual(60*60, sensor.GetLogs(now - datetime.timedelta(days=30))[0])
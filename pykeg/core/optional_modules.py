@@ -29,3 +29,9 @@ try:
   HAVE_DJKOMBU = True
 except ImportError:
   HAVE_DJKOMBU = False
+
+try:
+  import numpy
+  HAVE_NUMPY = True
+except ImportError:
+  HAVE_NUMPY = False
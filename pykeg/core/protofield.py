@@ -0,0 +1,182 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Model field storing a serialized protocol buffer message.
+
+The message is stored in a binary column, and is only decoded when the
+attribute is first read.  Rows which are loaded and saved without reading the
+field are written back without being re-encoded.
+
+  class Record(models.Model):
+    data = ProtoField('kegbot.api.models_pb2.Stats')
+
+The message class may be given as a class, or as a dotted path which is
+imported on first use.
+
+Serialized float fields hold only single precision, so the stored value is a
+version byte, the length of the serialized message and the message, followed
+by the value of every float field as a double.  Running totals kept in float
+fields are then not rounded each time they are saved.
+"""
+
+import base64
+import struct
+
+from django.utils import importlib
+from google.protobuf.descriptor import FieldDescriptor
+
+from pykeg.core.blobfield import BlobField
+from pykeg.core.blobfield import to_bytes
+
+ENCODING_VERSION = '\x01'
+
+_LENGTH = struct.Struct('<I')
+
+def _FloatFields(message):
+  """Yields (message, field, index) for each float value in `message` and its
+  submessages, in field number order; index is None for singular fields."""
+  for field, value in message.ListFields():
+    repeated = field.label == FieldDescriptor.LABEL_REPEATED
+    if field.cpp_type == FieldDescriptor.CPPTYPE_MESSAGE:
+      for submessage in (value if repeated else (value,)):
+        for entry in _FloatFields(submessage):
+          yield entry
+    elif field.cpp_type == FieldDescriptor.CPPTYPE_FLOAT:
+      if repeated:
+        for index in xrange(len(value)):
+          yield message, field, index
+      else:
+        yield message, field, None
+
+def encode(message):
+  """Returns the stored form of `message`."""
+  data = message.SerializeToString()
+  values = []
+  for submessage, field, index in _FloatFields(message):
+    value = getattr(submessage, field.name)
+    values.append(value if index is None else value[index])
+  return ENCODING_VERSION + _LENGTH.pack(len(data)) + data + \
+      struct.pack('<%id' % len(values), *values)
+
+def decode(data, message_class):
+  """Decodes a stored value into a new `message_class` message."""
+  message = message_class()
+  if not data:
+    return message
+  if data[0] != ENCODING_VERSION:
+    raise ValueError('Unknown encoding version: %r' % data[0])
+  start = 1 + _LENGTH.size
+  end = start + _LENGTH.unpack(data[1:start])[0]
+  message.ParseFromString(data[start:end])
+  fields = list(_FloatFields(message))
+  if len(data) - end != len(fields) * 8:
+    # Doubles were not stored; the single precision values remain.
+    return message
+  values = struct.unpack('<%id' % len(fields), data[end:])
+  for (submessage, field, index), value in zip(fields, values):
+    if index is None:
+      setattr(submessage, field.name, value)
+    else:
+      getattr(submessage, field.name)[index] = value
+  return message
+
+def encode_serialized(data):
+  """Returns the stored form of an already serialized message, without
+  doubles."""
+  return ENCODING_VERSION + _LENGTH.pack(len(data)) + data
+
+def serialized(data):
+  """Returns the serialized message of a stored value."""
+  if not data:
+    return ''
+  start = 1 + _LENGTH.size
+  return data[start:start + _LENGTH.unpack(data[1:start])[0]]
+
+
+class _ProtoDescriptor(object):
+  """Holds the encoded value until first access, then the decoded message."""
+
+  def __init__(self, field):
+    self.field = field
+
+  def __get__(self, instance, owner):
+    if instance is None:
+      return self
+    value = instance.__dict__.get(self.field.attname)
+    if not isinstance(value, (basestring, buffer)):
+      return value
+    value = self.field.to_python(value)
+    instance.__dict__[self.field.attname] = value
+    return value
+
+  def __set__(self, instance, value):
+    instance.__dict__[self.field.attname] = value
+
+
+class ProtoField(BlobField):
+  """Stores a protocol buffer message of type `message_class`."""
+
+  def __init__(self, message_class=None, *args, **kwargs):
+    self._message_class = message_class
+    kwargs.setdefault('default', '')
+    BlobField.__init__(self, *args, **kwargs)
+
+  @property
+  def message_class(self):
+    if isinstance(self._message_class, basestring):
+      module_name, class_name = self._message_class.rsplit('.', 1)
+      module = importlib.import_module(module_name)
+      self._message_class = getattr(module, class_name)
+    return self._message_class
+
+  def contribute_to_class(self, cls, name):
+    super(ProtoField, self).contribute_to_class(cls, name)
+    setattr(cls, self.name, _ProtoDescriptor(self))
+
+  def to_python(self, value):
+    """Decodes a stored or serialized value into a new message."""
+    if not isinstance(value, (basestring, buffer)) or not self.message_class:
+      return value
+    return decode(BlobField.to_python(self, value), self.message_class)
+
+  def pre_save(self, model_instance, add):
+    # Skip the descriptor, so that undecoded values are saved as-is.
+    return model_instance.__dict__.get(self.attname)
+
+  def _Encoded(self, value):
+    if value is None:
+      return ''
+    if not isinstance(value, (basestring, buffer)):
+      return encode(value)
+    return to_bytes(value)
+
+  def get_db_prep_value(self, value, connection, prepared=False):
+    return BlobField.get_db_prep_value(self, self._Encoded(value), connection,
+        prepared)
+
+  def value_to_string(self, obj):
+    return base64.b64encode(self._Encoded(self.pre_save(obj, False)))
+
+try:
+  from south.modelsinspector import add_introspection_rules
+except ImportError:
+  pass
+else:
+  add_introspection_rules([
+    ([ProtoField], [], {}),
+    ], ["^pykeg\.core\.protofield\.ProtoField"])
@@ -0,0 +1,84 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Process-local registry of the taps, kegs and settings used to record
+drinks, so that recording a drink needs no lookup queries.
+
+The registry is rebuilt after any KegTap, Keg, SiteSettings or User is saved
+or deleted (see models.py).
+"""
+
+from pykeg.core import cache
+
+class TapInfo:
+  """The recording parameters of a tap."""
+  def __init__(self, tap_id, meter_name, relay_name, ml_per_tick, keg_id):
+    self.id = tap_id
+    self.meter_name = meter_name
+    self.relay_name = relay_name
+    self.ml_per_tick = ml_per_tick
+    self.keg_id = keg_id  # The current keg, if online.
+
+  def __str__(self):
+    return 'TapInfo %s' % self.meter_name
+
+
+class Registry:
+  def __init__(self, taps, default_user_id, session_delta):
+    self.taps = taps  # Keyed by meter name.
+    self.default_user_id = default_user_id
+    self.session_delta = session_delta
+    self._user_ids = {}
+
+  def GetTap(self, meter_name):
+    """Returns the TapInfo for `meter_name`, or None if there is none."""
+    return self.taps.get(meter_name)
+
+  def GetUserId(self, username):
+    """Returns the id of the user `username`, or None if there is none."""
+    if username not in self._user_ids:
+      from pykeg.core import models
+      ids = models.User.objects.filter(username=username).values_list('id',
+          flat=True)
+      self._user_ids[username] = ids[0] if ids else None
+    return self._user_ids[username]
+
+
+def _Load():
+  from pykeg.core import models
+  taps = {}
+  for tap in models.KegTap.objects.select_related('current_keg'):
+    keg = tap.current_keg
+    keg_id = None
+    if keg and keg.status == 'online':
+      keg_id = keg.id
+    taps[tap.meter_name] = TapInfo(tap.id, tap.meter_name, tap.relay_name,
+        tap.ml_per_tick, keg_id)
+  site_settings = models.SiteSettings.get()
+  return Registry(taps, site_settings.default_user_id,
+      site_settings.GetSessionTimeoutDelta())
+
+_REGISTRY = cache.VersionedCache('tap-registry', _Load)
+
+def Get():
+  """Returns the current Registry."""
+  return _REGISTRY.Get()
+
+def Invalidate(*args, **kwargs):
+  """Discards the registry; usable as a signal handler."""
+  _REGISTRY.Invalidate()
@@ -0,0 +1,113 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unittests for the tap registry."""
+
+from django.core.cache import cache as django_cache
+from django.test import TestCase
+from django.utils import timezone
+
+from . import backend
+from . import cache
+from . import models
+from . import registry
+
+class RegistryTestCase(TestCase):
+  def setUp(self):
+    models.KegbotSite.get()  # create the site
+    self.backend = backend.KegbotBackend()
+    self.user = self.backend.CreateNewUser('user1')
+    self.tap = self.backend.CreateTap('tap1', 'kegboard.flow0',
+        ml_per_tick=0.5)
+    brewer = models.Brewer.objects.create(name='Brewer')
+    style = models.BeerStyle.objects.create(name='Porter')
+    beer_type = models.BeerType.objects.create(name='Beer', brewer=brewer,
+        style=style)
+    size = models.KegSize.objects.create(name='Keg', volume_ml=1000)
+    self.keg = models.Keg.objects.create(type=beer_type, size=size,
+        status='online')
+    self.tap.current_keg = self.keg
+    self.tap.save()
+    # With a process-local cache backend, the cache version is read from the
+    # database.
+    self.version_queries = 1 if cache.IsProcessLocal() else 0
+
+  def testInvalidation(self):
+    tap = registry.Get().GetTap('kegboard.flow0')
+    self.assertEquals(self.keg.id, tap.keg_id)
+    self.assertEquals(0.5, tap.ml_per_tick)
+    self.assertEquals(None, registry.Get().GetTap('kegboard.flow1'))
+    with self.assertNumQueries(self.version_queries):
+      registry.Get()
+
+    self.keg.status = 'offline'
+    self.keg.save()
+    self.assertEquals(None, registry.Get().GetTap('kegboard.flow0').keg_id)
+
+    self.tap.meter_name = 'kegboard.flow1'
+    self.tap.save()
+    self.assertEquals(None, registry.Get().GetTap('kegboard.flow0'))
+    self.assertEquals(self.tap.id, registry.Get().GetTap('kegboard.flow1').id)
+
+    site_settings = models.SiteSettings.get()
+    site_settings.default_user = self.user
+    site_settings.save()
+    self.assertEquals(self.user.id, registry.Get().default_user_id)
+
+  def testInvalidationReachesOtherProcesses(self):
+    # Before the registry was ever invalidated.
+    models.DatabaseLock.objects.filter(name='cache:tap-registry').delete()
+    django_cache.clear()
+
+    # The registry cache of another process.
+    other = cache.VersionedCache('tap-registry', registry._Load)
+    self.assertEquals(self.keg.id, other.Get().GetTap('kegboard.flow0').keg_id)
+
+    self.keg.status = 'offline'
+    self.keg.save()
+    self.assertEquals(None, other.Get().GetTap('kegboard.flow0').keg_id)
+
+    self.keg.status = 'online'
+    self.keg.save()
+    self.assertEquals(self.keg.id, other.Get().GetTap('kegboard.flow0').keg_id)
+
+  def testLoginKeepsRegistry(self):
+    cached = registry.Get()
+    self.user.last_login = timezone.now()
+    self.user.save(update_fields=['last_login'])
+    self.user.first_name = 'First'
+    self.user.save()
+    self.assertTrue(cached is registry.Get())
+
+    self.user.username = 'user2'
+    self.user.save()
+    self.assertFalse(cached is registry.Get())
+    self.assertEquals(self.user.id, registry.Get().GetUserId('user2'))
+
+  def testNewDrinkWithoutQueries(self):
+    self.backend._NewDrink('kegboard.flow0', 100, username='user1')
+    with self.assertNumQueries(self.version_queries):
+      d = self.backend._NewDrink('kegboard.flow0', 100, username='user1')
+    self.assertEquals(self.user.id, d.user_id)
+    self.assertEquals(self.keg.id, d.keg_id)
+    self.assertEquals(50, d.volume_ml)
+
+    # Unknown users are cached until a user is created.
+    self.assertEquals(None, registry.Get().GetUserId('user2'))
+    user2 = self.backend.CreateNewUser('user2')
+    self.assertEquals(user2.id, registry.Get().GetUserId('user2'))
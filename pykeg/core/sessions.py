@@ -0,0 +1,520 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Bulk (re)computation of drinking sessions and their chunks."""
+
+import datetime
+
+from django.core.management.color import no_style
+from django.db import connection
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from pykeg.core import models
+from pykeg.core import stats
+
+class _Chunk:
+  def __init__(self, time, session_delta):
+    self.start_time = time
+    self.end_time = time + session_delta
+    self.volume_ml = 0
+
+  def AddDrink(self, time, volume_ml, session_delta):
+    if self.start_time > time:
+      self.start_time = time
+    if self.end_time < time + session_delta:
+      self.end_time = time + session_delta
+    self.volume_ml += volume_ml
+
+
+class _Session(_Chunk):
+  def __init__(self, time, session_delta):
+    _Chunk.__init__(self, time, session_delta)
+    self.drink_ids = []
+    self.chunks = {}
+    self.user_chunks = {}
+    self.keg_chunks = {}
+
+
+def _ChunkRecords(session_id, session):
+  """Returns unsaved SessionChunk, UserSessionChunk and KegSessionChunk
+  records for the chunks of `session`."""
+  records = []
+  for (user_id, keg_id), c in session.chunks.iteritems():
+    records.append(models.SessionChunk(session_id=session_id,
+        user_id=user_id, keg_id=keg_id, start_time=c.start_time,
+        end_time=c.end_time, volume_ml=c.volume_ml))
+  for user_id, c in session.user_chunks.iteritems():
+    records.append(models.UserSessionChunk(session_id=session_id,
+        user_id=user_id, start_time=c.start_time, end_time=c.end_time,
+        volume_ml=c.volume_ml))
+  for keg_id, c in session.keg_chunks.iteritems():
+    records.append(models.KegSessionChunk(session_id=session_id,
+        keg_id=keg_id, start_time=c.start_time, end_time=c.end_time,
+        volume_ml=c.volume_ml))
+  return records
+
+
+def _BulkCreate(records):
+  by_model = {}
+  for record in records:
+    by_model.setdefault(record.__class__, []).append(record)
+  for model, model_records in by_model.iteritems():
+    model.objects.bulk_create(model_records)
+
+
+class SessionRegenerator:
+  """Assigns drinks to sessions in a single pass, in memory.
+
+  Rows are tuples of FIELDS, as returned by
+  `Drink.objects.values_list(*FIELDS)`, and must be given in time order.
+  The result is the same as calling `DrinkingSession.AssignSessionForDrink`
+  on each drink in turn: a drink joins the latest session if that session
+  is still active at the time of the drink, and starts a new one otherwise.
+  """
+  FIELDS = ('id', 'time', 'user', 'keg', 'volume_ml')
+
+  def __init__(self, session_delta):
+    self.session_delta = session_delta
+    self.sessions = []
+
+  def _Chunk(self, chunks, key, time):
+    chunk = chunks.get(key)
+    if chunk is None:
+      chunk = chunks[key] = _Chunk(time, self.session_delta)
+    return chunk
+
+  def AddDrink(self, drink_id, time, user_id, keg_id, volume_ml):
+    delta = self.session_delta
+    session = self.sessions and self.sessions[-1]
+    if not session or session.end_time <= time:
+      session = _Session(time, delta)
+      self.sessions.append(session)
+    session.AddDrink(time, volume_ml, delta)
+    session.drink_ids.append(drink_id)
+    for chunks, key in ((session.chunks, (user_id, keg_id)),
+        (session.user_chunks, user_id), (session.keg_chunks, keg_id)):
+      self._Chunk(chunks, key, time).AddDrink(time, volume_ml, delta)
+
+  def Write(self, batch_size=500, progress=None):
+    """Creates the sessions and chunks, and points drinks, pictures and
+    events at their new sessions.
+
+    Existing sessions must already have been deleted.  Sessions are written
+    in batches of `batch_size`, each batch in its own transaction.  If given,
+    `progress` is called with the number of sessions written so far.
+    """
+    # Sessions are given explicit ids, so that their chunks and drinks can be
+    # written without reading the ids back.
+    last = models.DrinkingSession.objects.order_by('-id').values_list('id',
+        flat=True)[:1]
+    next_id = (last[0] if last else 0) + 1
+
+    picture_drinks = {}
+    pictures = models.PourPicture.objects.exclude(drink=None)
+    for picture_id, drink_id in pictures.values_list('id', 'drink').iterator():
+      picture_drinks.setdefault(drink_id, []).append(picture_id)
+
+    for pos in xrange(0, len(self.sessions), batch_size):
+      batch = self.sessions[pos:pos+batch_size]
+      with transaction.commit_on_success():
+        next_id = self._WriteBatch(batch, next_id, picture_drinks)
+      if progress:
+        progress(pos + len(batch))
+
+    with transaction.commit_on_success():
+      cursor = connection.cursor()
+      for sql in connection.ops.sequence_reset_sql(no_style(),
+          [models.DrinkingSession]):
+        cursor.execute(sql)
+
+  def _WriteBatch(self, batch, next_id, picture_drinks):
+    sessions = []
+    chunks = []
+    for session in batch:
+      session.id = next_id
+      next_id += 1
+      sessions.append(models.DrinkingSession(id=session.id,
+          start_time=session.start_time, end_time=session.end_time,
+          volume_ml=session.volume_ml))
+      chunks.extend(_ChunkRecords(session.id, session))
+
+    models.DrinkingSession.objects.bulk_create(sessions)
+    _BulkCreate(chunks)
+
+    for session in batch:
+      picture_ids = []
+      for i in xrange(0, len(session.drink_ids), 500):
+        drink_ids = session.drink_ids[i:i+500]
+        models.Drink.objects.filter(id__in=drink_ids).update(
+            session=session.id)
+        models.SystemEvent.objects.filter(drink__in=drink_ids).update(
+            session=session.id)
+        for drink_id in drink_ids:
+          picture_ids.extend(picture_drinks.get(drink_id, ()))
+      if picture_ids:
+        models.PourPicture.objects.filter(id__in=picture_ids).update(
+            session=session.id)
+
+    # Sessions merged from several old ones keep only their first
+    # session_started event.
+    started = models.SystemEvent.objects.filter(kind='session_started',
+        session__in=[session.id for session in batch])
+    seen = set()
+    duplicate_ids = []
+    for event_id, session_id in started.order_by('time', 'id').values_list(
+        'id', 'session'):
+      if session_id in seen:
+        duplicate_ids.append(event_id)
+      seen.add(session_id)
+    if duplicate_ids:
+      models.SystemEvent.objects.filter(id__in=duplicate_ids).delete()
+    return next_id
+
+
+def DeleteAllSessions():
+  """Deletes all sessions, their chunks and stats, detaching drinks, pictures
+  and events."""
+  with transaction.commit_on_success():
+    models.Drink.objects.exclude(session=None).update(session=None)
+    models.PourPicture.objects.exclude(session=None).update(session=None)
+    # Events would otherwise be deleted along with their sessions.
+    models.SystemEvent.objects.exclude(session=None).update(session=None)
+    models.SessionStats.objects.all().delete()
+    models.SessionChunk.objects.all().delete()
+    models.UserSessionChunk.objects.all().delete()
+    models.KegSessionChunk.objects.all().delete()
+    models.DrinkingSession.objects.all().delete()
+
+
+def RebuildSessionStats(batch_size=100, progress=None):
+  """Builds the stats of every session from its drinks.
+
+  Existing session stats must already have been deleted.  If given,
+  `progress` is called with the number of sessions written so far.
+  """
+  regen = stats.StatsRegenerator(scopes=('sessions',))
+  drinks = models.Drink.objects.valid().exclude(session=None).order_by('id')
+  for row in drinks.values_list(*stats.StatsRegenerator.FIELDS).iterator():
+    regen.AddDrink(*row)
+
+  records = []
+  for session_id, acc in regen.sessions.iteritems():
+    records.append(models.SessionStats(session_id=session_id,
+        stats_proto=acc.Build()))
+  for pos in xrange(0, len(records), batch_size):
+    with transaction.commit_on_success():
+      models.SessionStats.objects.bulk_create(records[pos:pos+batch_size])
+    if progress:
+      progress(min(pos + batch_size, len(records)))
+  return len(records)
+
+
+def ReassignSessions(sessions, new_drinks=()):
+  """Recomputes the sessions of the drinks in `sessions`, merging or splitting
+  them as their drinks require.
+
+  Only the given sessions and the stats of their drinks' scopes are updated;
+  `sessions` must hold every session which could be merged with them.  The
+  caller must hold the session assignment lock (see DatabaseLock).
+
+  `new_drinks` are saved drinks which have not been post processed, in the
+  order they will be.  Those without a session are being assigned one, and
+  are added to the sessions and their chunks; none are added to stats, which
+  they are added to when post processed.  The `session` and `created_*`
+  attributes of those in the given sessions are set as by
+  DrinkingSession.AssignSessionForDrink.  Drinks queued for post processing
+  (see PostProcessTask) are also new drinks, processed before `new_drinks`;
+  their queued flags are updated.
+  """
+  # Stats and queued drinks are changed too; wait for any worker post
+  # processing drinks (see PostProcessTask).
+  models.DatabaseLock.Acquire(models.PostProcessTask.PROCESSING_LOCK)
+  session_delta = models.SiteSettings.get().GetSessionTimeoutDelta()
+  old_starts = dict((s.id, s.start_time) for s in sessions)
+  new_drink_ids = set(d.id for d in new_drinks)
+  # Locking reads, which see drinks committed while waiting for the lock; see
+  # DrinkingSession._AssignSessionForDrink.
+  tasks = models.PostProcessTask.objects.select_for_update().filter(
+      drink__session__in=old_starts.keys()).exclude(drink__in=new_drink_ids)
+  tasks = list(tasks.select_related('drink'))
+  new_drinks = [task.GetDrink() for task in tasks] + list(new_drinks)
+  new_drink_ids.update(task.drink_id for task in tasks)
+
+  fields = SessionRegenerator.FIELDS + ('session',)
+  drinks = models.Drink.objects.valid().select_for_update().filter(
+      session__in=old_starts.keys())
+  rows = list(drinks.values_list(*fields))
+  old_session = dict((row[0], row[-1]) for row in rows)
+  for drink in new_drinks:
+    if drink.session_id is None:
+      rows.append((drink.id, drink.time, drink.user_id, drink.keg_id,
+          drink.volume_ml, None))
+  rows.sort(key=lambda row: (row[1], row[0]))
+
+  regen = SessionRegenerator(session_delta)
+  for row in rows:
+    regen.AddDrink(*row[:-1])
+
+  # Each new session keeps the id of the earliest old session among its
+  # drinks, unless an earlier one kept it.  Sessions of post processed drinks
+  # come first, as they have events.
+  unclaimed = set(old_starts)
+  new_session = {}
+  for group in regen.sessions:
+    group.id = None
+    for drink_id in sorted(group.drink_ids, key=new_drink_ids.__contains__):
+      session_id = old_session.get(drink_id)
+      if session_id in unclaimed:
+        group.id = session_id
+        unclaimed.discard(session_id)
+        break
+    if group.id is None:
+      group.id = models.DrinkingSession.objects.create(
+          start_time=group.start_time, end_time=group.end_time,
+          volume_ml=group.volume_ml).id
+    else:
+      models.DrinkingSession.objects.filter(id=group.id).update(
+          start_time=group.start_time, end_time=group.end_time,
+          volume_ml=group.volume_ml)
+    for drink_id in group.drink_ids:
+      new_session[drink_id] = group
+
+  # Move drinks, their pictures and events, and rewrite chunks.
+  session_ids = set(old_starts) | set(g.id for g in regen.sessions)
+  models.SystemEvent.objects.filter(session__in=unclaimed,
+      kind='session_started').delete()
+  for group in regen.sessions:
+    models.Drink.objects.filter(id__in=group.drink_ids).update(
+        session=group.id)
+    models.PourPicture.objects.filter(drink__in=group.drink_ids).update(
+        session=group.id)
+    models.SystemEvent.objects.filter(drink__in=group.drink_ids).update(
+        session=group.id)
+  models.Drink.objects.filter(session__in=unclaimed).update(session=None)
+  for model in (models.SessionChunk, models.UserSessionChunk,
+      models.KegSessionChunk):
+    model.objects.filter(session__in=session_ids).delete()
+  chunks = []
+  for group in regen.sessions:
+    chunks.extend(_ChunkRecords(group.id, group))
+  _BulkCreate(chunks)
+  models.DrinkingSession.objects.filter(id__in=unclaimed).delete()
+
+  # Volume by day of week counts drinks on their session's start day, and
+  # session counts change as sessions merge or split.
+  scope_changes = {}
+  for drink_id, time, user_id, keg_id, volume_ml, session_id in rows:
+    if drink_id in new_drink_ids:
+      continue
+    old_weekday = old_starts[session_id].strftime('%w')
+    group = new_session[drink_id]
+    new_weekday = group.start_time.strftime('%w')
+    scopes = [(models.SystemStats, {})]
+    if user_id:
+      scopes.append((models.UserStats, {'user': user_id}))
+    if keg_id:
+      scopes.append((models.KegStats, {'keg': keg_id}))
+    for model, scope in scopes:
+      key = (model, tuple(scope.items()))
+      weekdays, old_ids, new_ids = scope_changes.setdefault(key,
+          ({}, set(), set()))
+      if old_weekday != new_weekday:
+        weekdays[old_weekday] = weekdays.get(old_weekday, 0) - volume_ml
+        weekdays[new_weekday] = weekdays.get(new_weekday, 0) + volume_ml
+      old_ids.add(session_id)
+      new_ids.add(group.id)
+  for (model, scope), (weekdays, old_ids, new_ids) in scope_changes.iteritems():
+    sessions_delta = len(new_ids) - len(old_ids)
+    if not weekdays and not sessions_delta:
+      continue
+    for record in model.objects.filter(**dict(scope))[:1]:
+      previous = record._Previous()
+      if previous:
+        stats.ApplySessionChanges(previous, weekdays, sessions_delta)
+        record.save()
+
+  # Session stats and leaderboards are small; rebuild them.
+  drink_qs = models.Drink.objects.valid().exclude(id__in=new_drink_ids)
+  models.LeaderboardEntry.objects.filter(scope__in=['session:%s' % session_id
+      for session_id in session_ids]).delete()
+  last_drink_ids = {}
+  user_volumes = {}
+  for drink_id, time, user_id, keg_id, volume_ml, session_id in rows:
+    if drink_id in new_drink_ids:
+      continue
+    group = new_session[drink_id]
+    last_drink_ids[group] = max(drink_id, last_drink_ids.get(group, 0))
+    if user_id:
+      volumes = user_volumes.setdefault(group, {})
+      volumes[user_id] = volumes.get(user_id, 0) + volume_ml
+  entries = []
+  for group in regen.sessions:
+    last_drink_id = last_drink_ids.get(group)
+    for user_id, volume_ml in user_volumes.get(group, {}).iteritems():
+      if volume_ml >= stats.MIN_VOLUME_ML:
+        entries.append(models.LeaderboardEntry(scope='session:%s' % group.id,
+            user_id=user_id, volume_ml=volume_ml))
+    records = models.SessionStats.objects.filter(session=group.id)
+    if last_drink_id is None:
+      records.delete()
+      continue
+    records = list(records[:1]) or [models.SessionStats(session_id=group.id)]
+    builder = models.SessionStats.STATS_BUILDER(
+        drink=models.Drink.objects.get(id=last_drink_id), drink_qs=drink_qs)
+    records[0].stats_proto = builder.Build()
+    records[0].save()
+  models.LeaderboardEntry.objects.bulk_create(entries)
+
+  # A new drink opens its session, or chunk, unless it holds a drink which is
+  # already post processed or will be before the new one.
+  order = dict((drink.id, i) for i, drink in enumerate(new_drinks))
+  for drink in new_drinks:
+    group = new_session.get(drink.id)
+    if group is None:
+      continue
+    others = [row for row in rows if new_session[row[0]] is group and
+        order.get(row[0], -1) < order[drink.id]]
+    drink.session = models.DrinkingSession.objects.get(id=group.id)
+    drink.created_session = not others
+    drink.created_user_chunk = not any(row[2] == drink.user_id
+        for row in others)
+    drink.created_keg_chunk = not any(row[3] == drink.keg_id
+        for row in others)
+  for task in tasks:
+    task.SetFlags(task.drink)
+    task.save()
+
+
+def _NeedsSplit(session_id, session_delta):
+  """Returns True if the drinks of a session have a gap of at least
+  `session_delta`."""
+  times = models.Drink.objects.valid().filter(session=session_id).order_by(
+      'time').values_list('time', flat=True)
+  last = None
+  for time in times.iterator():
+    if last is not None and time - last >= session_delta:
+      return True
+    last = time
+  return False
+
+
+# Models with session end times, the fields identifying their rows, and the
+# drink fields those rows are keyed by.
+_END_TIME_KEYS = (
+  (models.DrinkingSession, ('id',), ('session',)),
+  (models.SessionChunk, ('session', 'user', 'keg'),
+      ('session', 'user', 'keg')),
+  (models.UserSessionChunk, ('session', 'user'), ('session', 'user')),
+  (models.KegSessionChunk, ('session', 'keg'), ('session', 'keg')),
+)
+
+
+def _ResetEndTimes(change):
+  """Ends every session and chunk at the time of its last drink plus the new
+  timeout.
+
+  Rows which already end there, such as those poured into since the change
+  was saved, are left alone, so this can be run more than once.
+  """
+  session_delta = datetime.timedelta(minutes=change.new_timeout_minutes)
+  drinks = models.Drink.objects.valid().exclude(session=None).order_by()
+  with transaction.commit_on_success():
+    models.DatabaseLock.Acquire(models.DrinkingSession.ASSIGNMENT_LOCK)
+    for model, keys, drink_keys in _END_TIME_KEYS:
+      end_times = {}
+      for row in drinks.values(*drink_keys).annotate(last=Max('time')):
+        key = tuple(row[k] for k in drink_keys)
+        end_times[key] = row['last'] + session_delta
+      rows = model.objects.values_list('id', 'end_time', *keys)
+      for row in list(rows.iterator()):
+        end_time = end_times.get(row[2:])
+        if end_time is not None and end_time != row[1]:
+          model.objects.filter(id=row[0]).update(end_time=end_time)
+    change.shifted = True
+    change.save()
+
+
+def _Reassign(cluster):
+  with transaction.commit_on_success():
+    models.DatabaseLock.Acquire(models.DrinkingSession.ASSIGNMENT_LOCK)
+    ReassignSessions(list(models.DrinkingSession.objects.filter(
+        id__in=cluster)))
+
+
+def ApplyTimeoutChange(change, checkpoint_every=100, progress=None):
+  """Recomputes session boundaries after the session timeout changed.
+
+  Session end times are first reset to their last drink plus the new
+  timeout.  Sessions are
+  then scanned in start order, and only those which now overlap (and must be
+  merged) or which contain a gap as long as the timeout (and must be split)
+  are recomputed, with ReassignSessions.  `change.position` is saved every
+  `checkpoint_every` sessions, so an interrupted run resumes where it left
+  off.  If given, `progress` is called as progress(pos, total).
+  """
+  if not change.shifted:
+    _ResetEndTimes(change)
+
+  # If the timeout changed again, sessions are recomputed by the last change.
+  later = models.SessionTimeoutChange.objects.filter(id__gt=change.id)
+  if not later.exists():
+    session_delta = models.SiteSettings.get().GetSessionTimeoutDelta()
+    rows = models.DrinkingSession.objects.order_by('start_time', 'id')
+    if change.position:
+      rows = rows.filter(start_time__gte=change.position)
+    # Read ahead, since recomputing sessions writes to the same table.
+    rows = list(rows.values_list('id', 'start_time', 'end_time'))
+    total = len(rows)
+
+    pos = 0
+    unsaved = 0
+    cluster = []
+    for session_id, start_time, end_time in rows:
+      if cluster and start_time >= cluster_end:
+        if len(cluster) > 1 or needs_split:
+          _Reassign(cluster)
+        unsaved += len(cluster)
+        if unsaved >= checkpoint_every:
+          change.position = start_time
+          change.save()
+          unsaved = 0
+        cluster = []
+      if not cluster:
+        cluster_end = end_time
+        needs_split = False
+      cluster.append(session_id)
+      cluster_end = max(cluster_end, end_time)
+      if end_time - start_time >= 2 * session_delta:
+        needs_split = needs_split or _NeedsSplit(session_id, session_delta)
+      pos += 1
+      if progress:
+        progress(pos, total)
+    if cluster and (len(cluster) > 1 or needs_split):
+      _Reassign(cluster)
+
+  change.finished_time = timezone.now()
+  change.save()
+
+
+def ApplyTimeoutChanges(checkpoint_every=100, progress=None):
+  """Applies all pending session timeout changes, in order."""
+  changes = models.SessionTimeoutChange.objects.filter(finished_time=None)
+  for change in changes.order_by('id'):
+    ApplyTimeoutChange(change, checkpoint_every, progress)
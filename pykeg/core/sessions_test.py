@@ -0,0 +1,151 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import threading
+
+from django.db import connection
+from django.test import TransactionTestCase
+
+from kegbot.api.protoutil import ProtoMessageToDict
+
+from . import backend
+from . import models
+from . import sessions
+from .testutils import make_datetime
+
+class SessionRegeneratorTestCase(TransactionTestCase):
+  reset_sequences = True
+
+  def setUp(self):
+    self.backend = backend.KegbotBackend()
+    for name in ('user1', 'user2'):
+      self.backend.CreateNewUser(name)
+    self.backend.CreateTap('tap1', 'kegboard.flow0', ml_per_tick=1/2200.0)
+
+  def _snapshot(self):
+    """Returns sessions, chunks and drink assignments, keyed by session
+    start time rather than id."""
+    def stats(stats_proto):
+      # Repeated fields are ordered as built, incrementally or not.
+      d = ProtoMessageToDict(stats_proto)
+      return sorted((k, sorted(v) if isinstance(v, list) else v)
+          for k, v in d.iteritems())
+    def chunks(qs, *fields):
+      return sorted((c.session.start_time,) + tuple(getattr(c, f) for f in fields)
+          + (c.start_time, c.end_time, c.volume_ml) for c in qs)
+    return (
+      sorted((s.start_time, s.end_time, s.volume_ml)
+          for s in models.DrinkingSession.objects.all()),
+      chunks(models.SessionChunk.objects.all(), 'user_id', 'keg_id'),
+      chunks(models.UserSessionChunk.objects.all(), 'user_id'),
+      chunks(models.KegSessionChunk.objects.all(), 'keg_id'),
+      sorted((d.id, d.session.start_time) for d in models.Drink.objects.all()),
+      sorted((e.kind, e.drink_id, e.session.start_time)
+          for e in models.SystemEvent.objects.exclude(session=None)),
+      sorted((s.session.start_time, stats(s.stats_proto))
+          for s in models.SessionStats.objects.all()),
+    )
+
+  def testMatchesAssignSessionForDrink(self):
+    pour_time = make_datetime(2011, 05, 01, 12, 00)
+    pours = (
+      ('user1', 0, 100),
+      ('user2', 30, 400),
+      (None, 60, 200),
+      ('user1', 6 * 60, 300),  # Starts a new session.
+      ('user1', 6 * 60 + 10, 50),
+      ('user2', 24 * 60, 100),  # Starts a new session.
+    )
+    for username, minutes, volume_ml in pours:
+      self.backend.RecordDrink('kegboard.flow0', ticks=volume_ml,
+          volume_ml=volume_ml, username=username,
+          pour_time=pour_time + datetime.timedelta(minutes=minutes))
+    expected = self._snapshot()
+    self.assertEquals(3, len(expected[0]))
+    self.assertEquals(3, len(expected[6]))
+    event_count = models.SystemEvent.objects.count()
+
+    sessions.DeleteAllSessions()
+    self.assertEquals(0, models.DrinkingSession.objects.count())
+    self.assertEquals(event_count, models.SystemEvent.objects.count())
+
+    delta = models.SiteSettings.get().GetSessionTimeoutDelta()
+    regen = sessions.SessionRegenerator(delta)
+    drinks = models.Drink.objects.valid().order_by('time', 'id')
+    for row in drinks.values_list(*sessions.SessionRegenerator.FIELDS):
+      regen.AddDrink(*row)
+    regen.Write(batch_size=2)
+    self.assertEquals(3, sessions.RebuildSessionStats(batch_size=2))
+    self.assertEquals(expected, self._snapshot())
+    self.assertEquals(event_count, models.SystemEvent.objects.count())
+
+
+class ConcurrentSessionAssignmentTestCase(TransactionTestCase):
+  """Records drinks from several threads at once, each with its own database
+  connection."""
+  reset_sequences = True
+
+  NUM_THREADS = 8
+  DRINKS_PER_THREAD = 5
+
+  def setUp(self):
+    if connection.settings_dict['NAME'] in ('', ':memory:'):
+      # Each thread would get its own, empty, in-memory database.
+      self.skipTest('Needs a file test database; set TEST_NAME in DATABASES.')
+    models.KegbotSite.get()  # create the site
+    self.backend = backend.KegbotBackend()
+    self.users = [self.backend.CreateNewUser('user%i' % i)
+        for i in range(self.NUM_THREADS)]
+    self.backend.CreateTap('tap1', 'kegboard.flow0', ml_per_tick=1/2200.0)
+
+  def _pour(self, start, user, errors):
+    try:
+      start.wait()
+      for i in range(self.DRINKS_PER_THREAD):
+        self.backend.RecordDrink('kegboard.flow0', ticks=100, volume_ml=100,
+            username=user.username, do_postprocess=False)
+    except Exception, e:
+      errors.append(e)
+    finally:
+      connection.close()
+
+  def testParallelRecordDrink(self):
+    start = threading.Event()
+    errors = []
+    threads = [threading.Thread(target=self._pour, args=(start, user, errors))
+        for user in self.users]
+    for t in threads:
+      t.start()
+    start.set()
+    for t in threads:
+      t.join()
+    self.assertEquals([], errors)
+
+    num_drinks = self.NUM_THREADS * self.DRINKS_PER_THREAD
+    self.assertEquals(num_drinks, models.Drink.objects.count())
+    self.assertEquals(1, models.DrinkingSession.objects.count())
+    session = models.DrinkingSession.objects.get()
+    self.assertEquals(num_drinks * 100, session.volume_ml)
+    self.assertEquals(num_drinks, session.drinks.count())
+
+    chunks = session.user_chunks.all()
+    self.assertEquals(self.NUM_THREADS, len(chunks))
+    for chunk in chunks:
+      self.assertEquals(self.DRINKS_PER_THREAD * 100, chunk.volume_ml)
+    self.assertEquals(num_drinks * 100, session.keg_chunks.get().volume_ml)
@@ -23,69 +23,326 @@ import inspect
 import itertools
 import logging
 
+from django.db.models import Max
+
 from kegbot.api import models_pb2
 
+# Registry of stat methods, keyed by (builder class, REVISION).  Each value is
+# a (stats, reverse_stats) pair of dicts mapping stat name to method name;
+# see StatsBuilder._Registry().
 STAT_MAP = {}
 
-def stat(statname):
+# Volumes smaller than this, left over after removing a drink, are treated as
+# zero (float subtraction rarely returns to exactly 0.0).
+MIN_VOLUME_ML = 0.001
+
+def stat(statname, depends=()):
+  """Marks a method which computes a stat.
+
+  `depends` names other stats which must be maintained alongside this one,
+  because the incremental update reads their previous values.
+  """
   def decorate(f):
     setattr(f, 'statname', statname)
+    setattr(f, 'depends', tuple(depends))
+    return f
+  return decorate
+
+def reverse_stat(statname):
+  """Marks a method which removes a single drink's contribution to a stat."""
+  def decorate(f):
+    setattr(f, 'reverse_statname', statname)
     return f
   return decorate
 
+def _ScalarFields(message):
+  """Returns a copy of the fields of `message` which are not repeated."""
+  result = message.__class__()
+  for field, value in message.ListFields():
+    if field.label == field.LABEL_REPEATED:
+      continue
+    if field.type == field.TYPE_MESSAGE:
+      getattr(result, field.name).CopyFrom(value)
+    else:
+      setattr(result, field.name, value)
+  return result
+
 class StatsBuilder:
-  def __init__(self, drink, drink_qs, previous=None):
+  REVISION = 0
+
+  def __init__(self, drink, drink_qs, previous=None, indexes=None):
+    """Stats are updated in place in `previous`, if given.
+
+    `indexes` is a dict in which indexes of the repeated fields of `previous`
+    are kept (see _Index()).  Callers updating the same stats with several
+    drinks pass the same dict each time, so the indexes are built once.
+    """
     self.drink = drink
     self.drink_qs = drink_qs
     self.previous = previous
-    self.STAT_MAP = {}
-    for name, fn in inspect.getmembers(self, inspect.ismethod):
-      if hasattr(fn, 'statname'):
-        self.STAT_MAP[fn.statname] = fn
+    if indexes is None:
+      indexes = {}
+    self._indexes = indexes
+    self.STAT_MAP, self.REVERSE_STAT_MAP = self._Registry()
+
+  @classmethod
+  def _Registry(cls):
+    """Returns the (stats, reverse_stats) registry entry for this class,
+    discovering its stat methods on first use."""
+    key = (cls, cls.REVISION)
+    entry = STAT_MAP.get(key)
+    if entry is None:
+      stats, reverse_stats = {}, {}
+      for name, fn in inspect.getmembers(cls, inspect.ismethod):
+        if hasattr(fn, 'statname'):
+          stats[fn.statname] = name
+        if hasattr(fn, 'reverse_statname'):
+          reverse_stats[fn.reverse_statname] = name
+      entry = STAT_MAP[key] = (stats, reverse_stats)
+    return entry
+
+  @classmethod
+  def StatNames(cls):
+    """Returns the names of all stats computed by this builder."""
+    return sorted(cls._Registry()[0])
+
+  @classmethod
+  def Dependencies(cls, statname):
+    """Returns the names of stats that `statname` directly depends on."""
+    return getattr(cls, cls._Registry()[0][statname]).depends
+
+  @classmethod
+  def ResolveStatNames(cls, statnames=None):
+    """Returns the set of stats needed to compute `statnames` (all stats if
+    None), including their dependencies."""
+    if statnames is None:
+      return set(cls._Registry()[0])
+    result = set()
+    pending = list(statnames)
+    while pending:
+      statname = pending.pop()
+      if statname not in result:
+        result.add(statname)
+        pending.extend(cls.Dependencies(statname))
+    return result
 
   def _AllDrinks(self):
     return self.drink_qs
 
-  def Build(self):
+  def Build(self, statnames=None):
+    """Builds stats for `drink`, incrementally if `previous` is given.
+
+    If `statnames` is given, only those stats and their dependencies are
+    computed; other stats are copied from `previous` unchanged.
+    """
     self.stats = models_pb2.Stats()
     if not self.drink:
       return self.stats
+    self.through_id = self.drink.id
+    if self.previous:
+      self.through_id = max(self.through_id, self.previous.last_drink_id)
     self.drinks = self._AllDrinks()
+    self._query_cache = {}
+    if self.previous:
+      self._UpdateInPlace()
+    for statname in self.ResolveStatNames(statnames):
+      getattr(self, self.STAT_MAP[statname])()
+    return self.stats
+
+  def Remove(self, statnames=None):
+    """Returns `previous` with the contribution of `drink` removed.
+
+    `drink` should hold the values the drink had when it was added to
+    `previous`.  If there are no previous stats or any stat has no reverse
+    method, the stats are instead rebuilt from the remaining drinks in scope.
+    `statnames` limits the stats updated, as in Build().
+    """
+    self.stats = models_pb2.Stats()
+    if not self.drink:
+      return self.stats
+    if self.previous:
+      self.through_id = self.previous.last_drink_id
+    else:
+      self.through_id = self.drink_qs.aggregate(last=Max('id'))['last'] or 0
+    self.drinks = self._AllDrinks().exclude(id=self.drink.id)
+    self._query_cache = {}
+
+    statnames = self.ResolveStatNames(statnames)
+    if not self.previous or statnames - set(self.REVERSE_STAT_MAP):
+      return self._RebuildRemaining(statnames)
+    if self.previous.total_pours <= 1:
+      return self.stats
+
+    self._UpdateInPlace()
+    for statname in statnames:
+      getattr(self, self.REVERSE_STAT_MAP[statname])()
+    return self.stats
+
+  def _UpdateInPlace(self):
+    """Makes `previous` the stats being built.  The stat methods read
+    previous values from `previous`, which becomes a copy of the scalar
+    fields only, so that building does not copy the repeated fields."""
+    self.stats = self.previous
+    self.previous = _ScalarFields(self.stats)
+
+  def _Index(self, fieldname, keyname):
+    """Returns a dict of the entries of repeated field `fieldname`, keyed by
+    their `keyname`.
+
+    The index is built on first use and kept in `indexes` for later builds;
+    entries added or removed must be added to or removed from it too.
+    """
+    index = self._indexes.get(fieldname)
+    if index is None:
+      entries = getattr(self.stats, fieldname)
+      if keyname:
+        index = dict((getattr(entry, keyname), entry) for entry in entries)
+      else:
+        index = set(entries)
+      self._indexes[fieldname] = index
+    return index
+
+  def _RebuildRemaining(self, statnames):
+    last_drinks = self.drinks.order_by('-id')[:1]
+    if not last_drinks:
+      return self.stats
+    builder = self.__class__(drink=last_drinks[0],
+        drink_qs=self.drink_qs.exclude(id=self.drink.id))
+    rebuilt = builder.Build(statnames)
     if self.previous:
-      self.stats.MergeFrom(self.previous)
-    for statname, fn in self.STAT_MAP.iteritems():
-      fn()
+      # Keep the stats which were not asked for.  Stat names are the names of
+      # the fields they fill.
+      self._UpdateInPlace()
+      for statname in statnames:
+        self.stats.ClearField(statname)
+        self._indexes.pop(statname, None)
+    self.stats.MergeFrom(rebuilt)
     return self.stats
 
 
+class _Sums:
+  """Volumes of drinks, added in the order the drinks are given."""
+  def __init__(self):
+    self.total_volume_ml = 0
+    self.total_pours = 0
+    self.by_username = {}
+    self.by_weekday = {}
+    self.by_year = {}
+    self.sessions = set()
+
+  def AddDrink(self, volume_ml, username, time, session_id, start_time):
+    self.total_volume_ml += volume_ml
+    self.total_pours += 1
+    self.by_username[username] = self.by_username.get(username, 0) + volume_ml
+    self.by_year[time.year] = self.by_year.get(time.year, 0) + volume_ml
+    self.sessions.add(session_id)
+    if start_time is not None:
+      weekday = start_time.strftime('%w')
+      self.by_weekday[weekday] = self.by_weekday.get(weekday, 0.0) + volume_ml
+
+
 class BaseStatsBuilder(StatsBuilder):
-  """Builder which generates a variety of stats from object information."""
+  """Builder which generates a variety of stats from object information.
+
+  Full rebuilds (no `previous` stats) are computed in a single pass over a
+  column-only value list of the drinks, and the largest drink is found with
+  one query, rather than by loading Drink instances.  Query results shared
+  by several stats are computed once per Build().
+  """
+
+  # Drink attribute set by session assignment when the drink opened a new
+  # session for this builder's scope.
+  SESSION_CREATED_ATTR = 'created_session'
+
+  def _Cached(self, name, fn):
+    if name not in self._query_cache:
+      self._query_cache[name] = fn()
+    return self._query_cache[name]
+
+  def _Sums(self):
+    """Returns a _Sums of the drinks, computed in one pass over the drinks
+    in drink order.
+
+    Volumes are not summed by the database.  The order in which SUM() adds
+    rows is unspecified, and SQLite since 3.43 uses compensated summation,
+    so database totals differ in their last bits from the totals which the
+    incremental builders keep by adding each drink in turn.  A rebuild would
+    then change stored stats which are correct.  Only one row of columns per
+    drink is read, and only the sums are kept.
+    """
+    def query():
+      sums = _Sums()
+      qs = self.drinks.order_by('id').values_list('volume_ml',
+          'user__username', 'time', 'session', 'session__start_time')
+      for row in qs.iterator():
+        sums.AddDrink(*row)
+      return sums
+    return self._Cached('sums', query)
+
+  def _Totals(self):
+    """Returns (total volume, number of drinks)."""
+    sums = self._Sums()
+    return sums.total_volume_ml, sums.total_pours
+
+  def _Greatest(self):
+    """Returns (id, volume_ml) of the largest drink, or (0, 0) if none."""
+    def query():
+      res = self.drinks.order_by('-volume_ml').values_list('id', 'volume_ml')[:1]
+      if res:
+        return res[0]
+      return 0, 0
+    return self._Cached('greatest', query)
+
+  def _VolumeByUsername(self):
+    """Returns (username, volume_ml) pairs; username is None for guests."""
+    return self._Sums().by_username.items()
+
+  def _VolumeByWeekday(self):
+    """Returns (weekday, volume_ml) pairs, by session start day."""
+    return self._Sums().by_weekday.items()
+
+  def _VolumeByYear(self):
+    """Returns (year, volume_ml) pairs."""
+    return self._Sums().by_year.items()
 
   @stat('last_drink_id')
   def LastDrinkId(self):
-    self.stats.last_drink_id = self.drink.id
+    self.stats.last_drink_id = self.through_id
+
+  @reverse_stat('last_drink_id')
+  def RemoveLastDrinkId(self):
+    if self.drink.id == self.previous.last_drink_id:
+      self.stats.last_drink_id = self.drinks.order_by('-id').values_list('id', flat=True)[0]
 
   @stat('total_volume_ml')
   def TotalVolume(self):
     if not self.previous:
-      self.stats.total_volume_ml = sum(drink.volume_ml for drink in self.drinks)
+      self.stats.total_volume_ml = self._Totals()[0]
     else:
       self.stats.total_volume_ml += self.drink.volume_ml
 
+  @reverse_stat('total_volume_ml')
+  def RemoveTotalVolume(self):
+    self.stats.total_volume_ml -= self.drink.volume_ml
+
   @stat('total_pours')
   def TotalPours(self):
     if not self.previous:
-      self.stats.total_pours = self.drinks.count()
+      self.stats.total_pours = self._Totals()[1]
     else:
       self.stats.total_pours += 1
 
-  @stat('average_volume_ml')
+  @reverse_stat('total_pours')
+  def RemoveTotalPours(self):
+    self.stats.total_pours -= 1
+
+  @stat('average_volume_ml', depends=('total_volume_ml', 'total_pours'))
   def AverageVolume(self):
     if not self.previous:
-      count = self.drinks.count()
+      total, count = self._Totals()
       average = 0.0
       if count:
-        average = sum(drink.volume_ml for drink in self.drinks) / float(count)
+        average = total / float(count)
       self.stats.average_volume_ml = average
     else:
       vol = self.previous.total_volume_ml
@@ -94,30 +351,38 @@ class BaseStatsBuilder(StatsBuilder):
       count += 1
       self.stats.average_volume_ml = vol / float(count)
 
+  @reverse_stat('average_volume_ml')
+  def RemoveAverageVolume(self):
+    vol = self.previous.total_volume_ml - self.drink.volume_ml
+    count = self.previous.total_pours - 1
+    self.stats.average_volume_ml = vol / float(count)
+
   @stat('greatest_volume_ml')
   def GreatestVolume(self):
     if not self.previous:
-      res = 0
-      drinks = self.drinks.order_by('-volume_ml')
-      if drinks.count():
-        res = drinks[0].volume_ml
-      self.stats.greatest_volume_ml = res
+      self.stats.greatest_volume_ml = self._Greatest()[1]
     else:
       if self.drink.volume_ml > self.previous.greatest_volume_ml:
         self.stats.greatest_volume_ml = self.drink.volume_ml
 
-  @stat('greatest_volume_id')
+  @reverse_stat('greatest_volume_ml')
+  def RemoveGreatestVolume(self):
+    if self.drink.id == self.previous.greatest_volume_id:
+      self.stats.greatest_volume_ml = self._Greatest()[1]
+
+  @stat('greatest_volume_id', depends=('greatest_volume_ml',))
   def GreatestVolumeId(self):
     if not self.previous:
-      res = 0
-      drinks = self.drinks.order_by('-volume_ml')
-      if drinks.count():
-        res = drinks[0].id
-      self.stats.greatest_volume_id = res
+      self.stats.greatest_volume_id = self._Greatest()[0]
     else:
       if self.drink.volume_ml > self.previous.greatest_volume_ml:
         self.stats.greatest_volume_id = self.drink.id
 
+  @reverse_stat('greatest_volume_id')
+  def RemoveGreatestVolumeId(self):
+    if self.drink.id == self.previous.greatest_volume_id:
+      self.stats.greatest_volume_id = self._Greatest()[0]
+
   @stat('volume_by_day_of_week')
   def VolumeByDayOfweek(self):
     result = self.stats.volume_by_day_of_week
@@ -125,80 +390,118 @@ class BaseStatsBuilder(StatsBuilder):
       # Note: uses the session's start_time, rather than the drink's. This
       # causes late-night sessions to be reported for the day on which they were
       # started.
-      volmap = {}
-      for drink in self.drinks:
-        weekday = drink.session.start_time.strftime('%w')
-        if weekday not in volmap:
-          volmap[weekday] = 0.0
-        volmap[weekday] += drink.volume_ml
-      for weekday, volume_ml in volmap.iteritems():
+      for weekday, volume_ml in self._VolumeByWeekday():
         if volume_ml:
           day = result.add()
           day.weekday = weekday
           day.volume_ml = volume_ml
     else:
       drink_weekday = self.drink.session.start_time.strftime('%w')
-      for message in self.stats.volume_by_day_of_week:
-        if message.weekday == drink_weekday:
-          message.volume_ml += self.drink.volume_ml
-          return
-      message = result.add()
+      index = self._Index('volume_by_day_of_week', 'weekday')
+      message = index.get(drink_weekday)
+      if message is not None:
+        message.volume_ml += self.drink.volume_ml
+        return
+      message = index[drink_weekday] = result.add()
       message.weekday = drink_weekday
       message.volume_ml = self.drink.volume_ml
 
+  @reverse_stat('volume_by_day_of_week')
+  def RemoveVolumeByDayOfweek(self):
+    if not self.drink.session:
+      return
+    drink_weekday = self.drink.session.start_time.strftime('%w')
+    index = self._Index('volume_by_day_of_week', 'weekday')
+    message = index.get(drink_weekday)
+    if message is not None:
+      message.volume_ml -= self.drink.volume_ml
+      if message.volume_ml < MIN_VOLUME_ML:
+        self.stats.volume_by_day_of_week.remove(message)
+        del index[drink_weekday]
+
   @stat('registered_drinkers')
   def RegisteredDrinkers(self):
     if not self.previous:
       drinkers = set()
-      for drink in self.drinks:
-        if drink.user:
-          drinkers.add(str(drink.user.username))
+      for username, volume_ml in self._VolumeByUsername():
+        if username is not None:
+          drinkers.add(str(username))
       self.stats.registered_drinkers.extend(drinkers)
     else:
       if self.drink.user:
-        result = self.stats.registered_drinkers
+        index = self._Index('registered_drinkers', None)
         username = str(self.drink.user.username)
-        if username not in result:
-          result.append(username)
+        if username not in index:
+          self.stats.registered_drinkers.append(username)
+          index.add(username)
+
+  @reverse_stat('registered_drinkers')
+  def RemoveRegisteredDrinkers(self):
+    if self.drink.user:
+      index = self._Index('registered_drinkers', None)
+      username = str(self.drink.user.username)
+      if username in index and not self.drinks.filter(user=self.drink.user).exists():
+        self.stats.registered_drinkers.remove(username)
+        index.remove(username)
 
   @stat('sessions_count')
   def SessionsCount(self):
     if not self.previous:
-      all_sessions = set()
-      for drink in self.drinks:
-        all_sessions.add(drink.session.id)
-      self.stats.sessions_count = len(all_sessions)
-    else:
-      first_drink = self.drink.session.drinks.order_by('id')[0]
-      if self.drink.id == first_drink.id:
+      self.stats.sessions_count = len(self._Sums().sessions)
+    elif self.drink.session:
+      # Session assignment records whether the drink opened a session (or a
+      # chunk of it) for this scope; query only for drinks assigned elsewhere.
+      created = getattr(self.drink, self.SESSION_CREATED_ATTR, None)
+      if created is None:
+        others = self.drinks.filter(session=self.drink.session).exclude(id=self.drink.id)
+        created = not others.exists()
+      if created:
         self.stats.sessions_count += 1
 
+  @reverse_stat('sessions_count')
+  def RemoveSessionsCount(self):
+    if self.drink.session:
+      if not self.drinks.filter(session=self.drink.session).exists():
+        self.stats.sessions_count -= 1
+
   @stat('volume_by_year')
   def VolumeByYear(self):
     if not self.previous:
-      volmap = {}
-      for drink in self.drinks:
-        year = drink.time.year
-        volmap[year] = volmap.get(year, 0) + drink.volume_ml
+      volmap = dict(self._VolumeByYear())
       for year, volume_ml in volmap.iteritems():
         rec = self.stats.volume_by_year.add()
         rec.year = year
         rec.volume_ml = volume_ml
     else:
       year = self.drink.time.year
-      for entry in self.stats.volume_by_year:
-        if entry.year == year:
-          entry.volume_ml += self.drink.volume_ml
-          return
-      rec = self.stats.volume_by_year.add()
+      index = self._Index('volume_by_year', 'year')
+      entry = index.get(year)
+      if entry is not None:
+        entry.volume_ml += self.drink.volume_ml
+        return
+      rec = index[year] = self.stats.volume_by_year.add()
       rec.year = year
       rec.volume_ml = self.drink.volume_ml
 
+  @reverse_stat('volume_by_year')
+  def RemoveVolumeByYear(self):
+    year = self.drink.time.year
+    index = self._Index('volume_by_year', 'year')
+    entry = index.get(year)
+    if entry is not None:
+      entry.volume_ml -= self.drink.volume_ml
+      if entry.volume_ml < MIN_VOLUME_ML:
+        # Years are reported even with zero volume, as long as drinks remain.
+        entry.volume_ml = 0
+        if not self.drinks.filter(time__year=year).exists():
+          self.stats.volume_by_year.remove(entry)
+          del index[year]
+
   @stat('has_guest_pour')
   def HasGuestPour(self):
     if not self.previous:
-      for drink in self.drinks:
-        if not drink.user:
+      for username, volume_ml in self._VolumeByUsername():
+        if username is None:
           self.stats.has_guest_pour = True
           return
       self.stats.has_guest_pour = False
@@ -207,17 +510,19 @@ class BaseStatsBuilder(StatsBuilder):
         if not self.drink.user:
           self.stats.has_guest_pour = True
 
+  @reverse_stat('has_guest_pour')
+  def RemoveHasGuestPour(self):
+    if self.stats.has_guest_pour and not self.drink.user:
+      self.stats.has_guest_pour = self.drinks.filter(user__isnull=True).exists()
+
   @stat('volume_by_drinker')
   def VolumeByDrinker(self):
     if not self.previous:
       result = self.stats.volume_by_drinker
       volmap = {}
-      for drink in self.drinks:
-        if drink.user:
-          u = drink.user.username
-        else:
-          u = ''
-        volmap[u] = volmap.get(u, 0) + drink.volume_ml
+      for username, volume_ml in self._VolumeByUsername():
+        u = username or ''
+        volmap[u] = volmap.get(u, 0) + volume_ml
       for username, volume_ml in volmap.iteritems():
         if volume_ml:
           record = result.add()
@@ -229,20 +534,36 @@ class BaseStatsBuilder(StatsBuilder):
         u = self.drink.user.username
       else:
         u = ''
-      for message in result:
-        if message.username == u:
-          message.volume_ml += self.drink.volume_ml
-          return
-      message = result.add()
+      index = self._Index('volume_by_drinker', 'username')
+      message = index.get(u)
+      if message is not None:
+        message.volume_ml += self.drink.volume_ml
+        return
+      message = index[u] = result.add()
       message.username = u
       message.volume_ml = self.drink.volume_ml
 
+  @reverse_stat('volume_by_drinker')
+  def RemoveVolumeByDrinker(self):
+    result = self.stats.volume_by_drinker
+    if self.drink.user:
+      u = self.drink.user.username
+    else:
+      u = ''
+    index = self._Index('volume_by_drinker', 'username')
+    message = index.get(u)
+    if message is not None:
+      message.volume_ml -= self.drink.volume_ml
+      if message.volume_ml < MIN_VOLUME_ML:
+        result.remove(message)
+        del index[u]
+
 class SystemStatsBuilder(BaseStatsBuilder):
   """Builder of systemwide stats by drink."""
   REVISION = 5
 
   def _AllDrinks(self):
-    qs = self.drink_qs.filter(id__lte=self.drink.id)
+    qs = self.drink_qs.filter(id__lte=self.through_id)
     qs = qs.order_by('id')
     return qs
 
@@ -250,6 +571,7 @@ class SystemStatsBuilder(BaseStatsBuilder):
 class DrinkerStatsBuilder(SystemStatsBuilder):
   """Builder of user-specific stats by drink."""
   REVISION = 5
+  SESSION_CREATED_ATTR = 'created_user_chunk'
 
   def _AllDrinks(self):
     qs = SystemStatsBuilder._AllDrinks(self)
@@ -260,6 +582,7 @@ class DrinkerStatsBuilder(SystemStatsBuilder):
 class KegStatsBuilder(SystemStatsBuilder):
   """Builder of keg-specific stats."""
   REVISION = 5
+  SESSION_CREATED_ATTR = 'created_keg_chunk'
 
   def _AllDrinks(self):
     qs = SystemStatsBuilder._AllDrinks(self)
@@ -277,6 +600,149 @@ class SessionStatsBuilder(SystemStatsBuilder):
     return qs
 
 
+class StatsAccumulator:
+  """Accumulates the stats of a single scope from a stream of drinks.
+
+  Drinks must be added in id order.  The result of Build() matches a full
+  rebuild by BaseStatsBuilder over the same drinks, but no queries are made.
+  """
+  def __init__(self):
+    self.last_drink_id = 0
+    self.total_volume_ml = 0
+    self.total_pours = 0
+    self.greatest_volume_ml = 0
+    self.greatest_volume_id = 0
+    self.volume_by_day_of_week = {}
+    self.registered_drinkers = set()
+    self.sessions = set()
+    self.volume_by_year = {}
+    self.has_guest_pour = False
+    self.volume_by_drinker = {}
+
+  def AddDrink(self, drink_id, volume_ml, time, username, session_id,
+      session_start_time):
+    self.last_drink_id = drink_id
+    self.total_volume_ml += volume_ml
+    self.total_pours += 1
+    if self.total_pours == 1 or volume_ml > self.greatest_volume_ml:
+      self.greatest_volume_ml = volume_ml
+      self.greatest_volume_id = drink_id
+
+    if session_id:
+      # Note: uses the session's start_time, as in VolumeByDayOfweek.
+      weekday = session_start_time.strftime('%w')
+      self.volume_by_day_of_week[weekday] = \
+          self.volume_by_day_of_week.get(weekday, 0.0) + volume_ml
+      self.sessions.add(session_id)
+
+    if username:
+      self.registered_drinkers.add(str(username))
+    else:
+      self.has_guest_pour = True
+      username = ''
+    self.volume_by_drinker[username] = \
+        self.volume_by_drinker.get(username, 0) + volume_ml
+
+    self.volume_by_year[time.year] = \
+        self.volume_by_year.get(time.year, 0) + volume_ml
+
+  def Build(self):
+    stats = models_pb2.Stats()
+    stats.last_drink_id = self.last_drink_id
+    stats.total_volume_ml = self.total_volume_ml
+    stats.total_pours = self.total_pours
+    average = 0.0
+    if self.total_pours:
+      average = self.total_volume_ml / float(self.total_pours)
+    stats.average_volume_ml = average
+    stats.greatest_volume_ml = self.greatest_volume_ml
+    stats.greatest_volume_id = self.greatest_volume_id
+    for weekday, volume_ml in self.volume_by_day_of_week.iteritems():
+      if volume_ml:
+        day = stats.volume_by_day_of_week.add()
+        day.weekday = weekday
+        day.volume_ml = volume_ml
+    stats.registered_drinkers.extend(self.registered_drinkers)
+    stats.sessions_count = len(self.sessions)
+    for year, volume_ml in self.volume_by_year.iteritems():
+      rec = stats.volume_by_year.add()
+      rec.year = year
+      rec.volume_ml = volume_ml
+    stats.has_guest_pour = self.has_guest_pour
+    for username, volume_ml in self.volume_by_drinker.iteritems():
+      if volume_ml:
+        record = stats.volume_by_drinker.add()
+        record.username = username
+        record.volume_ml = volume_ml
+    return stats
+
+
+class StatsRegenerator:
+  """Builds system, keg, user and session stats in a single pass.
+
+  Each drink is fed to the accumulator of every scope it belongs to, so the
+  total work is proportional to the number of drinks.  Rows are tuples of
+  FIELDS, as returned by `Drink.objects.values_list(*FIELDS)`, and must be
+  given in id order.
+
+  `scopes` limits which of the system, kegs, users and sessions stats are
+  accumulated.
+  """
+  FIELDS = ('id', 'volume_ml', 'time', 'user', 'user__username', 'keg',
+      'session', 'session__start_time')
+  SCOPES = ('system', 'kegs', 'users', 'sessions')
+
+  def __init__(self, scopes=SCOPES):
+    self.scopes = frozenset(scopes)
+    self.system = StatsAccumulator()
+    self.kegs = {}
+    self.users = {}
+    self.sessions = {}
+
+  def _Accumulator(self, scope, key):
+    acc = scope.get(key)
+    if acc is None:
+      acc = scope[key] = StatsAccumulator()
+    return acc
+
+  def AddDrink(self, drink_id, volume_ml, time, user_id, username, keg_id,
+      session_id, session_start_time):
+    accumulators = []
+    if 'system' in self.scopes:
+      accumulators.append(self.system)
+    if user_id and 'users' in self.scopes:
+      accumulators.append(self._Accumulator(self.users, user_id))
+    if keg_id and 'kegs' in self.scopes:
+      accumulators.append(self._Accumulator(self.kegs, keg_id))
+    if session_id and 'sessions' in self.scopes:
+      accumulators.append(self._Accumulator(self.sessions, session_id))
+    for acc in accumulators:
+      acc.AddDrink(drink_id, volume_ml, time, username, session_id,
+          session_start_time)
+
+
+def ApplySessionChanges(stats, weekday_volumes, sessions_delta):
+  """Updates `stats` after drinks it counts moved between sessions.
+
+  `weekday_volumes` maps weekdays (as in volume_by_day_of_week) to the volume
+  gained or lost, since drinks are counted on their session's start day.
+  `sessions_delta` is the change in the number of sessions.
+  """
+  index = dict((day.weekday, day) for day in stats.volume_by_day_of_week)
+  for weekday, volume_ml in sorted(weekday_volumes.iteritems()):
+    day = index.get(weekday)
+    if day is None:
+      day = index[weekday] = stats.volume_by_day_of_week.add()
+      day.weekday = weekday
+      day.volume_ml = volume_ml
+    else:
+      day.volume_ml += volume_ml
+    if day.volume_ml < MIN_VOLUME_ML:
+      stats.volume_by_day_of_week.remove(day)
+      del index[weekday]
+  stats.sessions_count += sessions_delta
+
+
 def main():
   from pykeg.core import models
   last_drink = models.Drink.objects.valid().order_by('-id')[0]
@@ -16,13 +16,17 @@
 # You should have received a copy of the GNU General Public License
 # along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
 
+import datetime
+
 from django.test import TransactionTestCase
+from django.test.utils import override_settings
 
 from kegbot.api import models_pb2
 from kegbot.api.protoutil import ProtoMessageToDict
 
 from . import backend
 from . import models
+from . import sessions
 from . import stats
 from .testutils import make_datetime
 
@@ -139,3 +143,561 @@ class StatsTestCase(TransactionTestCase):
         drink_qs=models.Drink.objects.all()).Build()
     self.assertProtosEqual(system_stats_d2, system_stats_d2_inc)
 
+
+  def testRebuildSumsInDrinkOrder(self):
+    # Float sums depend on their order; full rebuilds must add volumes in the
+    # order the incremental builders did.
+    volumes = (0.1, 1e8, 0.2, -1e8 + 0.3, 123.456, 7.89)
+    pour_time = make_datetime(2011, 05, 01, 12, 00)
+    previous = None
+    for i, volume_ml in enumerate(volumes):
+      d = self.backend.RecordDrink('kegboard.flow0', ticks=100,
+          volume_ml=volume_ml, username=('user1', 'user2')[i % 2],
+          pour_time=pour_time + datetime.timedelta(minutes=i),
+          do_postprocess=False)
+      previous = stats.SystemStatsBuilder(d, previous=previous,
+          drink_qs=models.Drink.objects.all()).Build()
+
+    rebuilt = stats.SystemStatsBuilder(d,
+        drink_qs=models.Drink.objects.all()).Build()
+    def unordered(stats_proto):
+      d = ProtoMessageToDict(stats_proto)
+      return dict((k, sorted(v) if isinstance(v, list) else v)
+          for k, v in d.iteritems())
+    self.assertEquals(unordered(previous), unordered(rebuilt))
+    total = 0
+    for volume_ml in volumes:
+      total += volume_ml
+    self.assertEquals(total, rebuilt.total_volume_ml)
+
+  def testIndexesKeptBetweenBuilds(self):
+    pour_time = make_datetime(2011, 05, 01, 12, 00)
+    indexes = {}
+    previous = None
+    for i, username in enumerate(('user1', 'user2', 'user1', 'user3')):
+      d = self.backend.RecordDrink('kegboard.flow0', ticks=100,
+          volume_ml=100 * (i + 1), username=username,
+          pour_time=pour_time + datetime.timedelta(minutes=i),
+          do_postprocess=False)
+      built = stats.SystemStatsBuilder(d, previous=previous,
+          drink_qs=models.Drink.objects.all(), indexes=indexes).Build()
+      if previous is not None:
+        self.assertTrue(built is previous)
+      previous = built
+
+    # The kept index holds the entries of the stats, updated in place.
+    by_drinker = indexes['volume_by_drinker']
+    self.assertEquals(['user1', 'user2', 'user3'], sorted(by_drinker))
+    self.assertTrue(any(entry is by_drinker['user1']
+        for entry in previous.volume_by_drinker))
+    self.assertEquals(400, by_drinker['user1'].volume_ml)
+
+    rebuilt = stats.SystemStatsBuilder(d,
+        drink_qs=models.Drink.objects.all()).Build()
+    self.assertEquals(self._sortedStats(rebuilt), self._sortedStats(previous))
+
+  def testRegenerator(self):
+    pour_time = make_datetime(2011, 05, 01, 12, 00)
+    pours = (
+      ('user1', 0),
+      ('user2', 1),
+      (None, 2),
+      ('user1', 6),  # Starts a new session.
+      ('user3', 7),
+    )
+    for i, (username, hours) in enumerate(pours):
+      self.backend.RecordDrink('kegboard.flow0', ticks=100 * (i + 1),
+          volume_ml=100 * (i + 1), username=username,
+          pour_time=pour_time + datetime.timedelta(hours=hours),
+          do_postprocess=False)
+
+    drinks = models.Drink.objects.valid().order_by('id')
+    regen = stats.StatsRegenerator()
+    for row in drinks.values_list(*stats.StatsRegenerator.FIELDS):
+      regen.AddDrink(*row)
+
+    # Every scope must match a full rebuild by the stats builders.
+    expected = stats.SystemStatsBuilder(drinks.reverse()[0],
+        drink_qs=models.Drink.objects.valid()).Build()
+    self.assertProtosEqual(expected, regen.system.Build())
+
+    self.assertEquals(len(self.users), len(regen.users))
+    for user in self.users:
+      last = drinks.filter(user=user).reverse()[0]
+      expected = stats.DrinkerStatsBuilder(last,
+          drink_qs=models.Drink.objects.valid()).Build()
+      self.assertProtosEqual(expected, regen.users[user.id].Build())
+
+    sessions = models.DrinkingSession.objects.all()
+    self.assertEquals(2, len(sessions))
+    self.assertEquals(len(sessions), len(regen.sessions))
+    for session in sessions:
+      last = drinks.filter(session=session).reverse()[0]
+      expected = stats.SessionStatsBuilder(last,
+          drink_qs=models.Drink.objects.valid()).Build()
+      self.assertProtosEqual(expected, regen.sessions[session.id].Build())
+
+  def _sortedStats(self, stats_proto):
+    """Returns stats as a dict, with repeated fields in a stable order.
+
+    Stats are passed through serialization, as when stored.
+    """
+    stored = models_pb2.Stats()
+    stored.ParseFromString(stats_proto.SerializeToString())
+    d = ProtoMessageToDict(stored)
+    for k, v in d.iteritems():
+      if isinstance(v, list):
+        d[k] = sorted(v)
+    return d
+
+  def assertStoredStatsMatchRebuild(self):
+    drinks = models.Drink.objects.valid().order_by('id')
+    scopes = [(models.SystemStats.objects.all(), stats.SystemStatsBuilder, {})]
+    for user in self.users:
+      scopes.append((models.UserStats.objects.filter(user=user),
+          stats.DrinkerStatsBuilder, {'user': user}))
+    for session in models.DrinkingSession.objects.all():
+      scopes.append((models.SessionStats.objects.filter(session=session),
+          stats.SessionStatsBuilder, {'session': session}))
+    for records, builder_cls, scope in scopes:
+      scope_drinks = drinks.filter(**scope)
+      if not scope_drinks:
+        self.assertEquals(0, len(records))
+        continue
+      expected = builder_cls(scope_drinks.reverse()[0],
+          drink_qs=models.Drink.objects.valid()).Build()
+      self.assertEquals(self._sortedStats(expected),
+          self._sortedStats(records[0]._Previous()))
+
+    entries = models.LeaderboardEntry.objects.values_list('scope', 'user',
+        'volume_ml')
+    stored = sorted(entries)
+    models.LeaderboardEntry.Rebuild()
+    self.assertEquals(sorted(entries), stored)
+
+  def assertSessionsMatchRebuild(self):
+    delta = models.SiteSettings.get().GetSessionTimeoutDelta()
+    regen = sessions.SessionRegenerator(delta)
+    drinks = models.Drink.objects.valid().order_by('time', 'id')
+    for row in drinks.values_list(*sessions.SessionRegenerator.FIELDS):
+      regen.AddDrink(*row)
+
+    expected = sorted((s.start_time, s.end_time, s.volume_ml,
+        sorted(s.drink_ids)) for s in regen.sessions)
+    actual = sorted((s.start_time, s.end_time, s.volume_ml,
+        sorted(s.drinks.valid().values_list('id', flat=True)))
+        for s in models.DrinkingSession.objects.all())
+    self.assertEquals(expected, actual)
+
+    expected = sorted((s.start_time, user_id, c.start_time, c.end_time,
+        c.volume_ml) for s in regen.sessions
+        for user_id, c in s.user_chunks.iteritems())
+    actual = sorted((c.session.start_time, c.user_id, c.start_time,
+        c.end_time, c.volume_ml) for c in models.UserSessionChunk.objects.all())
+    self.assertEquals(expected, actual)
+
+  def testBackdatedDrinks(self):
+    def pour(username, time, volume_ml):
+      return self.backend.RecordDrink('kegboard.flow0', ticks=volume_ml,
+          volume_ml=volume_ml, username=username, pour_time=time)
+
+    # Two sessions, on a Sunday.
+    pour('user1', make_datetime(2011, 05, 01, 1, 0), 100)
+    pour('user2', make_datetime(2011, 05, 01, 1, 30), 200)
+    pour('user1', make_datetime(2011, 05, 01, 6, 0), 300)
+    pour('user3', make_datetime(2011, 05, 01, 6, 30), 400)
+    self.assertEquals(2, models.DrinkingSession.objects.count())
+    self.assertSessionsMatchRebuild()
+
+    # Within the first session.
+    pour('user1', make_datetime(2011, 05, 01, 1, 15), 50)
+    self.assertSessionsMatchRebuild()
+    self.assertStoredStatsMatchRebuild()
+
+    # Moves the start of the first session to Saturday.
+    d = pour('user3', make_datetime(2011, 04, 30, 23, 0), 150)
+    self.assertFalse(d.created_session)
+    self.assertTrue(d.created_user_chunk)
+    self.assertEquals(2, models.DrinkingSession.objects.count())
+    self.assertSessionsMatchRebuild()
+    self.assertStoredStatsMatchRebuild()
+
+    # Bridges both sessions.
+    d = pour('user2', make_datetime(2011, 05, 01, 4, 0), 250)
+    self.assertFalse(d.created_session)
+    self.assertFalse(d.created_user_chunk)
+    self.assertEquals(1, models.DrinkingSession.objects.count())
+    self.assertEquals(1, models.SystemStats.objects.get()._Previous().sessions_count)
+    self.assertSessionsMatchRebuild()
+    self.assertStoredStatsMatchRebuild()
+
+    # Cancelling it splits them again.
+    self.backend.CancelDrink(d.id)
+    self.assertEquals(2, models.DrinkingSession.objects.count())
+    self.assertEquals(2, models.SystemStats.objects.get()._Previous().sessions_count)
+    self.assertSessionsMatchRebuild()
+    self.assertStoredStatsMatchRebuild()
+
+    # A new session in the gap.
+    d = pour('user2', make_datetime(2011, 04, 30, 12, 0), 100)
+    self.assertTrue(d.created_session)
+    self.assertEquals(3, models.DrinkingSession.objects.count())
+    self.assertSessionsMatchRebuild()
+    self.assertStoredStatsMatchRebuild()
+
+  def testRecordDrinks(self):
+    def pour(client_id, username, time, volume_ml):
+      return {'tap_name': 'kegboard.flow0', 'ticks': volume_ml,
+          'volume_ml': volume_ml, 'username': username, 'pour_time': time,
+          'client_id': client_id}
+
+    self.backend.RecordDrink('kegboard.flow0', ticks=100, volume_ml=100,
+        username='user1', pour_time=make_datetime(2011, 05, 01, 6, 0))
+
+    # Out of order, opening a session which a later pour merges with the
+    # existing one.
+    drinks = self.backend.RecordDrinks([
+      pour('a', 'user2', make_datetime(2011, 05, 01, 2, 30), 200),
+      pour('b', 'user1', make_datetime(2011, 05, 01, 1, 0), 300),
+      pour('c', 'user3', make_datetime(2011, 05, 01, 4, 0), 400),
+      pour(None, 'user3', make_datetime(2011, 05, 02, 1, 0), 50),
+    ])
+    self.assertEquals(4, len(drinks))
+    self.assertEquals(5, models.Drink.objects.count())
+    self.assertEquals(2, models.DrinkingSession.objects.count())
+    self.assertEquals(2, models.SystemStats.objects.get()._Previous().sessions_count)
+    self.assertEquals(['b', 'a', 'c', None],
+        [d.client_id for d in sorted(drinks, key=lambda d: d.id)])
+    self.assertSessionsMatchRebuild()
+    self.assertStoredStatsMatchRebuild()
+
+    events = models.SystemEvent.objects.all()
+    self.assertEquals(2, events.filter(kind='session_started').count())
+    self.assertEquals(4, events.filter(kind='session_joined').count())
+    self.assertEquals(5, events.filter(kind='drink_poured').count())
+
+    # Replayed pours are not recorded again.
+    replayed = self.backend.RecordDrinks([
+      pour('c', 'user3', make_datetime(2011, 05, 01, 4, 0), 400),
+      pour('d', 'user2', make_datetime(2011, 05, 01, 4, 30), 100),
+      pour('d', 'user2', make_datetime(2011, 05, 01, 4, 30), 100),
+    ])
+    self.assertEquals(drinks[2].id, replayed[0].id)
+    self.assertEquals(replayed[1].id, replayed[2].id)
+    self.assertEquals(6, models.Drink.objects.count())
+    self.assertSessionsMatchRebuild()
+    self.assertStoredStatsMatchRebuild()
+
+  @override_settings(KEGBOT_ASYNC_POSTPROCESS=True)
+  def testAsyncPostProcess(self):
+    def pour(username, time, volume_ml):
+      return self.backend.RecordDrink('kegboard.flow0', ticks=volume_ml,
+          volume_ml=volume_ml, username=username, pour_time=time)
+
+    pour('user1', make_datetime(2011, 05, 01, 1, 0), 100)
+    pour('user2', make_datetime(2011, 05, 01, 6, 0), 200)
+    self.assertEquals(2, models.PostProcessTask.objects.count())
+    self.assertEquals(0, models.SystemStats.objects.count())
+    self.assertEquals(2, self.backend.ProcessPendingDrinks())
+    self.assertStoredStatsMatchRebuild()
+
+    # Queued drinks are changed, and merge sessions, before being processed.
+    d1 = pour('user3', make_datetime(2011, 05, 01, 7, 0), 300)
+    d2 = pour('user1', make_datetime(2011, 05, 01, 3, 30), 400)
+    pour('user3', make_datetime(2011, 05, 01, 9, 0), 50)
+    self.assertEquals(1, models.DrinkingSession.objects.count())
+    self.backend.ReassignDrink(d1.id, 'user2')
+    self.backend.AdjustDrinkVolume(d2.id, 250)
+    d3 = pour('user2', make_datetime(2011, 05, 02, 9, 0), 10)
+    self.backend.CancelDrink(d3.id)
+    self.assertEquals(3, models.PostProcessTask.objects.count())
+    self.assertSessionsMatchRebuild()
+
+    self.assertEquals(2, self.backend.ProcessPendingDrinks(batch_size=2))
+    self.assertEquals(1, self.backend.ProcessPendingDrinks(batch_size=2))
+    self.assertEquals(0, self.backend.ProcessPendingDrinks(batch_size=2))
+    self.assertEquals(1, models.SystemStats.objects.get()._Previous().sessions_count)
+    self.assertStoredStatsMatchRebuild()
+
+    events = models.SystemEvent.objects.all()
+    self.assertEquals(1, events.filter(kind='session_started').count())
+    self.assertEquals(3, events.filter(kind='session_joined').count())
+    self.assertEquals(5, events.filter(kind='drink_poured').count())
+
+  @override_settings(KEGBOT_ASYNC_POSTPROCESS=True)
+  def testChangeClaimedDrinks(self):
+    def pour(username, time, volume_ml):
+      return self.backend.RecordDrink('kegboard.flow0', ticks=volume_ml,
+          volume_ml=volume_ml, username=username, pour_time=time)
+
+    d1 = pour('user1', make_datetime(2011, 05, 01, 1, 0), 100)
+    d2 = pour('user2', make_datetime(2011, 05, 01, 1, 30), 200)
+    pour('user3', make_datetime(2011, 05, 01, 2, 0), 300)
+    self.assertEquals(2, self.backend._ClaimPendingDrinks(batch_size=2))
+
+    # Claimed drinks are changed, and drinks recorded, before the claimed
+    # drinks are processed.
+    self.backend.CancelDrink(d1.id)
+    self.backend.AdjustDrinkVolume(d2.id, 250)
+    pour('user1', make_datetime(2011, 05, 01, 0, 30), 50)
+    self.assertEquals(1, models.PostProcessTask.objects.filter(
+        claimed=True).count())
+
+    self.assertEquals(1, self.backend._ProcessClaimedDrinks())
+    self.assertEquals(0, self.backend._ProcessClaimedDrinks())
+    self.assertEquals(2, self.backend.ProcessPendingDrinks())
+    self.assertEquals(0, models.PostProcessTask.objects.count())
+    self.assertSessionsMatchRebuild()
+    self.assertStoredStatsMatchRebuild()
+
+  @override_settings(KEGBOT_ASYNC_POSTPROCESS=True)
+  def testReassignProcessedDrinkWithQueuedDrinks(self):
+    d1 = self.backend.RecordDrink('kegboard.flow0', ticks=100, volume_ml=100,
+        username='user2', pour_time=make_datetime(2011, 05, 01, 1, 0))
+    self.assertEquals(1, self.backend.ProcessPendingDrinks())
+
+    # Queued as opening user1's part of the session, until d1 joins it.
+    self.backend.RecordDrink('kegboard.flow0', ticks=200, volume_ml=200,
+        username='user1', pour_time=make_datetime(2011, 05, 01, 1, 30))
+    self.assertTrue(models.PostProcessTask.objects.get().created_user_chunk)
+    self.backend.ReassignDrink(d1.id, 'user1')
+    self.assertEquals(1, self.backend.ProcessPendingDrinks())
+
+    user_stats = models.UserStats.objects.get(user=self.users[0])._Previous()
+    self.assertEquals(1, user_stats.sessions_count)
+    self.assertStoredStatsMatchRebuild()
+
+  def testSessionTimeoutChange(self):
+    start = make_datetime(2011, 05, 01, 12, 0)
+    for username, minutes in (('user1', 0), ('user2', 120), ('user1', 330),
+        ('user3', 600), ('user2', 610)):
+      self.backend.RecordDrink('kegboard.flow0', ticks=100, volume_ml=100,
+          username=username,
+          pour_time=start + datetime.timedelta(minutes=minutes))
+    self.assertEquals(3, models.DrinkingSession.objects.count())
+
+    site_settings = models.SiteSettings.get()
+    for timeout, num_sessions in ((240, 2), (60, 4), (180, 3)):
+      site_settings.session_timeout_minutes = timeout
+      site_settings.save()
+      change = models.SessionTimeoutChange.objects.get(finished_time=None)
+      sessions.ApplyTimeoutChanges(checkpoint_every=1)
+      change = models.SessionTimeoutChange.objects.get(id=change.id)
+      self.assertTrue(change.shifted)
+      self.assertNotEquals(None, change.finished_time)
+      self.assertEquals(num_sessions, models.DrinkingSession.objects.count())
+      self.assertSessionsMatchRebuild()
+      self.assertStoredStatsMatchRebuild()
+
+    # Pours between the change and applying it already end at the new
+    # timeout, and running the change again moves nothing.
+    site_settings.session_timeout_minutes = 90
+    site_settings.save()
+    self.backend.RecordDrink('kegboard.flow0', ticks=100, volume_ml=100,
+        username='user1', pour_time=start + datetime.timedelta(minutes=680))
+    change = models.SessionTimeoutChange.objects.get(finished_time=None)
+    sessions.ApplyTimeoutChanges()
+    self.assertEquals(4, models.DrinkingSession.objects.count())
+    self.assertSessionsMatchRebuild()
+    change.finished_time = None
+    change.position = None
+    change.shifted = False
+    change.save()
+    sessions.ApplyTimeoutChanges()
+    self.assertSessionsMatchRebuild()
+    self.assertStoredStatsMatchRebuild()
+
+    # Saving without changing the timeout schedules nothing.
+    site_settings.save()
+    self.assertEquals(0, models.SessionTimeoutChange.objects.filter(
+        finished_time=None).count())
+
+  def testRemoveDrink(self):
+    pour_time = make_datetime(2011, 05, 01, 12, 00)
+    pours = (
+      ('user1', 0, 100),
+      ('user2', 1, 400),
+      (None, 2, 200),
+      ('user1', 6, 300),  # Starts a new session.
+      ('user3', 7, 100),
+    )
+    for username, hours, volume_ml in pours:
+      d = self.backend.RecordDrink('kegboard.flow0', ticks=volume_ml,
+          volume_ml=volume_ml, username=username,
+          pour_time=pour_time + datetime.timedelta(hours=hours),
+          do_postprocess=False)
+      d.PostProcess()
+    self.assertStoredStatsMatchRebuild()
+
+    # Greatest pour.
+    self.backend.CancelDrink(2)
+    self.assertStoredStatsMatchRebuild()
+
+    # Cancelling it again changes nothing.
+    self.assertEquals('deleted', self.backend.CancelDrink(2).status)
+    self.assertStoredStatsMatchRebuild()
+
+    # Last pour; user3 has no drinks left.
+    self.backend.CancelDrink(5)
+    self.assertStoredStatsMatchRebuild()
+    self.assertEquals(0, models.UserStats.objects.filter(user=self.users[2]).count())
+
+    self.backend.AdjustDrinkVolume(1, 250)
+    self.assertStoredStatsMatchRebuild()
+
+    # Guest pour reassigned; no guest pours remain.
+    self.backend.ReassignDrink(3, 'user3')
+    self.assertStoredStatsMatchRebuild()
+    self.assertFalse(models.SystemStats.objects.get()._Previous().has_guest_pour)
+
+    self.backend.ReassignDrink(4, None)
+    self.assertStoredStatsMatchRebuild()
+
+  def testSessionCreatedFlags(self):
+    pour_time = make_datetime(2011, 05, 01, 12, 00)
+    d1 = self.backend.RecordDrink('kegboard.flow0', ticks=100, volume_ml=100,
+        username='user1', pour_time=pour_time, do_postprocess=False)
+    self.assertTrue(d1.created_session)
+    self.assertTrue(d1.created_user_chunk)
+
+    d2 = self.backend.RecordDrink('kegboard.flow0', ticks=100, volume_ml=100,
+        username='user2', pour_time=pour_time + datetime.timedelta(minutes=5),
+        do_postprocess=False)
+    self.assertFalse(d2.created_session)
+    self.assertTrue(d2.created_user_chunk)
+
+    d3 = self.backend.RecordDrink('kegboard.flow0', ticks=100, volume_ml=100,
+        username='user1', pour_time=pour_time + datetime.timedelta(minutes=10),
+        do_postprocess=False)
+    self.assertFalse(d3.created_session)
+    self.assertFalse(d3.created_user_chunk)
+
+    for d in (d1, d2, d3):
+      d.PostProcess()
+    self.assertEquals(1, models.SystemStats.objects.get()._Previous().sessions_count)
+
+    events = models.SystemEvent.objects.all()
+    self.assertEquals(1, events.filter(kind='session_started').count())
+    self.assertEquals(2, events.filter(kind='session_joined').count())
+    self.assertEquals(3, events.filter(kind='drink_poured').count())
+    self.assertStoredStatsMatchRebuild()
+
+  def testStatSubsets(self):
+    builder_cls = stats.SystemStatsBuilder
+    self.assertTrue(builder_cls._Registry() is builder_cls._Registry())
+    self.assertEquals(set(['average_volume_ml', 'total_volume_ml', 'total_pours']),
+        builder_cls.ResolveStatNames(['average_volume_ml']))
+
+    pour_time = make_datetime(2011, 05, 01, 12, 00)
+    for volume_ml in (100, 300):
+      d = self.backend.RecordDrink('kegboard.flow0', ticks=volume_ml,
+          volume_ml=volume_ml, username='user1', pour_time=pour_time,
+          do_postprocess=False)
+
+    full = builder_cls(d, drink_qs=models.Drink.objects.valid()).Build()
+    partial = builder_cls(d, drink_qs=models.Drink.objects.valid()).Build(
+        ['total_volume_ml'])
+    self.assertEquals(400, partial.total_volume_ml)
+    self.assertFalse(partial.HasField('total_pours'))
+    self.assertEquals(0, len(partial.volume_by_drinker))
+
+    # Stats not asked for are carried over from the previous stats.
+    partial = builder_cls(d, drink_qs=models.Drink.objects.valid(),
+        previous=full).Build(['total_volume_ml'])
+    self.assertEquals(700, partial.total_volume_ml)
+    self.assertEquals(full.total_pours, partial.total_pours)
+    self.assertEquals(full.volume_by_drinker, partial.volume_by_drinker)
+
+  def testLeaderboard(self):
+    pour_time = make_datetime(2011, 05, 01, 12, 00)
+    pours = (
+      ('user1', 0, 100),
+      ('user2', 1, 400),
+      (None, 2, 200),
+      ('user1', 3, 200),
+      ('user3', 24 * 40, 500),  # Next month, in a new session.
+    )
+    for username, hours, volume_ml in pours:
+      d = self.backend.RecordDrink('kegboard.flow0', ticks=volume_ml,
+          volume_ml=volume_ml, username=username,
+          pour_time=pour_time + datetime.timedelta(hours=hours),
+          do_postprocess=False)
+      d.PostProcess()
+
+    user1, user2, user3 = self.users[:3]
+    Entry = models.LeaderboardEntry
+    self.assertEquals([(500, user3), (400, user2), (300, user1)],
+        Entry.Top('system'))
+    self.assertEquals([(500, user3), (400, user2)], Entry.Top('system', limit=2))
+    self.assertEquals([(400, user2), (300, user1)], Entry.Top('month:2011-05'))
+    self.assertEquals([(500, user3)], Entry.Top('month:2011-06'))
+    self.assertEquals(Entry.Top('system'), Entry.Top('year:2011'))
+    first_session = models.DrinkingSession.objects.order_by('id')[0]
+    self.assertEquals([(400, user2), (300, user1)],
+        Entry.Top(Entry.SessionScope(first_session)))
+
+    self.backend.CancelDrink(2)
+    self.assertEquals([(500, user3), (300, user1)], Entry.Top('system'))
+    self.backend.ReassignDrink(5, 'user1')
+    self.assertEquals([(800, user1)], Entry.Top('system'))
+    self.assertStoredStatsMatchRebuild()
+
+  def testLeaderboardConcurrentFirstPour(self):
+    d = self.backend.RecordDrink('kegboard.flow0', ticks=100, volume_ml=100,
+        username='user1', pour_time=make_datetime(2011, 05, 01, 12, 00),
+        do_postprocess=False)
+    Entry = models.LeaderboardEntry
+    user1 = self.users[0]
+
+    # Another pour creates the system entry after this one found none.
+    bulk_create = Entry.objects.bulk_create
+    def racing_bulk_create(entries):
+      Entry.objects.bulk_create = bulk_create
+      Entry.objects.create(scope='system', user=user1, volume_ml=50)
+      return bulk_create(entries)
+    Entry.objects.bulk_create = racing_bulk_create
+    try:
+      Entry.AddDrink(d)
+    finally:
+      Entry.objects.bulk_create = bulk_create
+
+    self.assertEquals([(150, user1)], Entry.Top('system'))
+    self.assertEquals([(100, user1)], Entry.Top('month:2011-05'))
+    self.assertEquals(len(Entry.ScopesForDrink(d)),
+        Entry.objects.filter(user=user1).count())
+
+  def testStoredStatsDecodeLazily(self):
+    d = self.backend.RecordDrink('kegboard.flow0', ticks=100, volume_ml=100,
+        username='user1', do_postprocess=False)
+    d.PostProcess()
+
+    record = models.SystemStats.objects.get()
+    self.assertTrue(isinstance(record.__dict__['stats_proto'],
+        (basestring, buffer)))
+    record.save()
+    record = models.SystemStats.objects.get()
+    self.assertEquals(100, record.stats_proto.total_volume_ml)
+    self.assertEquals(100, record.stats['total_volume_ml'])
+
+  def testStoredStatsKeepDoublePrecision(self):
+    # Each pour updates the stored stats, which are read back for the next.
+    volumes = (123.456, 0.1, 78.9, 1e6 + 0.7, 33.3)
+    for i, volume_ml in enumerate(volumes):
+      d = self.backend.RecordDrink('kegboard.flow0', ticks=100,
+          volume_ml=volume_ml, username='user1',
+          pour_time=make_datetime(2011, 05, 01, 12, i))
+
+    total = 0
+    for volume_ml in volumes:
+      total += volume_ml
+    stored = models.SystemStats.objects.get().stats_proto
+    self.assertEquals(total, stored.total_volume_ml)
+    self.assertEquals(total / len(volumes), stored.average_volume_ml)
+    self.assertEquals([total], [v.volume_ml for v in stored.volume_by_drinker])
+    self.assertEquals([total], [v.volume_ml for v in stored.volume_by_year])
+
+    rebuilt = stats.SystemStatsBuilder(d,
+        drink_qs=models.Drink.objects.valid()).Build()
+    self.assertEquals(rebuilt.total_volume_ml, stored.total_volume_ml)
+    self.assertEquals(rebuilt.volume_by_day_of_week[0].volume_ml,
+        stored.volume_by_day_of_week[0].volume_ml)
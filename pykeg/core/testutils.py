@@ -21,10 +21,27 @@
 import datetime
 
 from django.conf import settings
+from django.core.cache import cache
 from django.utils import timezone
+from nose.plugins import Plugin
 
 def make_datetime(*args):
   if settings.USE_TZ:
     return datetime.datetime(*args, tzinfo=timezone.utc)
   else:
     return datetime.datetime(*args)
+
+class ClearCachesPlugin(Plugin):
+  """Nose plugin which clears the Django cache before each test.
+
+  Tests roll back or flush the database without sending delete signals, so
+  rows cached by pykeg.core.cache would otherwise outlive them.
+  """
+  name = 'kegbot-clear-caches'
+  enabled = True
+
+  def configure(self, options, conf):
+    pass  # Always enabled.
+
+  def beforeTest(self, test):
+    cache.clear()
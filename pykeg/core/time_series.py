@@ -20,27 +20,103 @@
 
 A Kegbot core may report a time series (Drink.tick_time_series) for the meter
 events that caused a drink.
+
+A series has two forms.  The text form is a sequence of <time>:<amount> pairs,
+and is what clients post and the API returns.  The encoded form is what is
+stored: a version byte, followed by each pair as two zigzag varints, the
+time as a delta from the previous time and the amount as-is.
 """
 
-def from_string(s):
-  """Converts a time series to a list of (int, int) tuples.
+ENCODING_VERSION = '\x01'
+
+def iter_string(s):
+  """Yields the (int, int) tuples of a time series string, as parsed.
 
   The string should be a sequence of zero or more <time>:<amount> pairs.
   Whitespace delimits each pair; leading and trailing whitespace is ignored.
 
   ValueError is raised on any malformed input.
   """
-  pairs = s.strip().split()
-  ret = []
-  for pair in pairs:
+  for pair in s.split():
     time, amount = pair.split(':')
     time = int(time)
     amount = int(amount)
     if time < 0:
       raise ValueError('Time cannot be less than zero: %s' % time)
-    ret.append((time, amount))
-  return ret
+    yield time, amount
+
+def from_string(s):
+  """Converts a time series string to a list of (int, int) tuples."""
+  return list(iter_string(s))
 
 def to_string(pairs):
   """Converts a series of (int, int) tuples to a time series string."""
   return ' '.join('%i:%i' % pair for pair in pairs)
+
+def _zigzag(n):
+  return -2 * n - 1 if n < 0 else 2 * n
+
+def _unzigzag(n):
+  return (n >> 1) ^ -(n & 1)
+
+def _varint(n):
+  out = []
+  while n > 0x7f:
+    out.append(chr((n & 0x7f) | 0x80))
+    n >>= 7
+  out.append(chr(n))
+  return ''.join(out)
+
+def iter_encode(pairs):
+  """Yields the encoded form of a series of (int, int) tuples, in chunks.
+
+  ValueError is raised if any time is less than zero.
+  """
+  yield ENCODING_VERSION
+  last_time = 0
+  for time, amount in pairs:
+    if time < 0:
+      raise ValueError('Time cannot be less than zero: %s' % time)
+    yield _varint(_zigzag(time - last_time)) + _varint(_zigzag(amount))
+    last_time = time
+
+def encode(pairs):
+  """Converts a series of (int, int) tuples to its encoded form."""
+  return ''.join(iter_encode(pairs))
+
+def is_encoded(data):
+  """Returns True if `data` is in the encoded rather than the text form."""
+  return data[:1] == ENCODING_VERSION
+
+def iter_decode(data):
+  """Yields the (int, int) tuples of an encoded series.
+
+  ValueError is raised if the data is truncated or of an unknown version.
+  """
+  if not is_encoded(data):
+    raise ValueError('Unknown time series encoding')
+  values = []
+  n = shift = 0
+  last_time = 0
+  for pos in xrange(1, len(data)):
+    byte = ord(data[pos])
+    n |= (byte & 0x7f) << shift
+    if byte & 0x80:
+      shift += 7
+      continue
+    values.append(_unzigzag(n))
+    n = shift = 0
+    if len(values) == 2:
+      last_time += values[0]
+      yield last_time, values[1]
+      values = []
+  if values or shift:
+    raise ValueError('Truncated time series')
+
+def decode(data):
+  """Converts a stored time series, in either form, to a list of tuples."""
+  if not data:
+    return []
+  if is_encoded(data):
+    return list(iter_decode(data))
+  return from_string(data)
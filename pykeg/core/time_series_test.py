@@ -11,5 +11,21 @@ class TimeSeriesTestCase(unittest.TestCase):
 
     self.assertEqual(s.strip(), time_series.to_string(expected))
 
+  def testEncoding(self):
+    series = [(0, 12), (45, 6789), (40, -3), (2**40, 1)]
+    data = time_series.encode(series)
+    self.assertTrue(time_series.is_encoded(data))
+    self.assertEqual(series, list(time_series.iter_decode(data)))
+    self.assertEqual(data, ''.join(time_series.iter_encode(iter(series))))
+
+    # Both forms decode; empty values decode to an empty series.
+    self.assertEqual(series, time_series.decode(data))
+    self.assertEqual(series, time_series.decode(time_series.to_string(series)))
+    self.assertEqual([], time_series.decode(''))
+    self.assertEqual([], time_series.decode(None))
+
+    self.assertRaises(ValueError, time_series.decode, data[:-1])
+    self.assertRaises(ValueError, time_series.encode, [(-1, 0)])
+
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,91 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Model field storing a time series in a binary column.
+
+The series is stored in the encoded form of pykeg.core.time_series, and read
+as a list of (time, amount) tuples.  It may be assigned as a list of tuples,
+or as a string in either form; strings are only parsed when the attribute is
+first read, and encoded values are saved without being re-encoded.
+"""
+
+from pykeg.core import time_series
+from pykeg.core.blobfield import BlobField
+from pykeg.core.blobfield import to_binary
+from pykeg.core.blobfield import to_bytes
+
+
+class _TimeSeriesDescriptor(object):
+  """Holds the assigned value until first access, then the decoded series."""
+
+  def __init__(self, field):
+    self.field = field
+
+  def __get__(self, instance, owner):
+    if instance is None:
+      return self
+    value = instance.__dict__.get(self.field.attname)
+    if isinstance(value, list):
+      return value
+    value = self.field.to_python(value)
+    instance.__dict__[self.field.attname] = value
+    return value
+
+  def __set__(self, instance, value):
+    instance.__dict__[self.field.attname] = value
+
+
+class TimeSeriesField(BlobField):
+  """Stores a time series as encoded bytes."""
+
+  def contribute_to_class(self, cls, name):
+    super(TimeSeriesField, self).contribute_to_class(cls, name)
+    setattr(cls, self.name, _TimeSeriesDescriptor(self))
+
+  def to_python(self, value):
+    """Decodes a stored or assigned value into a list of tuples."""
+    if isinstance(value, list):
+      return value
+    return time_series.decode(to_bytes(value))
+
+  def pre_save(self, model_instance, add):
+    # Skip the descriptor, so that undecoded values are saved as-is.
+    return model_instance.__dict__.get(self.attname)
+
+  def get_db_prep_value(self, value, connection, prepared=False):
+    value = to_bytes(value)
+    if not value:
+      return None
+    if isinstance(value, basestring):
+      if time_series.is_encoded(value):
+        return to_binary(value, connection)
+      value = time_series.iter_string(value)
+    return to_binary(time_series.encode(value), connection)
+
+  def value_to_string(self, obj):
+    # Serialized in the text form, which to_python also accepts.
+    return time_series.to_string(self._get_val_from_obj(obj) or [])
+
+try:
+  from south.modelsinspector import add_introspection_rules
+except ImportError:
+  pass
+else:
+  add_introspection_rules([
+    ([TimeSeriesField], [], {}),
+    ], ["^pykeg\.core\.timeseriesfield\.TimeSeriesField"])
@@ -29,6 +29,7 @@ from kegbot.util import util
 
 from pykeg.contrib.soundserver import models as soundserver_models
 from pykeg.core import models
+from pykeg.core import time_series
 
 _CONVERSION_MAP = {}
 
@@ -192,7 +193,7 @@ def DrinkToProto(drink, full=False):
   if drink.shout:
     ret.shout = drink.shout
   if drink.tick_time_series:
-    ret.tick_time_series = drink.tick_time_series
+    ret.tick_time_series = time_series.to_string(drink.tick_time_series)
 
   if full:
     if drink.user:
@@ -325,7 +326,9 @@ def UserProfileToProto(record, full=False):
 @converts(models.KegStats)
 @converts(models.SessionStats)
 def SystemStatsToProto(record, full=False):
-  return protoutil.DictToProtoMessage(record.stats, models_pb2.Stats())
+  ret = models_pb2.Stats()
+  ret.CopyFrom(record.stats_proto)
+  return ret
 
 @converts(models.SystemEvent)
 def SystemEventToProto(record, full=False):
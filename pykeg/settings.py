@@ -3,6 +3,8 @@
 # Note: YOU SHOULD NOT NEED TO EDIT THIS FILE.  Instead, see the instructions in
 # local_settings.py.example.
 
+from datetime import timedelta
+
 # Grab flags for optional modules.
 from pykeg.core.optional_modules import *
 
@@ -129,6 +131,7 @@ MIDDLEWARE_CLASSES = (
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'pykeg.web.middleware.CacheInvalidationMiddleware',
     'django.middleware.transaction.TransactionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
 
@@ -182,6 +185,17 @@ if HAVE_DJCELERY and HAVE_DJKOMBU:
   CELERY_DEFAULT_QUEUE = "default"
   CELERYD_CONCURRENCY = 3
 
+  CELERYBEAT_SCHEDULE = {
+    'prune-thermologs': {
+      'task': 'pykeg.web.tasks.prune_thermologs',
+      'schedule': timedelta(hours=1),
+    },
+    'rollup-thermologs': {
+      'task': 'pykeg.web.tasks.rollup_thermologs',
+      'schedule': timedelta(minutes=5),
+    },
+  }
+
 ### debug_toolbar
 
 if HAVE_DEBUG_TOOLBAR:
@@ -293,8 +307,29 @@ FOURSQUARE_REQUEST_PERMISSIONS = ''
 UNTAPPD_CLIENT_ID = ''
 UNTAPPD_CLIENT_SECRET = ''
 
+### Kegbot
+
+# If True, recorded drinks are post processed (stats, leaderboards and events)
+# by the kb_postprocess worker, rather than before the request returns.
+KEGBOT_ASYNC_POSTPROCESS = False
+
+# Temperature readings older than this many hours are deleted by the
+# kb_compress_temps job, this many rows per transaction.
+KEGBOT_THERMOLOG_KEEP_HOURS = 24
+KEGBOT_THERMOLOG_PRUNE_BATCH_SIZE = 1000
+
+# Before they are deleted, readings are rolled up into summaries of each of
+# these resolutions, in seconds, from finest to coarsest.  Each resolution
+# must be a multiple of the previous one and divide a day.  Summaries are kept
+# for the given number of hours, or forever if None.
+KEGBOT_THERMOLOG_ROLLUPS = (
+  (5 * 60, 7 * 24),
+  (60 * 60, None),
+)
+
 TEST_RUNNER = 'django_nose.NoseTestSuiteRunner'
 NOSE_ARGS = ['--exe']
+NOSE_PLUGINS = ['pykeg.core.testutils.ClearCachesPlugin']
 SKIP_SOUTH_TESTS = True
 SOUTH_TESTS_MIGRATE = False
 
@@ -135,3 +135,39 @@ class ApiClientTestCase(BaseApiTestCase):
 
 
 
+
+    def testDrinksBatch(self):
+        create_site()
+        user = models.User.objects.create(username='testuser', is_staff=True)
+        models.ApiKey.objects.create(user=user, key='123')
+
+        def post(pours):
+            response = self.client.post('/api/drinks/batch',
+                data=kbjson.dumps({'pours': pours}),
+                content_type='application/json',
+                HTTP_X_KEGBOT_API_KEY='123')
+            return response, kbjson.loads(response.content)
+
+        pours = [
+            {'client_id': 'pour-1', 'tap': 'kegboard.flow0', 'ticks': 100,
+                'username': 'testuser'},
+            {'client_id': 'pour-2', 'tap': 'kegboard.flow1', 'ticks': 200},
+        ]
+
+        # Nothing is recorded if any pour is invalid.
+        response, data = post(pours + [{'tap': 'kegboard.flow0'}])
+        self.assertEquals(data.meta.result, 'error')
+        self.assertEquals(data.error.code, 'BadRequestError')
+        self.assertEquals(0, models.Drink.objects.count())
+
+        response, data = post(pours)
+        self.assertEquals(data.meta.result, 'ok')
+        self.assertEquals(2, len(data.objects))
+        self.assertEquals(2, models.Drink.objects.count())
+
+        # Replaying the same pours records nothing new.
+        response, replayed = post(pours)
+        self.assertEquals(replayed.meta.result, 'ok')
+        self.assertEquals([d.id for d in data.objects],
+            [d.id for d in replayed.objects])
+        self.assertEquals(2, models.Drink.objects.count())
@@ -31,6 +31,11 @@ class DrinkPostForm(forms.Form):
   shout = forms.CharField(required=False)
   tick_time_series = forms.CharField(required=False)
 
+class BatchDrinkPostForm(DrinkPostForm):
+  """Form to handle each pour posted to /drinks/batch/"""
+  tap = forms.CharField()
+  client_id = forms.CharField(required=False, max_length=64)
+
 class CancelDrinkForm(forms.Form):
   """Form to handled posts to /cancel-drink/"""
   id = forms.IntegerField()
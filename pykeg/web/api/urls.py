@@ -27,8 +27,10 @@ urlpatterns = patterns('pykeg.web.api.views',
         'assign_auth_token'),
     url(r'^cancel-drink/?$', 'cancel_drink'),
     url(r'^drinks/?$', 'all_drinks'),
+    url(r'^drinks/batch/?$', 'drinks_batch'),
     url(r'^drinks/(?P<drink_id>\d+)/?$', 'get_drink'),
     url(r'^drinks/(?P<drink_id>\d+)/add-photo/?$', 'add_drink_photo'),
+    url(r'^drinks/(?P<drink_id>\d+)/flow/?$', 'get_drink_flow'),
     url(r'^sessions/?$', 'all_sessions'),
     url(r'^sessions/current/?$', 'current_session'),
     url(r'^sessions/(?P<session_id>\d+)/?$', 'get_session'),
@@ -49,6 +51,7 @@ urlpatterns = patterns('pykeg.web.api.views',
     url(r'^taps/(?P<tap_id>[\w\.]+)/activate/?$', 'tap_activate'),
     url(r'^taps/(?P<tap_id>[\w\.]+)/spill/?$', 'tap_spill'),
     url(r'^taps/(?P<tap_id>[\w\.]+)/calibrate/?$', 'tap_calibrate'),
+    url(r'^taps/(?P<tap_id>[\w\.]+)/flow/?$', 'get_tap_flow'),
     url(r'^taps/(?P<tap_id>[\w\.]+)/?$', 'tap_detail'),
     url(r'^thermo-sensors/?$', 'all_thermo_sensors'),
     url(r'^thermo-sensors/(?P<sensor_name>[^/]+)/?$', 'get_thermo_sensor'),
@@ -45,7 +45,9 @@ from kegbot.util import kbjson
 
 from pykeg.contrib.soundserver import models as soundserver_models
 from pykeg.core import backend
+from pykeg.core import flow
 from pykeg.core import models
+from pykeg.core import registry
 from pykeg.proto import protolib
 from pykeg.web.api import forms
 from pykeg.web.api import util
@@ -103,6 +105,16 @@ def get_drink(request, drink_id):
   drink = get_object_or_404(models.Drink, id=drink_id)
   return protolib.ToProto(drink, full=True)
 
+def get_drink_flow(request, drink_id):
+  drink = get_object_or_404(models.Drink, id=drink_id)
+  drink_flow = flow.GetDrinkFlows([drink.id]).get(drink.id)
+  if not drink_flow:
+    raise kbapi.ServerError('Flow analysis is not available.')
+  ret = {'drink_id': drink.id}
+  for field in flow.FLOW_FIELDS:
+    ret[field] = getattr(drink_flow, field)
+  return ret
+
 @csrf_exempt
 @auth_required
 def add_drink_photo(request, drink_id):
@@ -295,13 +307,32 @@ def _thermo_sensor_post(request, sensor_name):
     raise kbapi.BadRequestError, _form_errors(form)
   cd = form.cleaned_data
   b = backend.KegbotBackend()
-  sensor, created = models.ThermoSensor.objects.get_or_create(raw_name=sensor_name)
   # TODO(mikey): use form fields to compute `when`
-  return b.LogSensorReading(sensor.raw_name, cd['temp_c'])
+  return b.LogSensorReading(sensor_name, cd['temp_c'])
 
 def get_thermo_sensor_logs(request, sensor_name):
   sensor = _get_sensor_or_404(request, sensor_name)
-  return sensor.thermolog_set.all()[:60*2]
+  hours = 2
+  if 'hours' in request.GET:
+    try:
+      hours = max(1, int(request.GET['hours']))
+    except ValueError:
+      pass
+  start = timezone.now() - datetime.timedelta(hours=hours)
+  resolution, logs = sensor.GetLogs(start)
+  if resolution == models.Thermolog.RESOLUTION:
+    return logs
+  ret = []
+  for rollup in logs:
+    ret.append({
+      'sensor_id': sensor.id,
+      'time': protolib.datestr(rollup.time),
+      'temperature_c': rollup.temp,
+      'min_temperature_c': rollup.min_temp,
+      'max_temperature_c': rollup.max_temp,
+      'resolution': resolution,
+    })
+  return ret
 
 def get_api_key(request):
   user = request.user
@@ -312,10 +343,13 @@ def get_api_key(request):
 
 @csrf_exempt
 def tap_detail(request, tap_id):
-  tap = get_object_or_404(models.KegTap, meter_name=tap_id)
   if request.method == 'POST':
-    return _tap_detail_post(request, tap)
+    # Pours are recorded from the tap registry, without querying the tap.
+    if not registry.Get().GetTap(tap_id):
+      raise Http404('No tap with meter name %s' % tap_id)
+    return _tap_detail_post(request, tap_id)
   elif request.method == 'GET':
+    tap = get_object_or_404(models.KegTap, meter_name=tap_id)
     return _tap_detail_get(request, tap)
   else:
    raise kbapi.BadRequestError('Method not supported')
@@ -323,6 +357,14 @@ def tap_detail(request, tap_id):
 def _tap_detail_get(request, tap):
   return protolib.ToProto(tap, full=True)
 
+def get_tap_flow(request, tap_id):
+  tap = get_object_or_404(models.KegTap, meter_name=tap_id)
+  if not tap.current_keg:
+    raise kbapi.NotFoundError('No keg on tap %s' % tap_id)
+  if not settings.HAVE_NUMPY:
+    raise kbapi.ServerError('Flow analysis is not available.')
+  return flow.GetKegProfile(tap.current_keg)
+
 @csrf_exempt
 @auth_required
 def tap_calibrate(request, tap_id):
@@ -363,12 +405,8 @@ def tap_activate(request, tap_id):
     raise kbapi.BadRequestError, _form_errors(form)
   return protolib.ToProto(tap, full=True)
 
-@auth_required
-def _tap_detail_post(request, tap):
-  form = forms.DrinkPostForm(request.POST)
-  if not form.is_valid():
-    raise kbapi.BadRequestError, _form_errors(form)
-  cd = form.cleaned_data
+def _pour_args(cd):
+  """Returns RecordDrink arguments for a validated DrinkPostForm."""
   if cd.get('pour_time') and cd.get('now'):
     pour_time = datetime.datetime.fromtimestamp(cd.get('pour_time'))
     pour_now = datetime.datetime.fromtimestamp(cd.get('now'))
@@ -379,20 +417,67 @@ def _tap_detail_post(request, tap):
   duration = cd.get('duration')
   if duration is None:
     duration = 0
+  return {
+    'ticks': cd['ticks'],
+    'volume_ml': cd.get('volume_ml'),
+    'username': cd.get('username'),
+    'pour_time': pour_time,
+    'duration': duration,
+    'shout': cd.get('shout'),
+    'tick_time_series': cd.get('tick_time_series'),
+  }
+
+@auth_required
+def _tap_detail_post(request, meter_name):
+  form = forms.DrinkPostForm(request.POST)
+  if not form.is_valid():
+    raise kbapi.BadRequestError, _form_errors(form)
   b = backend.KegbotBackend()
   try:
-    res = b.RecordDrink(tap_name=tap.meter_name,
-      ticks=cd['ticks'],
-      volume_ml=cd.get('volume_ml'),
-      username=cd.get('username'),
-      pour_time=pour_time,
-      duration=duration,
-      shout=cd.get('shout'),
-      tick_time_series=cd.get('tick_time_series'))
+    res = b.RecordDrink(tap_name=meter_name, **_pour_args(form.cleaned_data))
     return protolib.ToProto(res, full=True)
   except backend.BackendError, e:
     raise kbapi.ServerError(str(e))
 
+@require_http_methods(["POST"])
+@auth_required
+@csrf_exempt
+def drinks_batch(request):
+  """Records a list of pours, posted as a JSON object with a `pours` list.
+
+  Each pour has the fields of a tap post, plus `tap` (the meter name) and an
+  optional `client_id`; pours already recorded with the same `client_id` are
+  not recorded again.  Nothing is recorded unless every pour is valid.
+  """
+  try:
+    pours = kbjson.loads(request.body)['pours']
+  except (ValueError, KeyError, TypeError):
+    raise kbapi.BadRequestError('Expected a JSON object with a "pours" list.')
+  if not isinstance(pours, list):
+    raise kbapi.BadRequestError('Expected a JSON object with a "pours" list.')
+
+  records = []
+  errors = {}
+  for i, pour in enumerate(pours):
+    form = forms.BatchDrinkPostForm(pour if isinstance(pour, dict) else {})
+    if not form.is_valid():
+      errors[i] = _form_errors(form)
+      continue
+    cd = form.cleaned_data
+    args = _pour_args(cd)
+    args['tap_name'] = cd['tap']
+    args['client_id'] = cd.get('client_id')
+    records.append(args)
+  if errors:
+    raise kbapi.BadRequestError, errors
+
+  b = backend.KegbotBackend()
+  try:
+    drinks = b.RecordDrinks(records)
+  except backend.BackendError, e:
+    raise kbapi.ServerError(str(e))
+  return [protolib.ToProto(d, full=True) for d in drinks]
+
 @csrf_exempt
 @auth_required
 def cancel_drink(request):
@@ -29,37 +29,41 @@ def to_pints(volume):
 class ChartError(Exception):
   """Base chart exception."""
 
-def TemperatureSensorChart(sensor):
+def TemperatureSensorChart(sensor, hours=6):
   """ Shows a simple line plot of a specific temperature sensor.
 
   Syntax:
-    {% chart sensor <sensorname> width height %}
+    {% chart sensor <sensorname> [hours] width height %}
   Args:
     sensorname - the nice_name of a ThermoSensor
+    hours - the number of hours to plot; 6 if not given
   """
   if not isinstance(sensor, models.ThermoSensor):
     raise ChartError('Bad sensor given')
 
-  hours = 6
   now = timezone.now()
-  start = now - (datetime.timedelta(hours=hours))
-  start = start - (datetime.timedelta(seconds=start.second))
-
-  points = sensor.thermolog_set.filter(time__gte=start).order_by('time')
-
-  curr = start
-  temps = []
-  have_temps = False
-  for point in points:
-    while curr <= point.time:
-      curr += datetime.timedelta(minutes=1)
-      if curr < point.time:
-        temps.append(None)
-      else:
-        temps.append(point.temp)
-        have_temps = True
-
-  if not have_temps:
+  start = now - (datetime.timedelta(hours=int(hours)))
+  resolution, points = sensor.GetLogs(start)
+  if resolution == models.Thermolog.RESOLUTION:
+    # Minutes are read whole days at a time from the packed ThermoDays.
+    temps = sensor.GetTemps(start, now)
+  else:
+    step = datetime.timedelta(seconds=resolution)
+    seconds = start.hour * 3600 + start.minute * 60 + start.second
+    start = start - datetime.timedelta(seconds=seconds % resolution,
+        microseconds=start.microsecond)
+
+    curr = start
+    temps = []
+    for point in points:
+      while curr <= point.time:
+        curr += step
+        if curr < point.time:
+          temps.append(None)
+        else:
+          temps.append(point.temp)
+
+  if not any(t is not None for t in temps):
     raise ChartError('Not enough data')
 
   res = {
@@ -126,6 +126,17 @@ class TapForm(forms.ModelForm):
   )
 
 
+class CalibrateTapForm(forms.Form):
+  helper = FormHelper()
+  helper.form_class = 'form-horizontal'
+  helper.layout = Layout(
+      FormActions(
+          Submit('submit_calibrate_tap_form', 'Apply Suggested Calibration',
+            css_class='btn-primary'),
+      )
+  )
+
+
 class DeleteTapForm(forms.Form):
   helper = FormHelper()
   helper.form_class = 'form-horizontal'
@@ -21,6 +21,7 @@
 import cStringIO
 import datetime
 
+from django.conf import settings as django_settings
 from django.contrib import messages
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
@@ -39,6 +40,8 @@ from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from kegbot.util import kbjson
 
 from pykeg.core import backup
+from pykeg.core import calibration
+from pykeg.core import flow
 from pykeg.core import logger
 from pykeg.core import models
 from pykeg.connections.foursquare import forms as foursquare_forms
@@ -69,6 +72,13 @@ def general_settings(request):
     if form.is_valid():
       form.save()
       messages.success(request, 'Site settings were successfully updated.')
+      if models.SessionTimeoutChange.objects.filter(finished_time=None).exists():
+        if django_settings.HAVE_CELERY:
+          messages.info(request, 'Existing sessions are being recomputed '
+              'with the new session timeout.')
+        else:
+          messages.warning(request, 'Run "kegbot kb_apply_session_timeout" to '
+              'recompute existing sessions with the new session timeout.')
   context['settings_form'] = form
   return render_to_response('kegadmin/index.html', context_instance=context)
 
@@ -115,6 +125,19 @@ def tap_detail(request, tap_id):
         messages.success(request, 'Tap settings saved.')
         tap_settings_form = forms.TapForm(instance=tap, site=request.kbsite)
 
+    elif 'submit_calibrate_tap_form' in request.POST:
+      result = None
+      if django_settings.HAVE_NUMPY:
+        result = calibration.CalibrateTaps([tap]).get(tap.id)
+      if result:
+        tap.ml_per_tick = result.ml_per_tick
+        tap.save()
+        messages.success(request, 'Tap calibrated to %.6f mL per tick.' %
+            tap.ml_per_tick)
+        tap_settings_form = forms.TapForm(instance=tap, site=request.kbsite)
+      else:
+        messages.warning(request, 'Not enough corrected drinks to calibrate.')
+
     elif 'submit_delete_tap_form' in request.POST:
       delete_form = forms.DeleteTapForm(request.POST)
       if delete_form.is_valid():
@@ -147,6 +170,13 @@ def tap_detail(request, tap_id):
   context['end_keg_form'] = end_keg_form
   context['tap_settings_form'] = tap_settings_form
   context['delete_tap_form'] = forms.DeleteTapForm()
+  if tap.current_keg and django_settings.HAVE_NUMPY:
+    context['calibration'] = calibration.CalibrateTaps([tap]).get(tap.id)
+    context['calibrate_tap_form'] = forms.CalibrateTapForm()
+    profile = flow.GetKegProfile(tap.current_keg)
+    profile['rates'] = [(i * profile['bin_ms'] / 1000.0, rate)
+        for i, rate in enumerate(profile['rates'])]
+    context['flow_profile'] = profile
   return render_to_response('kegadmin/tap_detail.html', context_instance=context)
 
 @staff_member_required
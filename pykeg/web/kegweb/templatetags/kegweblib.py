@@ -178,7 +178,7 @@ class VolumeNode(Node):
 
 @register.tag('chart')
 def chart(parser, tokens):
-  """{% chart <charttype> <obj> width height %}"""
+  """{% chart <charttype> <obj> [args...] width height %}"""
   tokens = tokens.contents.split()
   if len(tokens) < 4:
     raise TemplateSyntaxError('chart requires at least 4 arguments')
@@ -241,8 +241,9 @@ class ChartNode(Node):
     height = self._height
 
     obj = Variable(self._args[0]).resolve(context)
+    extra_args = [Variable(arg).resolve(context) for arg in self._args[1:]]
     try:
-      chart_result = self._chart_fn(obj)
+      chart_result = self._chart_fn(obj, *extra_args)
     except charts.ChartError, e:
       error_str = 'chart error: %s' % (e,)
       return ChartNode.ERROR_TMPL % vars()
@@ -283,13 +284,14 @@ class ChartNode(Node):
     chart_data = kbjson.dumps(chart_data, indent=None)
     return ChartNode.CHART_TMPL % vars()
 
-  def chart_sensor(self, obj):
+  def chart_sensor(self, obj, hours=6):
     """Shows a simple line plot of a specific temperature sensor.
 
     Args:
       obj - the models.ThermoSensor to plot
+      hours - the number of hours to plot
     """
-    return charts.TemperatureSensorChart(obj)
+    return charts.TemperatureSensorChart(obj, hours)
 
   def chart_keg_volume(self, obj):
     """Shows a horizontal bar chart of keg served/remaining volume.
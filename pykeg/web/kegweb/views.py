@@ -76,18 +76,7 @@ def system_stats(request):
     'stats': stats,
   })
 
-  top_drinkers = []
-  for drinkervol in stats.get('volume_by_drinker', []):
-    username = drinkervol.username
-    vol = drinkervol.volume_ml
-    try:
-      user = models.User.objects.get(username=username)
-    except models.User.DoesNotExist:
-      continue  # should not happen
-    top_drinkers.append((vol, user))
-  top_drinkers.sort(reverse=True)
-
-  context['top_drinkers'] = top_drinkers[:10]
+  context['top_drinkers'] = models.LeaderboardEntry.Top('system')
 
   return render_to_response('kegweb/system-stats.html', context_instance=context)
 
@@ -18,6 +18,7 @@
 
 from pykeg import EPOCH
 
+from pykeg.core import cache
 from pykeg.core import models
 
 from django.db import DatabaseError
@@ -48,6 +49,17 @@ def _path_allowed(path, kbsite):
   return False
 
 
+class CacheInvalidationMiddleware:
+  """Completes invalidation of cached rows saved during the request.
+
+  Must be installed before TransactionMiddleware (in request order), so that
+  it runs after the request's transaction has been committed.
+  """
+  def process_response(self, request, response):
+    cache.FlushPendingInvalidations()
+    return response
+
+
 class KegbotSiteMiddleware:
   ALLOWED_VIEW_MODULE_PREFIXES = (
       'pykeg.web.setup_wizard.',
@@ -58,9 +70,10 @@ class KegbotSiteMiddleware:
     request.need_upgrade = False
 
     try:
-      request.kbsite = models.KegbotSite.objects.get(name='default')
-      epoch = request.kbsite.epoch
-    except (models.KegbotSite.DoesNotExist, DatabaseError), e:
+      request.kbsite = models.KegbotSite.get(create=False)
+      if request.kbsite:
+        epoch = request.kbsite.epoch
+    except DatabaseError, e:
       request.kbsite = None
 
     if not request.kbsite or not request.kbsite.is_setup:
@@ -22,6 +22,7 @@ from kegbot.util import util
 from kegbot.util import kbjson
 
 from pykeg.core import models
+from pykeg.core import sessions
 from pykeg.proto import protolib
 
 from pykeg.connections import tasks as connection_tasks
@@ -59,3 +60,22 @@ def handle_new_events(event_list):
 @task
 def handle_new_picture(picture_id):
   connection_tasks.handle_new_picture.delay(picture_id)
+
+@task
+def process_pending_drinks():
+  from pykeg.core import backend
+  b = backend.KegbotBackend()
+  while b.ProcessPendingDrinks():
+    pass
+
+@task
+def apply_session_timeout_changes():
+  sessions.ApplyTimeoutChanges()
+
+@task
+def prune_thermologs():
+  return models.Thermolog.PruneExpired()
+
+@task
+def rollup_thermologs():
+  models.ThermoRollup.Update()